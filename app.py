@@ -1,66 +1,299 @@
+import time
+
+# Measured from the first line so time-to-first-request includes imports
+_process_started = time.perf_counter()
+
 from flask import Flask, render_template, redirect, url_for, flash, request
 from flask_login import LoginManager, login_required, current_user
 from datetime import datetime
 import os
+import threading
+import click
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+from config import Config
+from models import db, User
+from schema import ensure_schema
+from assets import init_assets
+from templating import init_templating
+from sites import init_sites, for_each_database
+from ratelimit import init_ratelimit
+from telemetry import init_telemetry, user_load_span
+from services.search import build_index as build_search_index
+from routes.auth import auth_bp
+from routes.equipment import equipment_bp
+from routes.requests import requests_bp
+from routes.teams import teams_bp
+from routes.dashboard import dashboard_bp
+from routes.api import api_bp
+from routes.sites import sites_bp
+from routes.parts import parts_bp
+from routes.attachments import attachments_bp
+from routes.sla import sla_bp
+from routes.search import search_bp
+from routes.bulk import bulk_bp
 
-# Initialize Flask-Login
+# Flask-Login
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'auth.login'
 login_manager.login_message = 'Please log in to access this page.'
 
-# Import models after app initialization
-from models import db, User
-
-# Initialize database
-db.init_app(app)
 
 # User loader for Flask-Login
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    with user_load_span():
+        return User.query.get(int(user_id))
 
-# Import and register blueprints
-from routes.auth import auth_bp
-from routes.equipment import equipment_bp
-from routes.requests import requests_bp
-from routes.teams import teams_bp
-from routes.dashboard import dashboard_bp
 
-app.register_blueprint(auth_bp)
-app.register_blueprint(equipment_bp)
-app.register_blueprint(requests_bp)
-app.register_blueprint(teams_bp)
-app.register_blueprint(dashboard_bp)
-
-# Context processor for global variables
-@app.context_processor
-def inject_user():
-    return dict(current_user=current_user, now=datetime.now())
-
-# Home route
-@app.route('/')
-def index():
-    if current_user.is_authenticated:
-        return redirect(url_for('dashboard.index'))
-    return redirect(url_for('auth.login'))
-
-# Create tables and seed data
-def init_db():
-    with app.app_context():
-        db.create_all()
-        
-        # Check if we need to seed data
-        if User.query.count() == 0:
-            from seed_data import seed_database
-            seed_database()
-            print("✅ Database seeded successfully!")
+def create_app(config=None):
+    """Application factory.
+
+    Everything here is import-light so a pre-fork server can call it once in
+    the master (gunicorn --preload wsgi:app) and let workers share the
+    imported modules and compiled templates copy-on-write.
+    """
+    factory_started = time.perf_counter()
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if config:
+        app.config.update(config)
+
+    login_manager.init_app(app)
+    db.init_app(app)
+
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(equipment_bp)
+    app.register_blueprint(requests_bp)
+    app.register_blueprint(teams_bp)
+    app.register_blueprint(dashboard_bp)
+    app.register_blueprint(api_bp)
+    app.register_blueprint(sites_bp)
+    app.register_blueprint(parts_bp)
+    app.register_blueprint(attachments_bp)
+    app.register_blueprint(sla_bp)
+    app.register_blueprint(search_bp)
+    app.register_blueprint(bulk_bp)
+
+    # Throttling of write endpoints; registered first so a throttled
+    # request does no further work (see ratelimit.py)
+    init_ratelimit(app)
+
+    # Per-request site scoping and per-site storage routing (see sites.py)
+    init_sites(app)
+
+    # Fingerprinted static assets and gzip for HTML (see assets.py)
+    init_assets(app)
+
+    # Compiled templates on disk and the {% cache %} fragment tag (see templating.py)
+    init_templating(app)
+
+    # Context processor for global variables
+    @app.context_processor
+    def inject_user():
+        return dict(current_user=current_user, now=datetime.now())
+
+    # Home route
+    @app.route('/')
+    def index():
+        if current_user.is_authenticated:
+            return redirect(url_for('dashboard.index'))
+        return redirect(url_for('auth.login'))
+
+    # Tracing spans and /metrics; last, so every view gets a span (see telemetry.py)
+    init_telemetry(app)
+
+    register_commands(app)
+
+    schema_ms = 0.0
+    if app.config['CHECK_SCHEMA_ON_START']:
+        schema_started = time.perf_counter()
+        with app.app_context():
+            if ensure_schema(db):
+                print("✅ Database schema created/upgraded "
+                      "(load sample data with: flask --app app seed)")
+                refresh_sqlite_replica()
+            # Built once here so pre-forked workers share it copy-on-write
+            build_search_index()
+            # Never hand open connections to forked workers
+            for engine in db.engines.values():
+                engine.dispose()
+        schema_ms = (time.perf_counter() - schema_started) * 1000
+
+    if app.config['PRELOAD_TEMPLATES']:
+        for name in app.jinja_env.list_templates(extensions=['html']):
+            app.jinja_env.get_template(name)
+
+    app.extensions['startup'] = {
+        'factory_ms': (time.perf_counter() - factory_started) * 1000,
+        'schema_ms': schema_ms,
+    }
+    _report_first_request(app)
+    return app
+
+
+def _report_first_request(app):
+    """Log how long this process took to serve its first request"""
+    lock = threading.Lock()
+    state = {'pending': True}
+
+    @app.after_request
+    def first_request_timer(response):
+        if state['pending']:
+            with lock:
+                if state['pending']:
+                    state['pending'] = False
+                    startup = app.extensions['startup']
+                    startup['first_request_ms'] = (time.perf_counter() - _process_started) * 1000
+                    print(f"⏱️  First request served {startup['first_request_ms']:.0f} ms after start "
+                          f"(pid {os.getpid()}, create_app {startup['factory_ms']:.0f} ms, "
+                          f"schema check {startup['schema_ms']:.0f} ms)", flush=True)
+        return response
+
+
+def refresh_sqlite_replica():
+    # A fresh SQLite replica has no tables until its first snapshot
+    if 'replica' in db.engines and db.engines['replica'].dialect.name == 'sqlite':
+        from db_routing import snapshot_sqlite_replica
+        snapshot_sqlite_replica(db)
+
+
+def register_commands(app):
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create or upgrade the database schema"""
+        if ensure_schema(db):
+            refresh_sqlite_replica()
+            print("✅ Database schema created/upgraded")
+        else:
+            print("✅ Database schema is up to date")
+
+    @app.cli.command('seed')
+    @click.option('--force', is_flag=True, help='Seed even if users already exist.')
+    def seed_command(force):
+        """Load sample data (only into an empty database unless --force)"""
+        ensure_schema(db)
+        if User.query.count() and not force:
+            print("Database already has users; use --force to seed anyway.")
+            return
+        from seed_data import seed_database
+        seed_database()
+        refresh_sqlite_replica()
+
+    # Run the notification worker as its own process: flask --app app outbox-worker
+    @app.cli.command('outbox-worker')
+    def outbox_worker_command():
+        """Deliver queued notifications until interrupted"""
+        from services.notifications import OutboxWorker
+        OutboxWorker(app).run()
+
+    # Run the SLA breach timer as its own process: flask --app app sla-timer
+    @app.cli.command('sla-timer')
+    def sla_timer_command():
+        """Fire SLA breach and escalation events at their deadlines until interrupted"""
+        from services.sla import SlaTimer
+        SlaTimer(app).run()
+
+    # Nightly failure-risk scoring, e.g. from cron: flask --app app score-risk
+    @app.cli.command('score-risk')
+    def score_risk_command():
+        """Recompute failure-risk scores for all equipment"""
+        from services.risk import score_fleet
+        results = for_each_database(score_fleet)
+        count = sum(count for count, _ in results)
+        seconds = sum(seconds for _, seconds in results)
+        print(f"✅ Scored {count} equipment in {seconds:.2f}s")
+
+    # Daily warranty digest per team, e.g. from cron: flask --app app warranty-digest
+    @app.cli.command('warranty-digest')
+    @click.option('--days', type=int, help='Window in days (default: WARRANTY_HORIZON_DAYS)')
+    def warranty_digest_command(days):
+        """Mail each team the equipment whose warranty ends soon"""
+        from services.warranty import send_digests
+        days = days or app.config['WARRANTY_HORIZON_DAYS']
+        results = for_each_database(lambda: send_digests(days))
+        teams = sum(teams for teams, _ in results)
+        count = sum(count for _, count in results)
+        print(f"✅ Queued warranty digests for {teams} teams ({count} equipment ending within {days} days)")
+
+    # Refresh a SQLite read replica, e.g. from cron: flask --app app snapshot-replica
+    @app.cli.command('snapshot-replica')
+    def snapshot_replica_command():
+        """Copy the primary database into the SQLite read replica"""
+        from db_routing import snapshot_sqlite_replica
+        snapshot_sqlite_replica(db)
+        print("✅ Replica snapshot updated")
+
+    # Trim the offline-sync change feed, e.g. nightly: flask --app app prune-changes
+    @app.cli.command('prune-changes')
+    def prune_changes_command():
+        """Delete sync change-log rows older than SYNC_CHANGE_RETENTION_DAYS"""
+        from services.sync import prune_changes
+        days = app.config['SYNC_CHANGE_RETENTION_DAYS']
+        deleted = sum(for_each_database(lambda: prune_changes(days)))
+        print(f"✅ Pruned {deleted} change-log rows older than {days} days")
+
+    # Remove photo files no attachment refers to any more, e.g. weekly: flask --app app prune-attachments
+    @app.cli.command('prune-attachments')
+    def prune_attachments_command():
+        """Delete stored photos and thumbnails that are no longer attached"""
+        from attachments import prune
+        from models import Attachment
+        referenced = set()
+        for digests in for_each_database(lambda: db.session.query(Attachment.sha256).distinct().all()):
+            referenced.update(digest for digest, in digests)
+        print(f"✅ Removed {prune(referenced)} unreferenced files")
+
+    # Cost vs capacity of password hashing settings
+    @app.cli.command('benchmark-passwords')
+    @click.option('--method', 'methods', multiple=True,
+                  help='Werkzeug hash method to measure (repeatable); defaults to a range of costs.')
+    @click.option('--seconds', default=1.0, help='Time spent measuring each method.')
+    def benchmark_passwords_command(methods, seconds):
+        """Measure login throughput per core for password hash settings"""
+        from passwords import benchmark, cpu_count, method_prefix
+        configured = method_prefix(app.config['PASSWORD_HASH_METHOD'])
+        methods = methods or (configured, 'scrypt:16384:8:1', 'scrypt:65536:8:1',
+                              'pbkdf2:sha256:600000', 'pbkdf2:sha256:1000000')
+        cores = cpu_count()
+        print(f"🔐 Password hash cost ({cores} cores, {app.config['PASSWORD_HASH_CONCURRENCY']} hashing threads per process)")
+        for method, ms, per_core in benchmark(dict.fromkeys(methods), seconds):
+            marker = '  ← configured' if method == configured else ''
+            print(f"   {method:<24} {ms:7.1f} ms/login  {per_core:7.1f} logins/s per core  "
+                  f"~{per_core * cores:7.0f} logins/s on this host{marker}")
+
+    # One-off switch to SITE_STORAGE=per_site: flask --app app split-sites
+    @app.cli.command('split-sites')
+    def split_sites_command():
+        """Move each site's equipment and requests into its own database file"""
+        from sites import per_site_storage, split_into_site_files
+        if not per_site_storage():
+            print("Set SITE_STORAGE=per_site before splitting the database.")
+            return
+        moved = split_into_site_files()
+        for table, count in moved.items():
+            print(f"✅ Moved {count} {table} rows")
+
+
+def start_outbox_worker(app):
+    from services.notifications import OutboxWorker
+    worker = OutboxWorker(app)
+    worker.start()
+    return worker
+
+
+def start_sla_timer(app):
+    from services.sla import SlaTimer
+    timer = SlaTimer(app)
+    timer.start()
+    return timer
+
 
 if __name__ == '__main__':
-    init_db()
+    app = create_app()
+    # With the reloader the app runs in a child process; start the worker only there
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_outbox_worker(app)
+        start_sla_timer(app)
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,141 @@
+"""Fingerprinted, pre-compressed static assets and gzip for HTML responses.
+
+``flask --app app build-assets`` copies every file under static/css and
+static/js to static/dist/ with a content hash in its name, writes .gz (and
+.br when the brotli package is installed) next to it, and records the
+mapping in static/dist/manifest.json.
+
+Templates call ``asset_url('css/style.css')``. It returns the fingerprinted
+/assets/... URL when a build exists and falls back to the normal static URL
+otherwise, so re-run the build after editing an asset. Fingerprinted files
+never change, so they are served with ``Cache-Control: immutable`` and the
+best pre-compressed variant the client accepts.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+
+from flask import request, send_from_directory, url_for, abort
+
+try:
+    import brotli
+except ImportError:  # optional: only gzip variants are built without it
+    brotli = None
+
+ASSET_DIRS = ('css', 'js')
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+ONE_YEAR = 31536000
+
+# Dynamic HTML smaller than this is not worth compressing
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
+_manifest = {}
+
+
+def build_assets(static_folder):
+    """Fingerprint and pre-compress assets; returns the new manifest"""
+    dist = os.path.join(static_folder, DIST_DIR)
+    manifest = {}
+
+    for asset_dir in ASSET_DIRS:
+        for root, _, files in os.walk(os.path.join(static_folder, asset_dir)):
+            for filename in files:
+                source = os.path.join(root, filename)
+                logical = os.path.relpath(source, static_folder).replace(os.sep, '/')
+                with open(source, 'rb') as f:
+                    content = f.read()
+
+                digest = hashlib.sha256(content).hexdigest()[:12]
+                stem, ext = os.path.splitext(logical)
+                hashed = f'{stem}.{digest}{ext}'
+                target = os.path.join(dist, hashed)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+
+                with open(target, 'wb') as f:
+                    f.write(content)
+                with open(target + '.gz', 'wb') as f:
+                    f.write(gzip.compress(content, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    with open(target + '.br', 'wb') as f:
+                        f.write(brotli.compress(content))
+
+                manifest[logical] = hashed
+
+    with open(os.path.join(dist, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    _manifest.clear()
+    _manifest.update(manifest)
+    return manifest
+
+
+def load_manifest(static_folder):
+    _manifest.clear()
+    path = os.path.join(static_folder, DIST_DIR, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as f:
+            _manifest.update(json.load(f))
+
+
+def asset_url(filename):
+    """url_for('static', ...) replacement that prefers the fingerprinted file"""
+    hashed = _manifest.get(filename)
+    if hashed is None:
+        return url_for('static', filename=filename)
+    return url_for('serve_asset', filename=hashed)
+
+
+def init_assets(app):
+    load_manifest(app.static_folder)
+    app.jinja_env.globals['asset_url'] = asset_url
+
+    @app.route('/assets/<path:filename>')
+    def serve_asset(filename):
+        dist = os.path.join(app.static_folder, DIST_DIR)
+        if filename == MANIFEST or filename.endswith(('.gz', '.br')):
+            abort(404)
+
+        encodings = request.accept_encodings
+        encoding = None
+        if brotli is not None and encodings['br'] and os.path.exists(os.path.join(dist, filename + '.br')):
+            encoding = 'br'
+        elif encodings['gzip'] and os.path.exists(os.path.join(dist, filename + '.gz')):
+            encoding = 'gzip'
+
+        suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding, '')
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_from_directory(dist, filename + suffix, mimetype=mimetype,
+                                       max_age=ONE_YEAR, conditional=True)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Cache-Control'] = f'public, max-age={ONE_YEAR}, immutable'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    @app.after_request
+    def compress_html(response):
+        if (response.mimetype != 'text/html'
+                or response.status_code != 200
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or not request.accept_encodings['gzip']):
+            return response
+
+        data = response.get_data()
+        if len(data) < GZIP_MIN_SIZE:
+            return response
+
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        return response
+
+    @app.cli.command('build-assets')
+    def build_assets_command():
+        """Fingerprint and pre-compress static assets"""
+        manifest = build_assets(app.static_folder)
+        print(f"✅ Built {len(manifest)} assets into static/{DIST_DIR}/")
@@ -0,0 +1,172 @@
+"""Content-addressed storage for photo attachments.
+
+Each file is stored once under its SHA-256 (<ATTACHMENT_DIR>/ab/abcdef...),
+however many requests or equipment records it is attached to; Attachment
+rows only carry the digest and the original file name. Uploads are copied
+to disk in fixed-size chunks while being hashed, so memory use does not
+depend on the file size, then renamed into place.
+
+Thumbnails are rendered by a small process pool after the upload has been
+committed, so resizing never runs on (or blocks) a request thread. They
+need Pillow; without it the original is served in their place.
+
+Blobs are never rewritten, which makes the digest a strong ETag. Files no
+longer referenced by any Attachment row are removed by
+``flask --app app prune-attachments``.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+
+try:
+    from PIL import Image
+except ImportError:  # optional: photos are served without thumbnails
+    Image = None
+
+CHUNK_SIZE = 64 * 1024
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_DIR = 'thumbs'
+
+# Only photos are accepted; the type comes from the file's first bytes,
+# never from the client-supplied name or Content-Type
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class UnsupportedFile(Exception):
+    """The upload is not a supported photo format"""
+
+
+class FileTooLarge(Exception):
+    """The upload exceeds ATTACHMENT_MAX_BYTES"""
+
+
+def storage_dir():
+    directory = current_app.config.get('ATTACHMENT_DIR') or os.path.join(current_app.instance_path, 'attachments')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def blob_path(digest):
+    return os.path.join(storage_dir(), digest[:2], digest)
+
+
+def thumbnail_path(digest):
+    return os.path.join(storage_dir(), THUMBNAIL_DIR, digest[:2], f'{digest}.jpg')
+
+
+def sniff_content_type(head):
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, content_type in SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return None
+
+
+def store(stream):
+    """Hash and save an upload; returns (digest, size, content_type)"""
+    max_bytes = current_app.config['ATTACHMENT_MAX_BYTES']
+    directory = storage_dir()
+    digest = hashlib.sha256()
+    size = 0
+    head = b''
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='upload-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if len(head) < 16:
+                    head += chunk[:16 - len(head)]
+                size += len(chunk)
+                if size > max_bytes:
+                    raise FileTooLarge(f'Photos are limited to {max_bytes // (1024 * 1024)} MB')
+                digest.update(chunk)
+                out.write(chunk)
+
+        content_type = sniff_content_type(head)
+        if content_type is None:
+            raise UnsupportedFile('Only JPEG, PNG, GIF and WebP photos can be attached')
+
+        digest = digest.hexdigest()
+        target = blob_path(digest)
+        try:
+            # Already stored for another record: refresh the mtime so prune()
+            # treats it as new until the row referencing it is committed
+            os.utime(target)
+            os.remove(temp_path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(temp_path, target)
+        return digest, size, content_type
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _render_thumbnail(source, target, size):
+    """Runs in a pool process"""
+    if os.path.exists(target):
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with Image.open(source) as image:
+        image.thumbnail(size)
+        temp_path = f'{target}.{os.getpid()}.tmp'
+        image.convert('RGB').save(temp_path, 'JPEG', quality=80)
+    os.replace(temp_path, target)
+
+
+def _thumbnail_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=current_app.config['ATTACHMENT_THUMBNAIL_WORKERS'])
+    return _pool
+
+
+def queue_thumbnail(digest):
+    """Render a thumbnail in the background; call after the upload is committed"""
+    target = thumbnail_path(digest)
+    if Image is None or os.path.exists(target):
+        return
+    logger = current_app.logger
+    future = _thumbnail_pool().submit(_render_thumbnail, blob_path(digest), target, THUMBNAIL_SIZE)
+    future.add_done_callback(
+        lambda done: done.exception() and logger.warning('Thumbnail for %s failed: %s', digest, done.exception())
+    )
+
+
+def prune(referenced, grace_seconds=3600):
+    """Delete blobs and thumbnails whose digest is not referenced; returns files removed.
+
+    Files younger than grace_seconds are kept: their upload may not have
+    been committed yet.
+    """
+    cutoff = time.time() - grace_seconds
+    removed = 0
+    for root, _, files in os.walk(storage_dir()):
+        for filename in files:
+            digest = filename.split('.')[0]
+            path = os.path.join(root, filename)
+            if digest in referenced or os.path.getmtime(path) > cutoff:
+                continue
+            os.remove(path)
+            removed += 1
+    return removed
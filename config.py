@@ -0,0 +1,97 @@
+import os
+
+
+class Config:
+    """Default settings; create_app() accepts overrides as a dict"""
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URI', 'sqlite:///database.db')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Optional read replica for dashboards and reports, e.g. sqlite:///database-replica.db
+    # (refreshed by `flask --app app snapshot-replica`) or a Postgres standby URL
+    if os.environ.get('REPLICA_DATABASE_URI'):
+        SQLALCHEMY_BINDS = {'replica': os.environ['REPLICA_DATABASE_URI']}
+    READ_REPLICA_STICKY_SECONDS = 10
+
+    # Multi-site: 'shared' keeps every site in one database partitioned by
+    # site_id; 'per_site' stores each site's equipment and requests in its own
+    # SQLite file (site-<id>.db in SITE_DATABASE_DIR, default: instance folder)
+    SITE_STORAGE = os.environ.get('SITE_STORAGE', 'shared')
+    SITE_DATABASE_DIR = os.environ.get('SITE_DATABASE_DIR')
+
+    # Outgoing mail is written to the outbox table and delivered by OutboxWorker.
+    # MAIL_TRANSPORT is 'console' (log only) or 'smtp'; for local testing run a
+    # debugging SMTP server on MAIL_SERVER:MAIL_PORT.
+    MAIL_TRANSPORT = os.environ.get('MAIL_TRANSPORT', 'console')
+    MAIL_SERVER = os.environ.get('MAIL_SERVER', 'localhost')
+    MAIL_PORT = int(os.environ.get('MAIL_PORT', 1025))
+    MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') == '1'
+    MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
+    MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER', 'GearGuard <noreply@gearguard.local>')
+    OUTBOX_BATCH_SIZE = 50
+    OUTBOX_MAX_ATTEMPTS = 6
+    OUTBOX_BACKOFF_SECONDS = 30
+    OUTBOX_POLL_SECONDS = 5
+
+    # Photo attachments: content-addressed files under ATTACHMENT_DIR (default:
+    # instance/attachments); thumbnails are rendered by a process pool
+    ATTACHMENT_DIR = os.environ.get('ATTACHMENT_DIR')
+    ATTACHMENT_MAX_BYTES = 20 * 1024 * 1024
+    ATTACHMENT_THUMBNAIL_WORKERS = 2
+    # Werkzeug rejects larger request bodies before reading them
+    MAX_CONTENT_LENGTH = 50 * 1024 * 1024
+
+    # New SLA rows are picked up by the breach timer within this many seconds;
+    # known deadlines fire on time regardless
+    SLA_TIMER_POLL_SECONDS = 30
+
+    # Token-bucket limits for POST/PUT/PATCH/DELETE, per client IP and per
+    # user (or submitted email before login); see ratelimit.py. Buckets are
+    # per process unless RATELIMIT_STORAGE_URL points at Redis.
+    RATELIMIT_ENABLED = True
+    RATELIMIT_STORAGE_URL = os.environ.get('RATELIMIT_STORAGE_URL')
+    RATELIMITS = {
+        'auth.login': {'ip': '20/minute', 'user': '5/minute'},
+        'auth.signup': {'ip': '5/minute'},
+        'auth.forgot_password': {'ip': '5/minute', 'user': '3/hour'},
+        'auth.reset_password': {'ip': '10/minute'},
+        'requests.api_update_status': {'user': '30/minute'},
+    }
+    # Every other write endpoint shares these buckets
+    RATELIMIT_WRITES = {'ip': '300/minute', 'user': '120/minute'}
+
+    # Any Werkzeug method string; existing hashes are upgraded on login.
+    # Compare settings with: flask --app app benchmark-passwords
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    # Hashing threads per process; logins that would wait longer than the
+    # budget for one get 503 instead of queueing
+    PASSWORD_HASH_CONCURRENCY = os.cpu_count() or 2
+    PASSWORD_HASH_LATENCY_BUDGET_MS = 1500
+
+    # Request traces in OTLP/JSON: a file path (one trace per line) or an
+    # OTLP/HTTP collector URL such as http://localhost:4318/v1/traces.
+    # Unset, only the /metrics counters are kept; see telemetry.py.
+    TRACE_EXPORT = os.environ.get('TRACE_EXPORT')
+    # Share of new traces exported; a sampled incoming traceparent always is
+    TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 1.0))
+    # /metrics answers only requests with "Authorization: Bearer <token>";
+    # unset, it is 404 (it shows per-route traffic of an authenticated app)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+    # "Warranty ends soon" window of the equipment filter and the daily
+    # digest (flask --app app warranty-digest)
+    WARRANTY_HORIZON_DAYS = 30
+
+    # Offline sync clients must reconnect within this many days or bootstrap again
+    SYNC_CHANGE_RETENTION_DAYS = 30
+
+    # Startup: compare the stored schema version instead of running
+    # create_all(), and compile every template once so pre-forked workers
+    # share them copy-on-write
+    CHECK_SCHEMA_ON_START = True
+    PRELOAD_TEMPLATES = True
+    # Compiled templates are kept here across restarts (default: instance/jinja-cache)
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR')
+    # Rendered {% cache %} fragments kept per process; 0 renders everything live
+    FRAGMENT_CACHE_MAX_ENTRIES = 5000
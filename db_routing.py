@@ -0,0 +1,90 @@
+"""Read/write routing between the primary database and a read replica.
+
+When SQLALCHEMY_BINDS has a ``replica`` entry, views marked read-only send
+their SELECTs to that engine. Everything else stays on the primary:
+
+* INSERT/UPDATE/DELETE statements and ORM flushes,
+* any query in a request that has already written, and
+* every query from a user who wrote within READ_REPLICA_STICKY_SECONDS,
+  so a redirect after a form post always reads its own write.
+
+The replica can be a Postgres hot standby or, for SQLite, a second file
+refreshed with snapshot_sqlite_replica() (``flask --app app snapshot-replica``).
+
+With per-site storage (see sites.py) everything goes to the active site's
+engine instead, which takes precedence over the replica.
+"""
+import sqlite3
+import time
+from functools import wraps
+
+from flask import current_app, g, has_app_context, has_request_context, session as http_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA_BIND = 'replica'
+STICKY_SESSION_KEY = '_primary_until'
+
+
+class RoutingSession(Session):
+    """Session that sends read-only view queries to the replica bind"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context() and g.get('db_site_engine') is not None:
+            return g.db_site_engine
+        if bind is None and self._use_replica(clause):
+            return self._db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _use_replica(self, clause):
+        if not has_request_context() or not g.get('db_read_replica'):
+            return False
+        if REPLICA_BIND not in self._db.engines:
+            return False
+        if self._flushing or isinstance(clause, UpdateBase) or g.get('db_wrote'):
+            return False
+        return http_session.get(STICKY_SESSION_KEY, 0) < time.time()
+
+
+def read_only(view):
+    """Mark a view as safe to serve from the read replica"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_write(session, flush_context):
+    if has_request_context():
+        g.db_wrote = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _stick_to_primary(session):
+    # Keep this user on the primary long enough to read their own write
+    if has_request_context() and g.get('db_wrote'):
+        sticky = current_app.config.get('READ_REPLICA_STICKY_SECONDS', 10)
+        http_session[STICKY_SESSION_KEY] = time.time() + sticky
+
+
+def snapshot_sqlite_replica(db):
+    """Copy the primary SQLite database into the replica file in place.
+
+    Uses the online backup API, so the primary stays writable and replica
+    readers see either the old or the new snapshot.
+    """
+    primary = db.engines[None]
+    replica = db.engines[REPLICA_BIND]
+    if primary.dialect.name != 'sqlite' or replica.dialect.name != 'sqlite':
+        raise RuntimeError('Snapshots are only needed for a SQLite replica')
+
+    source = sqlite3.connect(primary.url.database)
+    target = sqlite3.connect(replica.url.database, timeout=30)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
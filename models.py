@@ -1,10 +1,19 @@
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from sqlalchemy import inspect as inspect_state, text
+from sqlalchemy.orm import declared_attr
+from datetime import datetime, time
+import json
 import secrets
+from db_routing import RoutingSession
+from passwords import hash_password, verify_password, needs_rehash
 
-db = SQLAlchemy()
+# Read-only views can be routed to a replica bind (see db_routing)
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Site that existing data is migrated into and that site-less rows fall back to
+DEFAULT_SITE_ID = 1
 
 # Association table for team members
 team_members = db.Table('team_members',
@@ -15,6 +24,39 @@ team_members = db.Table('team_members',
                         )
 
 
+def _current_site_id():
+    # Rows created inside a site-scoped request belong to that site
+    if has_app_context() and g.get('site_id'):
+        return g.site_id
+    return DEFAULT_SITE_ID
+
+
+class SiteScoped:
+    """Mixin for rows that belong to one site; queries are filtered by sites.py"""
+
+    @declared_attr
+    def site_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('sites.id'), nullable=False, index=True,
+                         default=_current_site_id, server_default=str(DEFAULT_SITE_ID))
+
+    @declared_attr
+    def site(cls):
+        return db.relationship('Site')
+
+
+class Site(db.Model):
+    """Plant or site; teams, equipment and requests each belong to one"""
+    __tablename__ = 'sites'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)
+    code = db.Column(db.String(20), nullable=False, unique=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Site {self.code}>'
+
+
 class User(UserMixin, db.Model):
     """User model for authentication and role management"""
     __tablename__ = 'users'
@@ -26,8 +68,12 @@ class User(UserMixin, db.Model):
     role = db.Column(db.String(20), nullable=False, default='Technician')
     reset_token = db.Column(db.String(100), unique=True)
     reset_token_expiry = db.Column(db.DateTime)
+    # NULL: not bound to a site (admins and managers who work across sites)
+    site_id = db.Column(db.Integer, db.ForeignKey('sites.id'))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    site = db.relationship('Site')
+
     # Relationship to Teams
     # We define it here. It will automatically create 'members' on the Team objects
     teams = db.relationship('Team', secondary=team_members,
@@ -39,10 +85,13 @@ class User(UserMixin, db.Model):
                                         lazy='dynamic')
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return needs_rehash(self.password_hash)
 
     def generate_reset_token(self):
         self.reset_token = secrets.token_urlsafe(32)
@@ -58,7 +107,7 @@ class User(UserMixin, db.Model):
         return f'<User {self.name}>'
 
 
-class Team(db.Model):
+class Team(SiteScoped, db.Model):
     """Maintenance team model"""
     __tablename__ = 'teams'
 
@@ -105,7 +154,7 @@ class Team(db.Model):
         return f'<Team {self.name}>'
 
 
-class Equipment(db.Model):
+class Equipment(SiteScoped, db.Model):
     """Equipment/Asset model"""
     __tablename__ = 'equipment'
 
@@ -117,23 +166,39 @@ class Equipment(db.Model):
     team_id = db.Column(db.Integer, db.ForeignKey('teams.id'), nullable=False)
     default_technician_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     purchase_date = db.Column(db.Date)
-    warranty_expiry = db.Column(db.Date)
+    # Indexed for the "expiring within N days" range scans (services/warranty.py)
+    warranty_expiry = db.Column(db.Date, index=True)
     location = db.Column(db.String(200))
     is_scrapped = db.Column(db.Boolean, default=False)
+    # Line -> machine -> subassembly; equipment_closure holds every ancestor path
+    parent_id = db.Column(db.Integer, db.ForeignKey('equipment.id'), index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Row version: every ORM UPDATE/DELETE is `WHERE id=? AND version=?`
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
     default_technician = db.relationship(
         'User', foreign_keys=[default_technician_id])
+    parent = db.relationship('Equipment', remote_side=[id],
+                             backref=db.backref('children', lazy='dynamic'))
     maintenance_requests = db.relationship('MaintenanceRequest',
                                            backref='equipment',
                                            lazy='dynamic',
                                            cascade='all, delete-orphan')
+    risk = db.relationship('EquipmentRisk', uselist=False,
+                           cascade='all, delete-orphan')
+    attachments = db.relationship('Attachment', order_by='Attachment.id',
+                                  cascade='all, delete-orphan')
 
     def get_open_requests_count(self):
         return self.maintenance_requests.filter(
             MaintenanceRequest.status.in_(['New', 'In Progress'])
         ).count()
 
+    def in_warranty(self, on=None):
+        return self.warranty_expiry is not None and self.warranty_expiry >= (on or datetime.now().date())
+
     def get_status_badge(self):
         if self.is_scrapped:
             return 'Scrapped'
@@ -145,9 +210,52 @@ class Equipment(db.Model):
         return f'<Equipment {self.name}>'
 
 
-class MaintenanceRequest(db.Model):
+class EquipmentClosure(db.Model):
+    """One row per (ancestor, descendant) pair, including each node with itself at depth 0"""
+    __tablename__ = 'equipment_closure'
+    __table_args__ = (
+        db.Index('ix_equipment_closure_descendant_depth', 'descendant_id', 'depth'),
+    )
+
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('equipment.id'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('equipment.id'), primary_key=True)
+    depth = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<EquipmentClosure {self.ancestor_id}>{self.descendant_id} ({self.depth})>'
+
+
+class EquipmentRisk(db.Model):
+    """Failure-risk score per equipment, rebuilt by the nightly scoring job"""
+    __tablename__ = 'equipment_risk'
+
+    equipment_id = db.Column(db.Integer, db.ForeignKey('equipment.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False, index=True)
+    failures_90d = db.Column(db.Integer, nullable=False, default=0)
+    failures_365d = db.Column(db.Integer, nullable=False, default=0)
+    age_years = db.Column(db.Float)
+    in_warranty = db.Column(db.Boolean, nullable=False, default=False)
+    avg_repair_hours = db.Column(db.Float)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+    def get_level(self):
+        if self.score >= 60:
+            return 'High'
+        return 'Medium' if self.score >= 30 else 'Low'
+
+    def __repr__(self):
+        return f'<EquipmentRisk {self.equipment_id}: {self.score}>'
+
+
+class MaintenanceRequest(SiteScoped, db.Model):
     """Maintenance request model"""
     __tablename__ = 'maintenance_requests'
+    __table_args__ = (
+        # Subtree roll-ups join requests by equipment
+        db.Index('ix_maintenance_requests_equipment_status', 'equipment_id', 'status'),
+        # A technician's own queue and counters (services/workqueue.py)
+        db.Index('ix_maintenance_requests_technician_status_due', 'assigned_technician_id', 'status', 'due_date'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     subject = db.Column(db.String(200), nullable=False)
@@ -166,8 +274,18 @@ class MaintenanceRequest(db.Model):
     due_date = db.Column(db.Date)
     completed_at = db.Column(db.DateTime)
     notes = db.Column(db.Text)
+    # Corrective work raised while the equipment was under warranty
+    under_warranty = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
+    # Row version: every ORM UPDATE/DELETE is `WHERE id=? AND version=?`
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
     created_by = db.relationship('User', foreign_keys=[created_by_id])
+    attachments = db.relationship('Attachment', order_by='Attachment.id',
+                                  cascade='all, delete-orphan')
+    sla = db.relationship('RequestSla', uselist=False, backref='request',
+                          cascade='all, delete-orphan')
 
     def is_overdue(self):
         if self.status in ['Repaired', 'Scrap']:
@@ -191,3 +309,386 @@ class MaintenanceRequest(db.Model):
 
     def __repr__(self):
         return f'<MaintenanceRequest {self.subject}>'
+
+
+class OutboxMessage(db.Model):
+    """Notification queued in the same transaction as the state change that caused it"""
+    __tablename__ = 'outbox'
+    __table_args__ = (
+        db.Index('ix_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    dedup_key = db.Column(db.String(200), unique=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(32), index=True)
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<OutboxMessage {self.kind} to {self.recipient}>'
+
+
+class RequestEvent(db.Model):
+    """Append-only history of a maintenance request (create, assign, status change)"""
+    __tablename__ = 'request_events'
+    __table_args__ = (
+        db.Index('ix_request_events_request_time', 'request_id', 'created_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    # No relationship/cascade on purpose: history outlives the request row
+    request_id = db.Column(db.Integer, db.ForeignKey('maintenance_requests.id'), nullable=False)
+    event_type = db.Column(db.String(20), nullable=False)
+    from_status = db.Column(db.String(20))
+    to_status = db.Column(db.String(20))
+    actor_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Compact JSON, NULL when there is nothing beyond the columns above
+    payload = db.Column(db.Text)
+
+    actor = db.relationship('User', foreign_keys=[actor_id])
+
+    def get_payload(self):
+        return json.loads(self.payload) if self.payload else {}
+
+    def __repr__(self):
+        return f'<RequestEvent {self.event_type} #{self.request_id}>'
+
+
+@db.event.listens_for(RequestEvent, 'before_update')
+@db.event.listens_for(RequestEvent, 'before_delete')
+def _request_events_are_append_only(mapper, connection, target):
+    raise ValueError('Request events are append-only')
+
+
+class RequestChange(db.Model):
+    """Change feed for offline sync clients; the autoincrement id is the sync cursor"""
+    __tablename__ = 'request_changes'
+    __table_args__ = (
+        db.Index('ix_request_changes_team_id_id', 'team_id', 'id'),
+        # Ids are never reused, even after pruning, so cursors stay valid
+        {'sqlite_autoincrement': True},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    request_id = db.Column(db.Integer, nullable=False)
+    team_id = db.Column(db.Integer, nullable=False)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<RequestChange {self.id} #{self.request_id}>'
+
+
+@db.event.listens_for(RoutingSession, 'after_flush')
+def _log_request_changes(session, flush_context):
+    # Written in the flush's own transaction; bulk query.update()/delete()
+    # bypasses the ORM and has to log its changes itself
+    now = datetime.utcnow()
+    rows = []
+    for obj in session.new:
+        if isinstance(obj, MaintenanceRequest):
+            rows.append({'request_id': obj.id, 'team_id': obj.team_id, 'deleted': False, 'changed_at': now})
+    for obj in session.dirty:
+        if isinstance(obj, MaintenanceRequest) and session.is_modified(obj, include_collections=False):
+            rows.append({'request_id': obj.id, 'team_id': obj.team_id, 'deleted': False, 'changed_at': now})
+            # A request moved to another team disappears from the old team's clients
+            for old_team_id in inspect_state(obj).attrs.team_id.history.deleted:
+                if old_team_id is not None and old_team_id != obj.team_id:
+                    rows.append({'request_id': obj.id, 'team_id': old_team_id, 'deleted': True, 'changed_at': now})
+    for obj in session.deleted:
+        if isinstance(obj, MaintenanceRequest):
+            rows.append({'request_id': obj.id, 'team_id': obj.team_id, 'deleted': True, 'changed_at': now})
+    if rows:
+        session.connection().execute(RequestChange.__table__.insert(), rows)
+
+
+class Part(db.Model):
+    """Spare part in the shared catalogue"""
+    __tablename__ = 'parts'
+
+    id = db.Column(db.Integer, primary_key=True)
+    sku = db.Column(db.String(50), nullable=False, unique=True)
+    name = db.Column(db.String(200), nullable=False)
+    unit = db.Column(db.String(20), nullable=False, default='pcs')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Part {self.sku}>'
+
+
+class StockLocation(SiteScoped, db.Model):
+    """Storeroom, shelf or van that holds parts"""
+    __tablename__ = 'stock_locations'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<StockLocation {self.name}>'
+
+
+class StockLedgerEntry(db.Model):
+    """Append-only stock movement; replaying the ledger reproduces StockBalance"""
+    __tablename__ = 'stock_ledger'
+    __table_args__ = (
+        db.Index('ix_stock_ledger_part_location_time', 'part_id', 'location_id', 'created_at'),
+        db.Index('ix_stock_ledger_request_id', 'request_id'),
+    )
+
+    # receipt: on_hand += quantity     reservation: reserved += quantity
+    # release: reserved -= quantity    consumption: on_hand -= quantity
+    ENTRY_TYPES = ('receipt', 'reservation', 'release', 'consumption')
+
+    id = db.Column(db.Integer, primary_key=True)
+    part_id = db.Column(db.Integer, db.ForeignKey('parts.id'), nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('stock_locations.id'), nullable=False)
+    entry_type = db.Column(db.String(20), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    # No relationship/cascade on purpose: the ledger outlives the request row
+    request_id = db.Column(db.Integer, db.ForeignKey('maintenance_requests.id'))
+    actor_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    note = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    part = db.relationship('Part')
+    location = db.relationship('StockLocation')
+    actor = db.relationship('User', foreign_keys=[actor_id])
+
+    def __repr__(self):
+        return f'<StockLedgerEntry {self.entry_type} {self.quantity} of part {self.part_id}>'
+
+
+@db.event.listens_for(StockLedgerEntry, 'before_update')
+@db.event.listens_for(StockLedgerEntry, 'before_delete')
+def _stock_ledger_is_append_only(mapper, connection, target):
+    raise ValueError('Stock ledger entries are append-only')
+
+
+class StockBalance(db.Model):
+    """Running totals per part and location, updated in the same transaction as each ledger entry"""
+    __tablename__ = 'stock_balances'
+
+    part_id = db.Column(db.Integer, db.ForeignKey('parts.id'), primary_key=True)
+    location_id = db.Column(db.Integer, db.ForeignKey('stock_locations.id'), primary_key=True)
+    on_hand = db.Column(db.Integer, nullable=False, default=0)
+    reserved = db.Column(db.Integer, nullable=False, default=0)
+
+    part = db.relationship('Part')
+    location = db.relationship('StockLocation')
+
+    @property
+    def available(self):
+        return self.on_hand - self.reserved
+
+    def __repr__(self):
+        return f'<StockBalance part {self.part_id} @ {self.location_id}: {self.on_hand}/{self.reserved}>'
+
+
+class PartReservation(db.Model):
+    """Quantity still reserved for a request, so releasing never sums the ledger"""
+    __tablename__ = 'part_reservations'
+
+    request_id = db.Column(db.Integer, db.ForeignKey('maintenance_requests.id'), primary_key=True)
+    part_id = db.Column(db.Integer, db.ForeignKey('parts.id'), primary_key=True)
+    location_id = db.Column(db.Integer, db.ForeignKey('stock_locations.id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+
+    part = db.relationship('Part')
+    location = db.relationship('StockLocation')
+
+    def __repr__(self):
+        return f'<PartReservation #{self.request_id} part {self.part_id}: {self.quantity}>'
+
+
+class Attachment(db.Model):
+    """Photo attached to a request or equipment; the file itself is stored once per SHA-256"""
+    __tablename__ = 'attachments'
+
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    content_type = db.Column(db.String(50), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    # Exactly one of request_id / equipment_id is set
+    request_id = db.Column(db.Integer, db.ForeignKey('maintenance_requests.id'), index=True)
+    equipment_id = db.Column(db.Integer, db.ForeignKey('equipment.id'), index=True)
+    uploaded_by_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    uploaded_by = db.relationship('User', foreign_keys=[uploaded_by_id])
+
+    def __repr__(self):
+        return f'<Attachment {self.filename} ({self.sha256[:12]})>'
+
+
+class BusinessCalendar(db.Model):
+    """Working days and hours (in a local time zone) that SLA targets are measured in"""
+    __tablename__ = 'business_calendars'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)
+    timezone = db.Column(db.String(50), nullable=False, default='UTC')
+    # ISO weekdays that are working days, Monday = 1
+    workdays = db.Column(db.String(7), nullable=False, default='12345')
+    day_start = db.Column(db.Time, nullable=False, default=time(8, 0))
+    day_end = db.Column(db.Time, nullable=False, default=time(17, 0))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    holidays = db.relationship('CalendarHoliday', order_by='CalendarHoliday.date',
+                               cascade='all, delete-orphan')
+
+    def __repr__(self):
+        return f'<BusinessCalendar {self.name}>'
+
+
+class CalendarHoliday(db.Model):
+    """A non-working date in a business calendar"""
+    __tablename__ = 'calendar_holidays'
+    __table_args__ = (
+        db.UniqueConstraint('calendar_id', 'date', name='uq_calendar_holidays_calendar_date'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    calendar_id = db.Column(db.Integer, db.ForeignKey('business_calendars.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    name = db.Column(db.String(100))
+
+    def __repr__(self):
+        return f'<CalendarHoliday {self.date}>'
+
+
+class SlaPolicy(db.Model):
+    """Response and resolve targets in business minutes; a blank type or team matches any"""
+    __tablename__ = 'sla_policies'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    request_type = db.Column(db.String(20))
+    team_id = db.Column(db.Integer, db.ForeignKey('teams.id'))
+    calendar_id = db.Column(db.Integer, db.ForeignKey('business_calendars.id'), nullable=False)
+    response_minutes = db.Column(db.Integer, nullable=False)
+    resolve_minutes = db.Column(db.Integer, nullable=False)
+    # Escalate to managers this long after a missed resolve target
+    escalate_after_minutes = db.Column(db.Integer)
+    is_active = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    team = db.relationship('Team')
+    calendar = db.relationship('BusinessCalendar')
+
+    def __repr__(self):
+        return f'<SlaPolicy {self.name}>'
+
+
+class RequestSla(db.Model):
+    """SLA deadlines of one request (kept out of maintenance_requests so timers never bump its version)"""
+    __tablename__ = 'request_slas'
+    __table_args__ = (
+        # Ids are never reused: the breach timer picks up new rows by id
+        {'sqlite_autoincrement': True},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    request_id = db.Column(db.Integer, db.ForeignKey('maintenance_requests.id'), nullable=False, unique=True)
+    policy_id = db.Column(db.Integer, db.ForeignKey('sla_policies.id'), nullable=False)
+    response_due_at = db.Column(db.DateTime, nullable=False)
+    resolve_due_at = db.Column(db.DateTime, nullable=False)
+    escalate_at = db.Column(db.DateTime)
+    responded_at = db.Column(db.DateTime)
+    response_breached_at = db.Column(db.DateTime)
+    resolve_breached_at = db.Column(db.DateTime)
+    escalated_at = db.Column(db.DateTime)
+
+    policy = db.relationship('SlaPolicy')
+
+    def __repr__(self):
+        return f'<RequestSla #{self.request_id}>'
+
+
+# Live SLA state of every request with an SLA, e.g.
+#   SELECT * FROM request_sla_state WHERE resolve_state = 'breached' AND status IN ('New', 'In Progress')
+# Timestamps are compared as text, which matches how DateTime is stored in SQLite.
+SLA_STATE_VIEW = 'request_sla_state'
+SLA_STATE_VIEW_SQL = """
+CREATE VIEW request_sla_state AS
+SELECT r.id AS request_id, r.site_id, r.team_id, r.request_type, r.status, s.policy_id,
+       s.response_due_at, s.responded_at, s.resolve_due_at, r.completed_at, s.escalated_at,
+       CASE WHEN s.responded_at IS NOT NULL
+            THEN CASE WHEN s.responded_at <= s.response_due_at THEN 'met' ELSE 'breached' END
+            WHEN s.response_due_at <= strftime('%Y-%m-%d %H:%M:%f', 'now') THEN 'breached'
+            ELSE 'pending' END AS response_state,
+       CASE WHEN r.completed_at IS NOT NULL
+            THEN CASE WHEN r.completed_at <= s.resolve_due_at THEN 'met' ELSE 'breached' END
+            WHEN s.resolve_due_at <= strftime('%Y-%m-%d %H:%M:%f', 'now') THEN 'breached'
+            ELSE 'pending' END AS resolve_state,
+       ROUND((julianday(s.resolve_due_at) - julianday('now')) * 1440) AS resolve_minutes_left
+FROM request_slas s
+JOIN maintenance_requests r ON r.id = s.request_id
+"""
+
+
+LINK_NODE_SQL = """
+INSERT INTO equipment_closure (ancestor_id, descendant_id, depth)
+SELECT ancestor_id, :id, depth + 1 FROM equipment_closure WHERE descendant_id = :parent_id
+UNION ALL SELECT :id, :id, 0
+"""
+
+# Detach the subtree from its old ancestors, then hang it under the new parent
+UNLINK_SUBTREE_SQL = """
+DELETE FROM equipment_closure
+WHERE descendant_id IN (SELECT descendant_id FROM equipment_closure WHERE ancestor_id = :id)
+  AND ancestor_id NOT IN (SELECT descendant_id FROM equipment_closure WHERE ancestor_id = :id)
+"""
+
+RELINK_SUBTREE_SQL = """
+INSERT INTO equipment_closure (ancestor_id, descendant_id, depth)
+SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1
+FROM equipment_closure above
+JOIN equipment_closure below ON below.ancestor_id = :id
+WHERE above.descendant_id = :parent_id
+"""
+
+
+@db.event.listens_for(RoutingSession, 'after_flush')
+def _maintain_equipment_closure(session, flush_context):
+    # Same transaction as the flush, so the closure never disagrees with parent_id
+    pending = {obj.id: obj for obj in session.new if isinstance(obj, Equipment)}
+    moved = [obj for obj in session.dirty if isinstance(obj, Equipment)
+             and inspect_state(obj).attrs.parent_id.history.has_changes()]
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Equipment)]
+    if not (pending or moved or deleted):
+        return
+
+    connection = session.connection()
+    # Parents first, so a child can copy its parent's ancestor paths
+    while pending:
+        ready = [obj for obj in pending.values() if obj.parent_id not in pending]
+        if not ready:
+            raise ValueError('Equipment hierarchy cannot contain a cycle')
+        for obj in ready:
+            connection.execute(text(LINK_NODE_SQL), {'id': obj.id, 'parent_id': obj.parent_id})
+            del pending[obj.id]
+
+    for obj in moved:
+        if obj.parent_id is not None and connection.execute(text(
+                'SELECT 1 FROM equipment_closure WHERE ancestor_id = :id AND descendant_id = :parent_id'
+        ), {'id': obj.id, 'parent_id': obj.parent_id}).first():
+            raise ValueError('Equipment cannot be moved under its own sub-asset')
+        connection.execute(text(UNLINK_SUBTREE_SQL), {'id': obj.id})
+        connection.execute(text(RELINK_SUBTREE_SQL), {'id': obj.id, 'parent_id': obj.parent_id})
+
+    for equipment_id in deleted:
+        connection.execute(text(
+            'DELETE FROM equipment_closure WHERE ancestor_id = :id OR descendant_id = :id'
+        ), {'id': equipment_id})
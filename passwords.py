@@ -0,0 +1,133 @@
+"""Password hashing with a configurable cost, transparent upgrades and a latency budget.
+
+PASSWORD_HASH_METHOD takes any Werkzeug method string, e.g.
+``scrypt:32768:8:1`` or ``pbkdf2:sha256:600000``. Stored hashes carry the
+method they were made with; on a successful login a hash made with other
+parameters is replaced by one with the current ones, so raising the cost
+upgrades accounts as their owners log in.
+
+Hashing runs in a per-process pool of PASSWORD_HASH_CONCURRENCY threads
+(hashlib releases the GIL while it works). A request whose estimated wait
+for the pool, from the queue length and the recent time per hash, would
+exceed PASSWORD_HASH_LATENCY_BUDGET_MS is answered with 503 and
+Retry-After at once instead of queueing behind a burst.
+
+``flask --app app benchmark-passwords`` reports logins per second per core
+for each method, to weigh cost against capacity.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from flask import current_app, has_app_context
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+
+# Weight of the newest sample in the running time-per-hash estimate
+SMOOTHING = 0.2
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending = 0
+_seconds_per_hash = None
+
+
+def configured_method():
+    if has_app_context():
+        return current_app.config.get('PASSWORD_HASH_METHOD', DEFAULT_METHOD)
+    return DEFAULT_METHOD
+
+
+@lru_cache(maxsize=None)
+def method_prefix(method):
+    """'scrypt' -> 'scrypt:32768:8:1': the method as Werkzeug writes it into a hash"""
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+@lru_cache(maxsize=None)
+def _dummy_hash(method):
+    return generate_password_hash('unused', method)
+
+
+def needs_rehash(password_hash, method=None):
+    """True when a stored hash was made with other parameters than configured"""
+    return password_hash.split('$', 1)[0] != method_prefix(method or configured_method())
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=current_app.config['PASSWORD_HASH_CONCURRENCY'],
+                                           thread_name_prefix='password-hash')
+    return _pool
+
+
+def _run(fn, *args):
+    """Run one hash in the pool, or shed the request when the wait would blow the budget"""
+    global _pending
+    if not has_app_context():
+        return fn(*args)
+
+    config = current_app.config
+    budget = config['PASSWORD_HASH_LATENCY_BUDGET_MS'] / 1000
+    with _pool_lock:
+        rounds = _pending // config['PASSWORD_HASH_CONCURRENCY'] + 1
+        if _seconds_per_hash is not None and rounds * _seconds_per_hash > budget:
+            raise ServiceUnavailable('The server is busy. Please try again in a moment.', retry_after=1)
+        _pending += 1
+
+    try:
+        return _executor().submit(_timed, fn, *args).result()
+    finally:
+        with _pool_lock:
+            _pending -= 1
+
+
+def _timed(fn, *args):
+    global _seconds_per_hash
+    started = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        elapsed = time.perf_counter() - started
+        with _pool_lock:
+            _seconds_per_hash = elapsed if _seconds_per_hash is None else \
+                (1 - SMOOTHING) * _seconds_per_hash + SMOOTHING * elapsed
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password, configured_method())
+
+
+def verify_password(password_hash, password):
+    """Check a password; with no hash (unknown account) the same work is done anyway,
+    so response time does not reveal which accounts exist"""
+    if password_hash is None:
+        _run(check_password_hash, _dummy_hash(configured_method()), password)
+        return False
+    return _run(check_password_hash, password_hash, password)
+
+
+def benchmark(methods, seconds=1.0):
+    """[(method, ms per hash, logins per second per core)] measured on one thread"""
+    results = []
+    for method in methods:
+        password_hash = generate_password_hash('benchmark-password', method)
+        count = 0
+        started = time.perf_counter()
+        while time.perf_counter() - started < seconds or count < 3:
+            check_password_hash(password_hash, 'benchmark-password')
+            count += 1
+        elapsed = (time.perf_counter() - started) / count
+        results.append((method_prefix(method), elapsed * 1000, 1 / elapsed))
+    return results
+
+
+def cpu_count():
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
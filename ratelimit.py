@@ -0,0 +1,156 @@
+"""Token-bucket rate limits for write endpoints.
+
+Every POST/PUT/PATCH/DELETE takes one token from a bucket per scope:
+``ip`` (the client address) and ``user`` (the logged-in user or, on the
+login and password-reset forms, the submitted email). RATELIMITS gives
+per-endpoint limits such as ``{'auth.login': {'ip': '20/minute'}}``; other
+write endpoints share RATELIMIT_WRITES. An empty bucket answers 429 with
+Retry-After instead of doing the work.
+
+Buckets live in process memory by default, so with N workers a limit is
+effectively N times as generous. Set RATELIMIT_STORAGE_URL to a redis://
+URL (needs the redis package) to share them between workers and hosts,
+or assign any object with a ``take(key, capacity, period)`` method to
+``app.extensions['ratelimit']``. If the shared store is unreachable,
+requests are let through rather than failed.
+
+Password hashing sheds load the same way when it falls behind (see
+passwords.py); both answers are rendered by the handler below.
+"""
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, jsonify, request
+from flask_login import current_user
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+try:
+    import redis
+except ImportError:  # optional: buckets stay in process memory without it
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+# Forms that identify the account before anyone is logged in
+ACCOUNT_FIELD = 'email'
+
+
+def parse_limit(limit):
+    """'20/minute' -> (20, 60)"""
+    count, _, period = limit.partition('/')
+    return int(count), PERIODS[period.strip().rstrip('s')]
+
+
+class MemoryBackend:
+    """Buckets in this process's memory, at most max_keys of them"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        # Least recently used first; evicting one forgets at most its deficit
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, period):
+        """Seconds to wait before a token is available; 0 means one was taken"""
+        now = time.monotonic()
+        rate = capacity / period
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class RedisBackend:
+    """Buckets shared by every process that uses the same Redis"""
+
+    # Refill, take and store atomically on the server's clock
+    SCRIPT = """
+    local capacity, rate = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = math.min(capacity, (tonumber(bucket[1]) or capacity) + (now - (tonumber(bucket[2]) or now)) * rate)
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, url, prefix='ratelimit:'):
+        if redis is None:
+            raise RuntimeError('RATELIMIT_STORAGE_URL needs the redis package')
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, socket_timeout=0.2)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def take(self, key, capacity, period):
+        return float(self._script(keys=[self.prefix + key], args=[capacity, capacity / period]))
+
+
+def _identities():
+    """scope -> identity of the caller, for the scopes that apply to this request"""
+    identities = {'ip': request.remote_addr or 'unknown'}
+    if current_user.is_authenticated:
+        identities['user'] = f'id:{current_user.id}'
+    elif request.form.get(ACCOUNT_FIELD):
+        identities['user'] = f'email:{request.form[ACCOUNT_FIELD].strip().lower()}'
+    return identities
+
+
+def check_rate_limits():
+    if request.method not in WRITE_METHODS or request.endpoint is None:
+        return
+    config = current_app.config
+    limits = config['RATELIMITS'].get(request.endpoint)
+    bucket = request.endpoint
+    if limits is None:
+        limits, bucket = config['RATELIMIT_WRITES'], 'writes'
+
+    backend = current_app.extensions['ratelimit']
+    identities = _identities()
+    for scope, limit in limits.items():
+        if scope not in identities:
+            continue
+        capacity, period = parse_limit(limit)
+        try:
+            wait = backend.take(f'{bucket}:{scope}:{identities[scope]}', capacity, period)
+        except Exception:
+            logger.exception('Rate limit store failed; letting the request through')
+            return
+        if wait:
+            raise TooManyRequests(retry_after=math.ceil(wait))
+
+
+def _wants_json():
+    return request.is_json or request.blueprint == 'api' or request.accept_mimetypes.best == 'application/json'
+
+
+def init_ratelimit(app):
+    url = app.config.get('RATELIMIT_STORAGE_URL')
+    app.extensions['ratelimit'] = RedisBackend(url) if url else MemoryBackend()
+
+    if app.config['RATELIMIT_ENABLED']:
+        app.before_request(check_rate_limits)
+
+    @app.errorhandler(TooManyRequests)
+    @app.errorhandler(ServiceUnavailable)
+    def too_busy(error):
+        if not _wants_json():
+            return error
+        message = 'Too many requests. Please slow down.' if error.code == 429 else error.description
+        headers = {'Retry-After': str(error.retry_after)} if error.retry_after else {}
+        return jsonify({'success': False, 'message': message, 'retry_after': error.retry_after}), \
+            error.code, headers
@@ -0,0 +1,360 @@
+from flask import Blueprint, request, Response
+from flask_login import current_user
+from models import db, MaintenanceRequest, Equipment, Team, User
+from services.hierarchy import subtree_ids
+from services.workqueue import work_queue, status_counts
+from services.sync import (changes_since, latest_cursor, apply_mutations, CursorExpired,
+                           BatchRetry, OPEN_STATUSES, MAX_BATCH)
+from sqlalchemy.orm import aliased
+from datetime import date, datetime
+
+try:
+    import orjson
+except ImportError:  # optional: falls back to the standard library encoder
+    orjson = None
+    import json
+
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 10000
+
+Technician = aliased(User)
+
+# Field name -> (column, table it needs joined or None)
+REQUEST_FIELDS = {
+    'id': (MaintenanceRequest.id, None),
+    'subject': (MaintenanceRequest.subject, None),
+    'description': (MaintenanceRequest.description, None),
+    'request_type': (MaintenanceRequest.request_type, None),
+    'status': (MaintenanceRequest.status, None),
+    'site_id': (MaintenanceRequest.site_id, None),
+    'equipment_id': (MaintenanceRequest.equipment_id, None),
+    'equipment_name': (Equipment.name, Equipment),
+    'team_id': (MaintenanceRequest.team_id, None),
+    'team_name': (Team.name, Team),
+    'assigned_technician_id': (MaintenanceRequest.assigned_technician_id, None),
+    'technician_name': (Technician.name, Technician),
+    'scheduled_date': (MaintenanceRequest.scheduled_date, None),
+    'due_date': (MaintenanceRequest.due_date, None),
+    'duration': (MaintenanceRequest.duration, None),
+    'under_warranty': (MaintenanceRequest.under_warranty, None),
+    'created_by_id': (MaintenanceRequest.created_by_id, None),
+    'created_at': (MaintenanceRequest.created_at, None),
+    'completed_at': (MaintenanceRequest.completed_at, None),
+    'version': (MaintenanceRequest.version, None),
+}
+
+EQUIPMENT_FIELDS = {
+    'id': (Equipment.id, None),
+    'name': (Equipment.name, None),
+    'serial_number': (Equipment.serial_number, None),
+    'department': (Equipment.department, None),
+    'site_id': (Equipment.site_id, None),
+    'assigned_employee': (Equipment.assigned_employee, None),
+    'team_id': (Equipment.team_id, None),
+    'team_name': (Team.name, Team),
+    'default_technician_id': (Equipment.default_technician_id, None),
+    'purchase_date': (Equipment.purchase_date, None),
+    'warranty_expiry': (Equipment.warranty_expiry, None),
+    'location': (Equipment.location, None),
+    'is_scrapped': (Equipment.is_scrapped, None),
+    'parent_id': (Equipment.parent_id, None),
+    'created_at': (Equipment.created_at, None),
+}
+
+TEAM_FIELDS = {
+    'id': (Team.id, None),
+    'name': (Team.name, None),
+    'site_id': (Team.site_id, None),
+    'description': (Team.description, None),
+    'created_at': (Team.created_at, None),
+}
+
+JOIN_CONDITIONS = {
+    (MaintenanceRequest, Equipment): lambda: Equipment.id == MaintenanceRequest.equipment_id,
+    (MaintenanceRequest, Team): lambda: Team.id == MaintenanceRequest.team_id,
+    (MaintenanceRequest, Technician): lambda: Technician.id == MaintenanceRequest.assigned_technician_id,
+    (Equipment, Team): lambda: Team.id == Equipment.team_id,
+}
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f'Cannot serialize {type(value).__name__}')
+
+
+def dumps(payload):
+    """Encode to JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, default=_default, separators=(',', ':')).encode()
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+
+@api_bp.errorhandler(ApiError)
+def handle_api_error(error):
+    return json_response({'error': error.message}, error.status)
+
+
+@api_bp.before_request
+def require_login():
+    # JSON 401 instead of Flask-Login's redirect to the login page
+    if not current_user.is_authenticated:
+        return json_response({'error': 'Authentication required'}, 401)
+
+
+def select_fields(available):
+    """Parse ?fields=a,b,c; the id is always included for the cursor"""
+    requested = request.args.get('fields', '')
+    if not requested:
+        names = list(available)
+    else:
+        names = [name.strip() for name in requested.split(',') if name.strip()]
+        unknown = [name for name in names if name not in available]
+        if unknown:
+            raise ApiError(f"Unknown fields: {', '.join(unknown)}. "
+                           f"Available: {', '.join(available)}")
+        if 'id' not in names:
+            names.insert(0, 'id')
+    return names
+
+
+def build_query(model, available, names):
+    """SELECT the named columns, joining only the tables they need"""
+    query = db.session.query(*[available[name][0] for name in names]).select_from(model)
+
+    joined = set()
+    for name in names:
+        target = available[name][1]
+        if target is not None and target not in joined:
+            query = query.outerjoin(target, JOIN_CONDITIONS[(model, target)]())
+            joined.add(target)
+    return query
+
+
+def request_limit():
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    return min(max(limit, 1), MAX_LIMIT)
+
+
+def run_keyset_query(model, available, apply_filters, extra=None):
+    """Select only the requested columns, one page after ?after=<id>"""
+    names = select_fields(available)
+    limit = request_limit()
+    after = request.args.get('after', type=int)
+
+    query = apply_filters(build_query(model, available, names))
+    if after is not None:
+        query = query.filter(model.id > after)
+
+    rows = query.order_by(model.id).limit(limit).all()
+
+    # Plain tuples straight into dicts; no ORM objects are built
+    data = [dict(zip(names, row)) for row in rows]
+    next_after = data[-1]['id'] if len(data) == limit else None
+
+    return json_response(dict(extra or {}, data=data, next_after=next_after, limit=limit))
+
+
+@api_bp.route('/requests')
+def list_requests():
+    """Maintenance requests (filters mirror requests.list_requests)"""
+    status = request.args.get('status', '')
+    request_type = request.args.get('type', '')
+    team_id = request.args.get('team', '')
+    equipment_id = request.args.get('equipment', '')
+    under = request.args.get('under', type=int)
+    search = request.args.get('search', '')
+
+    def apply_filters(query):
+        if status:
+            query = query.filter(MaintenanceRequest.status == status)
+        if request_type:
+            query = query.filter(MaintenanceRequest.request_type == request_type)
+        if team_id:
+            query = query.filter(MaintenanceRequest.team_id == team_id)
+        if equipment_id:
+            query = query.filter(MaintenanceRequest.equipment_id == equipment_id)
+        if under:
+            query = query.filter(MaintenanceRequest.equipment_id.in_(subtree_ids(under)))
+        if search:
+            query = query.filter(
+                db.or_(
+                    MaintenanceRequest.subject.contains(search),
+                    MaintenanceRequest.description.contains(search)
+                )
+            )
+
+        # Technicians see only their team's requests
+        if current_user.role == 'Technician':
+            user_teams = [team.id for team in current_user.teams]
+            query = query.filter(MaintenanceRequest.team_id.in_(user_teams))
+        return query
+
+    return run_keyset_query(MaintenanceRequest, REQUEST_FIELDS, apply_filters)
+
+
+@api_bp.route('/equipment')
+def list_equipment():
+    """Equipment (filters mirror equipment.list_equipment)"""
+    department = request.args.get('department', '')
+    employee = request.args.get('employee', '')
+    status = request.args.get('status', '')
+    team_id = request.args.get('team', '')
+    under = request.args.get('under', type=int)
+    search = request.args.get('search', '')
+
+    def apply_filters(query):
+        if department:
+            query = query.filter(Equipment.department == department)
+        if employee:
+            query = query.filter(Equipment.assigned_employee.contains(employee))
+        if status == 'scrapped':
+            query = query.filter(Equipment.is_scrapped.is_(True))
+        elif status == 'operational':
+            query = query.filter(Equipment.is_scrapped.is_(False))
+        if team_id:
+            query = query.filter(Equipment.team_id == team_id)
+        if under:
+            query = query.filter(Equipment.id.in_(subtree_ids(under)))
+        if search:
+            query = query.filter(
+                db.or_(
+                    Equipment.name.contains(search),
+                    Equipment.serial_number.contains(search)
+                )
+            )
+        return query
+
+    return run_keyset_query(Equipment, EQUIPMENT_FIELDS, apply_filters)
+
+
+@api_bp.route('/teams')
+def list_teams():
+    """Maintenance teams"""
+    search = request.args.get('search', '')
+
+    def apply_filters(query):
+        if search:
+            query = query.filter(Team.name.contains(search))
+        return query
+
+    return run_keyset_query(Team, TEAM_FIELDS, apply_filters)
+
+
+def sync_team_ids():
+    """Teams a sync client follows: a technician's own, or ?team=1,2 (default all)"""
+    if current_user.role == 'Technician':
+        return [team.id for team in current_user.teams]
+
+    requested = request.args.get('team', '')
+    if requested:
+        try:
+            return [int(team_id) for team_id in requested.split(',') if team_id.strip()]
+        except ValueError:
+            raise ApiError('team must be a comma-separated list of ids')
+    return [team_id for (team_id,) in db.session.query(Team.id)]
+
+
+def fetch_requests(names, ids, *criteria):
+    """Rows for the given request ids (names[0] must be 'id'), in id order"""
+    if not ids:
+        return []
+    rows = build_query(MaintenanceRequest, REQUEST_FIELDS, names).filter(
+        MaintenanceRequest.id.in_(ids), *criteria
+    ).order_by(MaintenanceRequest.id).all()
+    return [dict(zip(names, row)) for row in rows]
+
+
+@api_bp.route('/my-work')
+def my_work():
+    """The caller's open requests, most urgent first, with counters by status"""
+    names = select_fields(REQUEST_FIELDS)
+    today = date.today()
+    rows = work_queue(build_query(MaintenanceRequest, REQUEST_FIELDS, names), current_user.id, today).all()
+    return json_response({
+        'counts': status_counts(current_user.id, today),
+        'data': [dict(zip(names, row)) for row in rows],
+    })
+
+
+@api_bp.route('/sync/bootstrap')
+def sync_bootstrap():
+    """Open requests of the client's teams; keep the cursor from the first page"""
+    team_ids = sync_team_ids()
+
+    # Taken before the rows are read: anything changing meanwhile is replayed
+    extra = {'cursor': latest_cursor(), 'teams': team_ids} if request.args.get('after') is None else None
+
+    def apply_filters(query):
+        return query.filter(
+            MaintenanceRequest.team_id.in_(team_ids),
+            MaintenanceRequest.status.in_(OPEN_STATUSES)
+        )
+
+    return run_keyset_query(MaintenanceRequest, REQUEST_FIELDS, apply_filters, extra)
+
+
+@api_bp.route('/sync/changes')
+def sync_changes():
+    """Requests changed since ?cursor=; closed, moved or deleted ones as tombstones"""
+    cursor = request.args.get('cursor', 0, type=int)
+    team_ids = sync_team_ids()
+    names = select_fields(REQUEST_FIELDS)
+
+    try:
+        request_ids, next_cursor, has_more = changes_since(cursor, team_ids, request_limit())
+    except CursorExpired:
+        raise ApiError('Cursor has expired; download /sync/bootstrap again', 410)
+
+    # Anything that changed but is no longer open in these teams is a tombstone
+    changed = fetch_requests(names, request_ids,
+                             MaintenanceRequest.team_id.in_(team_ids),
+                             MaintenanceRequest.status.in_(OPEN_STATUSES))
+    changed_ids = {row['id'] for row in changed}
+
+    return json_response({
+        'changed': changed,
+        'deleted': [request_id for request_id in request_ids if request_id not in changed_ids],
+        'cursor': next_cursor,
+        'has_more': has_more,
+    })
+
+
+@api_bp.route('/sync/push', methods=['POST'])
+def sync_push():
+    """Apply a batch of offline mutations in one transaction, with per-item results"""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise ApiError('Expected a JSON body {"mutations": [...]}')
+    mutations = body.get('mutations')
+    if not isinstance(mutations, list):
+        raise ApiError('Expected a JSON body {"mutations": [...]}')
+    if len(mutations) > MAX_BATCH:
+        raise ApiError(f'At most {MAX_BATCH} mutations per batch')
+
+    try:
+        results = apply_mutations(mutations, current_user)
+    except BatchRetry:
+        raise ApiError('The batch collided with a concurrent update; nothing was applied, retry', 409)
+
+    # Conflicts carry the server's row so the client can rebase or discard
+    conflicts = [result['id'] for result in results if result['status'] == 'conflict']
+    current = {row['id']: row for row in fetch_requests(list(REQUEST_FIELDS), conflicts)}
+    for result in results:
+        if result['status'] == 'conflict':
+            result['current'] = current.get(result['id'])
+
+    return json_response({'results': results})
@@ -0,0 +1,145 @@
+import os
+
+from flask import Blueprint, redirect, url_for, flash, request, send_file, abort
+from flask_login import login_required, current_user
+from models import db, Attachment, MaintenanceRequest, Equipment
+from attachments import (store, queue_thumbnail, blob_path, thumbnail_path,
+                         UnsupportedFile, FileTooLarge)
+
+attachments_bp = Blueprint('attachments', __name__, url_prefix='/attachments')
+
+# Same-origin only, revalidated after an hour; the ETag makes that a 304
+CACHE_SECONDS = 3600
+
+
+def can_access_request(maintenance_request):
+    """Technicians only see requests of their own teams"""
+    if current_user.role != 'Technician':
+        return True
+    return maintenance_request.team_id in [team.id for team in current_user.teams]
+
+
+def get_owner_or_404(attachment):
+    """The request or equipment an attachment belongs to, within the current site"""
+    if attachment.request_id:
+        owner = db.session.get(MaintenanceRequest, attachment.request_id)
+        if owner is None or not can_access_request(owner):
+            abort(404)
+        return owner
+    owner = db.session.get(Equipment, attachment.equipment_id)
+    if owner is None:
+        abort(404)
+    return owner
+
+
+def owner_url(attachment):
+    if attachment.request_id:
+        return url_for('requests.view', id=attachment.request_id)
+    return url_for('equipment.view', id=attachment.equipment_id)
+
+
+def save_uploads(back_url, **owner):
+    """Store every uploaded photo and attach it to the owner"""
+    uploads = [upload for upload in request.files.getlist('photos') if upload.filename]
+    if not uploads:
+        flash('Choose at least one photo to upload.', 'danger')
+        return redirect(back_url)
+
+    digests = []
+    for upload in uploads:
+        try:
+            digest, size, content_type = store(upload.stream)
+        except (UnsupportedFile, FileTooLarge) as e:
+            db.session.rollback()
+            flash(f'{upload.filename}: {e}', 'danger')
+            return redirect(back_url)
+        db.session.add(Attachment(
+            sha256=digest,
+            filename=os.path.basename(upload.filename)[:255],
+            content_type=content_type,
+            size=size,
+            uploaded_by_id=current_user.id,
+            **owner
+        ))
+        digests.append(digest)
+    db.session.commit()
+
+    for digest in digests:
+        queue_thumbnail(digest)
+
+    flash(f'{len(digests)} photo(s) attached.', 'success')
+    return redirect(back_url)
+
+
+@attachments_bp.route('/request/<int:id>', methods=['POST'])
+@login_required
+def upload_for_request(id):
+    """Attach photos to a maintenance request"""
+    maintenance_request = MaintenanceRequest.query.get_or_404(id)
+    if not can_access_request(maintenance_request):
+        flash('Access denied.', 'danger')
+        return redirect(url_for('requests.list_requests'))
+    return save_uploads(url_for('requests.view', id=id), request_id=id)
+
+
+@attachments_bp.route('/equipment/<int:id>', methods=['POST'])
+@login_required
+def upload_for_equipment(id):
+    """Attach photos to equipment"""
+    Equipment.query.get_or_404(id)
+    return save_uploads(url_for('equipment.view', id=id), equipment_id=id)
+
+
+def send_blob(path, etag, mimetype, download_name):
+    # Blobs never change, so the digest is a strong validator; send_file
+    # answers If-None-Match / If-Range and Range requests from it
+    response = send_file(path, mimetype=mimetype, download_name=download_name,
+                         conditional=True, etag=etag, max_age=CACHE_SECONDS)
+    response.cache_control.public = None
+    response.cache_control.private = True
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
+@attachments_bp.route('/<int:id>')
+@login_required
+def download(id):
+    """The original photo (supports Range and If-None-Match)"""
+    attachment = Attachment.query.get_or_404(id)
+    get_owner_or_404(attachment)
+    path = blob_path(attachment.sha256)
+    if not os.path.exists(path):
+        abort(404)
+    return send_blob(path, attachment.sha256, attachment.content_type, attachment.filename)
+
+
+@attachments_bp.route('/<int:id>/thumbnail')
+@login_required
+def thumbnail(id):
+    """Thumbnail, or the original while it is still being rendered"""
+    attachment = Attachment.query.get_or_404(id)
+    get_owner_or_404(attachment)
+    path = thumbnail_path(attachment.sha256)
+    if not os.path.exists(path):
+        return download(id)
+    return send_blob(path, f'{attachment.sha256}-thumb', 'image/jpeg', None)
+
+
+@attachments_bp.route('/<int:id>/delete', methods=['POST'])
+@login_required
+def delete(id):
+    """Remove an attachment (the uploader or a manager)"""
+    attachment = Attachment.query.get_or_404(id)
+    get_owner_or_404(attachment)
+    back_url = owner_url(attachment)
+
+    if not (current_user.is_manager() or attachment.uploaded_by_id == current_user.id):
+        flash('Access denied.', 'danger')
+        return redirect(back_url)
+
+    # The file stays until prune-attachments finds it unreferenced
+    db.session.delete(attachment)
+    db.session.commit()
+
+    flash('Photo removed.', 'success')
+    return redirect(back_url)
@@ -1,6 +1,9 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_user, logout_user, login_required, current_user
+from werkzeug.exceptions import ServiceUnavailable
 from models import db, User
+from services.notifications import notify_password_reset
+from passwords import verify_password
 from datetime import datetime, timedelta
 
 auth_bp = Blueprint('auth', __name__, url_prefix='/auth')
@@ -62,7 +65,18 @@ def login():
         
         user = User.query.filter_by(email=email).first()
         
-        if user and user.check_password(password):
+        # Unknown emails cost a hash too, so timing does not reveal accounts
+        valid = user.check_password(password) if user else verify_password(None, password)
+        
+        if valid:
+            # Made with older parameters: upgrade it while the password is at hand
+            if user.password_needs_rehash():
+                try:
+                    user.set_password(password)
+                    db.session.commit()
+                except ServiceUnavailable:
+                    pass  # hashing pool is busy: upgrade on a later login
+            
             login_user(user, remember=remember)
             flash(f'Welcome back, {user.name}!', 'success')
             
@@ -97,16 +111,14 @@ def forgot_password():
         if user:
             token = user.generate_reset_token()
             user.reset_token_expiry = datetime.utcnow() + timedelta(hours=1)
-            db.session.commit()
             
-            # In production, send email with reset link
-            # For demo, we'll show the token
+            # The email is queued with the token and sent by the outbox worker
             reset_link = url_for('auth.reset_password', token=token, _external=True)
-            flash(f'Password reset link: {reset_link}', 'info')
-            flash('(In production, this would be sent via email)', 'warning')
-        else:
-            # Don't reveal if email exists or not (security best practice)
-            flash('If the email exists, a reset link has been sent.', 'info')
+            notify_password_reset(user, token, reset_link)
+            db.session.commit()
+        
+        # Don't reveal if email exists or not (security best practice)
+        flash('If the email exists, a reset link has been sent.', 'info')
         
         return redirect(url_for('auth.login'))
     
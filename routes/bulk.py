@@ -0,0 +1,115 @@
+from flask import Blueprint, render_template, redirect, url_for, flash, request
+from flask_login import login_required, current_user
+from models import db, Team, User
+from services.bulk import equipment_selection, move_equipment, scrap_equipment, reassign_open_work
+from services.reference import team_choices, technician_choices, department_choices
+
+bulk_bp = Blueprint('bulk', __name__, url_prefix='/bulk')
+
+FILTER_FIELDS = ('department', 'team_id', 'employee', 'search')
+
+
+def managers_only():
+    if not current_user.is_manager():
+        flash('Access denied. Managers and Admins only.', 'danger')
+        return redirect(url_for('dashboard.index'))
+    return None
+
+
+def render_page(values, preview=None, status=200):
+    return render_template('bulk/index.html',
+                          values=values,
+                          preview=preview,
+                          teams=team_choices(),
+                          technicians=technician_choices(),
+                          departments=department_choices()), status
+
+
+@bulk_bp.route('/')
+@login_required
+def index():
+    """Bulk changes; filters can be prefilled from the equipment list"""
+    denied = managers_only()
+    if denied:
+        return denied
+    return render_page(request.args)
+
+
+@bulk_bp.route('/equipment', methods=['POST'])
+@login_required
+def equipment():
+    """Move or scrap all equipment matching the filters (preview first)"""
+    denied = managers_only()
+    if denied:
+        return denied
+
+    action = request.form.get('action')
+    apply = 'apply' in request.form
+    filters = {field: request.form.get(field, '').strip() for field in FILTER_FIELDS}
+    if not any(filters.values()):
+        flash('Choose at least one filter; bulk changes never apply to all equipment.', 'danger')
+        return render_page(request.form, status=400)
+
+    selection = equipment_selection(
+        department=filters['department'],
+        team_id=request.form.get('team_id', type=int),
+        employee=filters['employee'],
+        search=filters['search']
+    )
+
+    if action == 'move':
+        target = db.session.get(Team, request.form.get('target_team_id', type=int) or 0)
+        if target is None:
+            flash('Choose the team to move the equipment to.', 'danger')
+            return render_page(request.form, status=400)
+        counts = move_equipment(selection, target.id, cascade='cascade' in request.form,
+                                actor=current_user, dry_run=not apply)
+        message = (f"{counts['equipment']} equipment item(s) and {counts['requests']} open request(s) "
+                   f"{'moved' if apply else 'will move'} to {target.name}.")
+    elif action == 'scrap':
+        counts = scrap_equipment(selection, dry_run=not apply)
+        message = (f"{counts['equipment']} equipment item(s) {'scrapped' if apply else 'will be scrapped'}; "
+                   f"{counts['open_requests']} open request(s) on them stay open.")
+    else:
+        flash('Unknown bulk action.', 'danger')
+        return render_page(request.form, status=400)
+
+    if not apply:
+        return render_page(request.form, preview={'form': 'equipment', 'message': message})
+    flash(message, 'success')
+    return redirect(url_for('bulk.index'))
+
+
+@bulk_bp.route('/reassign', methods=['POST'])
+@login_required
+def reassign():
+    """Hand one technician's open requests to another (preview first)"""
+    denied = managers_only()
+    if denied:
+        return denied
+
+    apply = 'apply' in request.form
+    source = db.session.get(User, request.form.get('from_technician_id', type=int) or 0)
+    target_id = request.form.get('to_technician_id', type=int)
+    target = db.session.get(User, target_id) if target_id else None
+    if source is None or (target_id and target is None) or source == target:
+        flash('Choose two different technicians (or leave the new one empty to unassign).', 'danger')
+        return render_page(request.form, status=400)
+    if target is not None and target.role != 'Technician':
+        flash(f'{target.name} is not a technician.', 'danger')
+        return render_page(request.form, status=400)
+
+    counts = reassign_open_work(source.id, target.id if target else None,
+                                team_id=request.form.get('reassign_team_id', type=int),
+                                actor=current_user, dry_run=not apply)
+    to_whom = f'to {target.name}' if target else 'to nobody (unassigned)'
+    message = (f"{counts['requests']} open request(s) of {source.name} "
+               f"{'reassigned' if apply else 'will be reassigned'} {to_whom}.")
+    if counts['not_in_team']:
+        message += (f" {counts['not_in_team']} request(s) of teams {target.name} is not a member of "
+                    f"{'were' if apply else 'will be'} left with {source.name}.")
+
+    if not apply:
+        return render_page(request.form, preview={'form': 'reassign', 'message': message})
+    flash(message, 'success')
+    return redirect(url_for('bulk.index'))
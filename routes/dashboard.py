@@ -1,14 +1,40 @@
-from flask import Blueprint, render_template, jsonify, request, flash, redirect, url_for
+from flask import Blueprint, render_template, jsonify, request, flash, redirect, url_for, Response
 from flask_login import login_required, current_user
 from models import db, Equipment, MaintenanceRequest, Team, User
+from db_routing import read_only
+from services.analytics import get_reliability, merge_reliability, DIMENSIONS
+from services.trends import get_trends, merge_trends, parse_month, add_months
+from services.workqueue import work_queue, status_counts
+from sites import for_each_site
 from datetime import datetime, timedelta
 from sqlalchemy import func, extract
+from sqlalchemy.orm import joinedload
+import csv
+import io
 
 dashboard_bp = Blueprint('dashboard', __name__, url_prefix='/dashboard')
 
 
+def all_sites_requested():
+    """?sites=all: users who are not bound to a site can report across every site"""
+    return not current_user.site_id and request.args.get('sites') == 'all'
+
+
+def site_trends(start, end, year_over_year=False):
+    if all_sites_requested():
+        return merge_trends(for_each_site(lambda: get_trends(start, end, year_over_year)))
+    return get_trends(start, end, year_over_year)
+
+
+def site_reliability(dimension, start, end):
+    if all_sites_requested():
+        return merge_reliability(for_each_site(lambda: get_reliability(dimension, start, end)))
+    return get_reliability(dimension, start, end)
+
+
 @dashboard_bp.route('/')
 @login_required
+@read_only
 def index():
     """Main dashboard"""
     # Get statistics
@@ -62,6 +88,7 @@ def index():
 
 @dashboard_bp.route('/kanban')
 @login_required
+@read_only
 def kanban():
     """Kanban board view"""
     new_requests = MaintenanceRequest.query.filter_by(status='New').order_by(
@@ -87,8 +114,23 @@ def kanban():
                            scrap_requests=scrap_requests)
 
 
+@dashboard_bp.route('/my-work')
+@login_required
+@read_only
+def my_work():
+    """The current user's open requests, most urgent first"""
+    today = datetime.now().date()
+    queue = work_queue(MaintenanceRequest.query.options(joinedload(MaintenanceRequest.equipment)),
+                       current_user.id, today).all()
+    return render_template('dashboard/my_work.html',
+                           queue=queue,
+                           counts=status_counts(current_user.id, today),
+                           today=today)
+
+
 @dashboard_bp.route('/calendar')
 @login_required
+@read_only
 def calendar():
     """Calendar view for preventive maintenance"""
     preventive_requests = MaintenanceRequest.query.filter_by(
@@ -113,6 +155,7 @@ def calendar():
 
 @dashboard_bp.route('/reports')
 @login_required
+@read_only
 def reports():
     """Reports page"""
     # Fix: Added current_user role check logic
@@ -132,36 +175,98 @@ def reports():
     else:
         end_date = datetime(year, month + 1, 1)
 
-    # Get team reports
-    teams = Team.query.all()
-    team_reports = []
-    for team in teams:
-        # Uses the method we fixed in models.py earlier
-        stats = team.get_monthly_stats(year, month)
-        team_reports.append(stats)
-
-    # Overall Statistics for the period
-    total_requests = MaintenanceRequest.query.filter(
-        MaintenanceRequest.created_at >= start_date,
-        MaintenanceRequest.created_at < end_date
-    ).count()
+    # Team reports and period totals come from one grouped query
+    trends = site_trends((year, month), (year, month))
+    team_reports = [{
+        'team_name': f"{team['site']} · {team['name']}" if 'site' in team else team['name'],
+        'total_requests': team['series']['total'][0],
+        'completed': team['series']['completed'][0],
+        'total_hours': team['series']['hours'][0],
+    } for team in trends['teams']]
 
-    completed_requests = MaintenanceRequest.query.filter(
-        MaintenanceRequest.created_at >= start_date,
-        MaintenanceRequest.created_at < end_date,
-        MaintenanceRequest.status == 'Repaired'
-    ).count()
+    total_requests = trends['totals']['total'][0]
+    completed_requests = trends['totals']['completed'][0]
+    total_duration = trends['totals']['hours'][0]
 
-    total_duration = db.session.query(func.sum(MaintenanceRequest.duration)).filter(
-        MaintenanceRequest.created_at >= start_date,
-        MaintenanceRequest.created_at < end_date,
-        MaintenanceRequest.status == 'Repaired'
-    ).scalar() or 0
+    # Last 12 months up to the selected one, for the trend table
+    trend_report = site_trends(add_months(year, month, -11), (year, month))
+
+    # Reliability metrics for the same period
+    reliability = {
+        'team': site_reliability('team', start_date, end_date),
+        'department': site_reliability('department', start_date, end_date),
+        'equipment': site_reliability('equipment', start_date, end_date)[:10],
+    }
 
     return render_template('dashboard/reports.html',
                            team_reports=team_reports,
                            total_requests=total_requests,
                            completed_requests=completed_requests,
                            total_duration=total_duration,
+                           reliability=reliability,
+                           trend_report=trend_report,
+                           all_sites=all_sites_requested(),
                            year=year,
                            month=month)
+
+
+@dashboard_bp.route('/reports/trends')
+@login_required
+@read_only
+def trends():
+    """Chart-ready monthly trends by team and request type (JSON)"""
+    if not current_user.is_manager():
+        return jsonify({'success': False, 'message': 'Access denied'}), 403
+
+    # start/end are inclusive YYYY-MM months; defaults to the last 12 months
+    now = datetime.now()
+    try:
+        end = parse_month(request.args['end']) if request.args.get('end') else (now.year, now.month)
+        start = parse_month(request.args['start']) if request.args.get('start') else add_months(*end, -11)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Months must be YYYY-MM'}), 400
+
+    if start > end:
+        return jsonify({'success': False, 'message': 'start must not be after end'}), 400
+    if (end[0] - start[0]) * 12 + end[1] - start[1] >= 120:
+        return jsonify({'success': False, 'message': 'Range is limited to 120 months'}), 400
+
+    year_over_year = request.args.get('yoy') in ('1', 'true')
+    return jsonify(site_trends(start, end, year_over_year=year_over_year))
+
+
+@dashboard_bp.route('/reports/reliability.csv')
+@login_required
+@read_only
+def reliability_csv():
+    """Reliability metrics export for spreadsheets"""
+    if not current_user.is_manager():
+        flash('Access denied. Managers only.', 'danger')
+        return redirect(url_for('dashboard.index'))
+
+    dimension = request.args.get('by', 'team')
+    if dimension not in DIMENSIONS:
+        dimension = 'team'
+
+    # Defaults to the current month; start/end are YYYY-MM-DD, end exclusive
+    now = datetime.now()
+    try:
+        start_date = datetime.strptime(request.args['start'], '%Y-%m-%d') if request.args.get('start') \
+            else datetime(now.year, now.month, 1)
+        end_date = datetime.strptime(request.args['end'], '%Y-%m-%d') if request.args.get('end') \
+            else datetime(now.year, now.month, now.day) + timedelta(days=1)
+    except ValueError:
+        return Response('Dates must be YYYY-MM-DD', status=400, mimetype='text/plain')
+
+    rows = site_reliability(dimension, start_date, end_date)
+    columns = ['label', 'failures', 'repairs', 'mttr_hours', 'avg_repair_hours', 'mtbf_days',
+               'first_time_fix_rate', 'backlog', 'backlog_age_days', 'oldest_backlog_days']
+
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+
+    filename = f'reliability-{dimension}-{start_date:%Y%m%d}-{end_date:%Y%m%d}.csv'
+    return Response(output.getvalue(), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
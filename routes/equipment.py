@@ -1,10 +1,47 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request
+from flask import Blueprint, current_app, render_template, redirect, url_for, flash, request
 from flask_login import login_required, current_user
-from models import db, Equipment, Team, User, MaintenanceRequest
+from models import db, Equipment, EquipmentRisk, Team, User, MaintenanceRequest, Attachment
+from services.concurrency import VersionConflict, check_version, commit_or_conflict
+from services.reference import team_choices, technician_choices, department_choices
+from services.hierarchy import get_breadcrumbs, get_subtree_rollup, get_child_rollups, is_in_subtree
+from services.warranty import warranty_filter
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import joinedload
 from datetime import datetime
 
 equipment_bp = Blueprint('equipment', __name__, url_prefix='/equipment')
 
+
+@equipment_bp.errorhandler(VersionConflict)
+def handle_version_conflict(conflict):
+    """Someone else changed the equipment first: 409 with its current state"""
+    equipment = conflict.obj
+    try:
+        db.session.refresh(equipment)
+    except InvalidRequestError:
+        flash('This equipment was deleted by someone else.', 'warning')
+        return redirect(url_for('equipment.list_equipment'))
+    
+    flash('This equipment was changed by someone else in the meantime. '
+          'Review the current values below and try again.', 'warning')
+    return render_template('equipment/edit.html',
+                          equipment=equipment,
+                          teams=team_choices(),
+                          technicians=technician_choices()), 409
+
+
+def resolve_parent(parent_serial, equipment=None):
+    """Parent asset from its serial number -> (parent or None, error message or None)"""
+    if not parent_serial:
+        return None, None
+    parent = Equipment.query.filter_by(serial_number=parent_serial).first()
+    if parent is None:
+        return None, f'No equipment with serial number {parent_serial}.'
+    if equipment is not None and equipment.id is not None and is_in_subtree(parent.id, equipment.id):
+        return None, 'Equipment cannot be placed under itself or one of its sub-assets.'
+    return parent, None
+
+
 @equipment_bp.route('/')
 @login_required
 def list_equipment():
@@ -14,9 +51,12 @@ def list_equipment():
     employee = request.args.get('employee', '')
     status = request.args.get('status', '')
     search = request.args.get('search', '')
+    sort = request.args.get('sort', '')
+    warranty = request.args.get('warranty', '')
+    warranty_days = request.args.get('days', current_app.config['WARRANTY_HORIZON_DAYS'], type=int)
     
-    # Base query
-    query = Equipment.query
+    # Base query (risk scores are precomputed by the nightly scoring job)
+    query = Equipment.query.outerjoin(EquipmentRisk).options(db.contains_eager(Equipment.risk))
     
     # Apply filters
     if department:
@@ -34,17 +74,23 @@ def list_equipment():
                 Equipment.serial_number.contains(search)
             )
         )
+    if warranty:
+        query = warranty_filter(query, warranty, warranty_days)
     
-    equipment_list = query.order_by(Equipment.created_at.desc()).all()
+    if sort == 'risk':
+        query = query.order_by(EquipmentRisk.score.desc().nulls_last(), Equipment.created_at.desc())
+    elif warranty == 'expiring':
+        query = query.order_by(Equipment.warranty_expiry)
+    else:
+        query = query.order_by(Equipment.created_at.desc())
     
-    # Get unique departments for filter
-    departments = db.session.query(Equipment.department).distinct().all()
-    departments = [d[0] for d in departments]
+    equipment_list = query.all()
     
     return render_template('equipment/list.html',
                           equipment_list=equipment_list,
-                          departments=departments,
-                          filters={'department': department, 'employee': employee, 'status': status, 'search': search})
+                          departments=department_choices(),
+                          filters={'department': department, 'employee': employee, 'status': status, 'search': search, 'sort': sort,
+                                   'warranty': warranty, 'days': warranty_days})
 
 
 @equipment_bp.route('/create', methods=['GET', 'POST'])
@@ -70,23 +116,35 @@ def create():
         if not all([name, serial_number, department, team_id]):
             flash('Please fill all required fields.', 'danger')
             return render_template('equipment/create.html',
-                                  teams=Team.query.all(),
-                                  technicians=User.query.filter_by(role='Technician').all())
+                                  teams=team_choices(),
+                                  technicians=technician_choices())
         
         # Check if serial number exists
         if Equipment.query.filter_by(serial_number=serial_number).first():
             flash('Serial number already exists.', 'danger')
             return render_template('equipment/create.html',
-                                  teams=Team.query.all(),
-                                  technicians=User.query.filter_by(role='Technician').all())
+                                  teams=team_choices(),
+                                  technicians=technician_choices())
+        
+        parent, error = resolve_parent(request.form.get('parent_serial', '').strip())
+        if error:
+            flash(error, 'danger')
+            return render_template('equipment/create.html',
+                                  teams=team_choices(),
+                                  technicians=technician_choices())
         
+        # Equipment belongs to its maintenance team's site
+        team = Team.query.get_or_404(team_id)
+
         # Create equipment
         equipment = Equipment(
             name=name,
             serial_number=serial_number,
             department=department,
             assigned_employee=assigned_employee,
-            team_id=team_id,
+            team_id=team.id,
+            site_id=team.site_id,
+            parent_id=parent.id if parent else None,
             default_technician_id=default_technician_id if default_technician_id else None,
             purchase_date=datetime.strptime(purchase_date, '%Y-%m-%d').date() if purchase_date else None,
             warranty_expiry=datetime.strptime(warranty_expiry, '%Y-%m-%d').date() if warranty_expiry else None,
@@ -100,17 +158,17 @@ def create():
         return redirect(url_for('equipment.view', id=equipment.id))
     
     # GET request
-    teams = Team.query.all()
-    technicians = User.query.filter_by(role='Technician').all()
-    
-    return render_template('equipment/create.html', teams=teams, technicians=technicians)
+    return render_template('equipment/create.html', teams=team_choices(), technicians=technician_choices())
 
 
 @equipment_bp.route('/<int:id>')
 @login_required
 def view(id):
     """View equipment details"""
-    equipment = Equipment.query.get_or_404(id)
+    # Photo metadata comes back in the same query as the equipment row
+    equipment = Equipment.query.options(
+        joinedload(Equipment.attachments).joinedload(Attachment.uploaded_by)
+    ).get_or_404(id)
     
     # Get maintenance requests for this equipment
     maintenance_requests = equipment.maintenance_requests.order_by(
@@ -119,7 +177,10 @@ def view(id):
     
     return render_template('equipment/view.html',
                           equipment=equipment,
-                          maintenance_requests=maintenance_requests)
+                          maintenance_requests=maintenance_requests,
+                          breadcrumbs=get_breadcrumbs(equipment.id),
+                          subtree=get_subtree_rollup(equipment.id),
+                          children=get_child_rollups(equipment.id))
 
 
 @equipment_bp.route('/<int:id>/edit', methods=['GET', 'POST'])
@@ -150,10 +211,22 @@ def edit(id):
             flash('Serial number already exists.', 'danger')
             return render_template('equipment/edit.html',
                                   equipment=equipment,
-                                  teams=Team.query.all(),
-                                  technicians=User.query.filter_by(role='Technician').all())
+                                  teams=team_choices(),
+                                  technicians=technician_choices())
+        
+        parent, error = resolve_parent(request.form.get('parent_serial', '').strip(), equipment)
+        if error:
+            flash(error, 'danger')
+            return render_template('equipment/edit.html',
+                                  equipment=equipment,
+                                  teams=team_choices(),
+                                  technicians=technician_choices())
         
-        # Update equipment
+        # Reject edits made on top of an outdated copy
+        check_version(equipment, request.form.get('version', type=int))
+        
+        # Update equipment (moving it moves its whole subtree)
+        equipment.parent_id = parent.id if parent else None
         equipment.name = name
         equipment.serial_number = serial_number
         equipment.department = department
@@ -165,19 +238,16 @@ def edit(id):
         equipment.location = location
         equipment.is_scrapped = is_scrapped
         
-        db.session.commit()
+        commit_or_conflict(equipment)
         
         flash('Equipment updated successfully!', 'success')
         return redirect(url_for('equipment.view', id=equipment.id))
     
     # GET request
-    teams = Team.query.all()
-    technicians = User.query.filter_by(role='Technician').all()
-    
     return render_template('equipment/edit.html',
                           equipment=equipment,
-                          teams=teams,
-                          technicians=technicians)
+                          teams=team_choices(),
+                          technicians=technician_choices())
 
 
 @equipment_bp.route('/<int:id>/delete', methods=['POST'])
@@ -199,8 +269,13 @@ def delete(id):
         flash('Cannot delete equipment with active maintenance requests.', 'danger')
         return redirect(url_for('equipment.view', id=id))
     
+    if equipment.children.count():
+        flash('Move or delete its sub-assets first.', 'danger')
+        return redirect(url_for('equipment.view', id=id))
+    
+    check_version(equipment, request.form.get('version', type=int))
     db.session.delete(equipment)
-    db.session.commit()
+    commit_or_conflict(equipment)
     
     flash('Equipment deleted successfully!', 'success')
     return redirect(url_for('equipment.list_equipment'))
@@ -0,0 +1,140 @@
+from flask import Blueprint, render_template, redirect, url_for, flash, request
+from flask_login import login_required, current_user
+from models import db, Part, StockLocation, StockBalance, StockLedgerEntry
+from services.inventory import receive
+from sites import current_site_id
+
+parts_bp = Blueprint('parts', __name__, url_prefix='/parts')
+
+LEDGER_PAGE_SIZE = 50
+
+
+@parts_bp.route('/')
+@login_required
+def list_parts():
+    """Parts catalogue with stock totals at the current site"""
+    search = request.args.get('search', '').strip()
+
+    totals = db.session.query(
+        StockBalance.part_id,
+        db.func.sum(StockBalance.on_hand).label('on_hand'),
+        db.func.sum(StockBalance.reserved).label('reserved')
+    ).join(StockLocation).group_by(StockBalance.part_id)
+    site_id = current_site_id()
+    if site_id is not None:
+        totals = totals.filter(StockLocation.site_id == site_id)
+    totals = totals.subquery()
+
+    # Outer join keeps parts that have never been stocked here
+    query = db.session.query(
+        Part,
+        db.func.coalesce(totals.c.on_hand, 0),
+        db.func.coalesce(totals.c.reserved, 0)
+    ).outerjoin(totals, totals.c.part_id == Part.id)
+
+    if search:
+        query = query.filter(db.or_(Part.sku.ilike(f'%{search}%'), Part.name.ilike(f'%{search}%')))
+
+    parts = [{'part': part, 'on_hand': on_hand, 'reserved': reserved}
+             for part, on_hand, reserved in query.order_by(Part.sku).all()]
+    locations = StockLocation.query.order_by(StockLocation.name).all()
+    return render_template('parts/list.html', parts=parts, locations=locations, search=search)
+
+
+@parts_bp.route('/create', methods=['POST'])
+@login_required
+def create():
+    """Add a part to the catalogue"""
+    if not current_user.is_manager():
+        flash('Access denied. Managers and Admins only.', 'danger')
+        return redirect(url_for('parts.list_parts'))
+
+    sku = request.form.get('sku', '').strip().upper()
+    name = request.form.get('name', '').strip()
+    unit = request.form.get('unit', '').strip() or 'pcs'
+
+    if not sku or not name:
+        flash('SKU and name are required.', 'danger')
+        return redirect(url_for('parts.list_parts'))
+
+    if Part.query.filter_by(sku=sku).first():
+        flash('A part with that SKU already exists.', 'danger')
+        return redirect(url_for('parts.list_parts'))
+
+    part = Part(sku=sku, name=name, unit=unit)
+    db.session.add(part)
+    db.session.commit()
+
+    flash('Part created successfully!', 'success')
+    return redirect(url_for('parts.view', id=part.id))
+
+
+@parts_bp.route('/locations/create', methods=['POST'])
+@login_required
+def create_location():
+    """Add a stock location to the current site"""
+    if not current_user.is_manager():
+        flash('Access denied. Managers and Admins only.', 'danger')
+        return redirect(url_for('parts.list_parts'))
+
+    name = request.form.get('name', '').strip()
+    if not name:
+        flash('Location name is required.', 'danger')
+        return redirect(url_for('parts.list_parts'))
+
+    if StockLocation.query.filter_by(name=name).first():
+        flash('A stock location with that name already exists.', 'danger')
+        return redirect(url_for('parts.list_parts'))
+
+    db.session.add(StockLocation(name=name))
+    db.session.commit()
+
+    flash('Stock location created successfully!', 'success')
+    return redirect(url_for('parts.list_parts'))
+
+
+@parts_bp.route('/<int:id>')
+@login_required
+def view(id):
+    """Stock per location and recent movements for one part"""
+    part = Part.query.get_or_404(id)
+
+    balances = StockBalance.query.join(StockLocation).filter(
+        StockBalance.part_id == id
+    ).order_by(StockLocation.name).all()
+
+    entries = StockLedgerEntry.query.join(StockLocation).filter(
+        StockLedgerEntry.part_id == id
+    ).order_by(StockLedgerEntry.id.desc()).limit(LEDGER_PAGE_SIZE).all()
+
+    locations = StockLocation.query.order_by(StockLocation.name).all()
+    return render_template('parts/view.html', part=part, balances=balances, entries=entries,
+                           locations=locations)
+
+
+@parts_bp.route('/<int:id>/receive', methods=['POST'])
+@login_required
+def receive_stock(id):
+    """Book delivered stock into a location"""
+    if not current_user.is_manager():
+        flash('Access denied. Managers and Admins only.', 'danger')
+        return redirect(url_for('parts.view', id=id))
+
+    part = Part.query.get_or_404(id)
+    location = db.session.get(StockLocation, request.form.get('location_id', type=int) or 0)
+    quantity = request.form.get('quantity', type=int)
+
+    if location is None:
+        flash('Choose a stock location.', 'danger')
+        return redirect(url_for('parts.view', id=id))
+
+    try:
+        receive(part, location, quantity, actor=current_user, note=request.form.get('note', '').strip() or None)
+    except ValueError as e:
+        db.session.rollback()
+        flash(str(e), 'danger')
+        return redirect(url_for('parts.view', id=id))
+    db.session.commit()
+
+    flash(f'Received {quantity} {part.unit} of {part.sku} into {location.name}.', 'success')
+    return redirect(url_for('parts.view', id=id))
@@ -1,10 +1,74 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify
 from flask_login import login_required, current_user
-from models import db, MaintenanceRequest, Equipment, Team, User
+from models import db, MaintenanceRequest, Equipment, Team, User, Part, StockLocation, Attachment
+from services.notifications import notify_assigned, notify_status_changed
+from services.history import record_event, get_history
+from services.concurrency import VersionConflict, check_version, commit_or_conflict
+from services.hierarchy import subtree_ids
+from services.reference import team_choices, equipment_choices
+from services.inventory import InsufficientStock, reserve, consume, release, get_request_parts, CLOSED_STATUSES
+from services.sla import get_sla_state
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import ObjectDeletedError
 from datetime import datetime
 
 requests_bp = Blueprint('requests', __name__, url_prefix='/requests')
 
+
+def get_team_technicians(team_id):
+    """Users who can be assigned to a request of this team"""
+    return User.query.join(User.teams).filter(Team.id == team_id).all()
+
+
+def view_context(maintenance_request):
+    """Template variables for the request detail page"""
+    reservations, consumed = get_request_parts(maintenance_request.id)
+    return {
+        'request': maintenance_request,
+        'technicians': get_team_technicians(maintenance_request.team_id),
+        'reservations': reservations,
+        'consumed': consumed,
+        'parts': Part.query.order_by(Part.sku).all(),
+        'locations': StockLocation.query.order_by(StockLocation.name).all(),
+        'sla': get_sla_state(maintenance_request.id),
+    }
+
+
+def request_state(maintenance_request):
+    """Current state of a request, returned with 409 conflicts"""
+    return {
+        'id': maintenance_request.id,
+        'version': maintenance_request.version,
+        'status': maintenance_request.status,
+        'assigned_technician_id': maintenance_request.assigned_technician_id,
+        'subject': maintenance_request.subject,
+        'due_date': maintenance_request.due_date.isoformat() if maintenance_request.due_date else None,
+        'completed_at': maintenance_request.completed_at.isoformat() if maintenance_request.completed_at else None,
+    }
+
+
+@requests_bp.errorhandler(VersionConflict)
+def handle_version_conflict(conflict):
+    """Someone else changed the request first: 409 with its current state"""
+    maintenance_request = conflict.obj
+    try:
+        state = request_state(maintenance_request)
+    except ObjectDeletedError:
+        if request.is_json:
+            return jsonify({'success': False, 'message': 'Request was deleted'}), 404
+        flash('This request was deleted by someone else.', 'warning')
+        return redirect(url_for('requests.list_requests'))
+    
+    if request.is_json:
+        return jsonify({'success': False,
+                        'message': 'Request was changed by someone else',
+                        'current': state}), 409
+    
+    flash('This request was changed by someone else in the meantime. '
+          'Review the current version below and try again.', 'warning')
+    return render_template('requests/view.html', **view_context(maintenance_request)), 409
+
+
 @requests_bp.route('/')
 @login_required
 def list_requests():
@@ -14,6 +78,8 @@ def list_requests():
     request_type = request.args.get('type', '')
     team_id = request.args.get('team', '')
     search = request.args.get('search', '')
+    under = request.args.get('under', type=int)
+    technician_id = request.args.get('technician', type=int)
     
     # Base query
     query = MaintenanceRequest.query
@@ -33,6 +99,17 @@ def list_requests():
             )
         )
     
+    # Everything on an asset and its sub-assets (line, machine, ...)
+    under_equipment = None
+    if under:
+        under_equipment = Equipment.query.get_or_404(under)
+        query = query.filter(MaintenanceRequest.equipment_id.in_(subtree_ids(under)))
+
+    technician = None
+    if technician_id:
+        technician = User.query.get_or_404(technician_id)
+        query = query.filter_by(assigned_technician_id=technician_id)
+    
     # Role-based filtering
     if current_user.role == 'Technician':
         # Technicians see only their team's requests
@@ -41,12 +118,11 @@ def list_requests():
     
     maintenance_requests = query.order_by(MaintenanceRequest.created_at.desc()).all()
     
-    # Get teams for filter
-    teams = Team.query.all()
-    
     return render_template('requests/list.html',
                           maintenance_requests=maintenance_requests,
-                          teams=teams,
+                          teams=team_choices(),
+                          under_equipment=under_equipment,
+                          technician=technician,
                           filters={'status': status, 'type': request_type, 'team': team_id, 'search': search})
 
 
@@ -66,14 +142,14 @@ def create():
         if not all([subject, description, request_type, equipment_id]):
             flash('Please fill all required fields.', 'danger')
             return render_template('requests/create.html',
-                                  equipment_list=Equipment.query.filter_by(is_scrapped=False).all())
+                                  equipment_list=equipment_choices())
         
         # Get equipment to auto-fill team
         equipment = Equipment.query.get(equipment_id)
         if not equipment:
             flash('Invalid equipment selected.', 'danger')
             return render_template('requests/create.html',
-                                  equipment_list=Equipment.query.filter_by(is_scrapped=False).all())
+                                  equipment_list=equipment_choices())
         
         # Create maintenance request
         maintenance_request = MaintenanceRequest(
@@ -82,6 +158,7 @@ def create():
             request_type=request_type,
             equipment_id=equipment_id,
             team_id=equipment.team_id,  # Auto-filled from equipment
+            site_id=equipment.site_id,
             scheduled_date=datetime.strptime(scheduled_date, '%Y-%m-%d').date() if scheduled_date else None,
             due_date=datetime.strptime(due_date, '%Y-%m-%d').date() if due_date else None,
             created_by_id=current_user.id,
@@ -93,21 +170,27 @@ def create():
             maintenance_request.assigned_technician_id = equipment.default_technician_id
         
         db.session.add(maintenance_request)
+        db.session.flush()
+        record_event(maintenance_request, 'created', current_user,
+                     to_status='New',
+                     technician_id=maintenance_request.assigned_technician_id)
         db.session.commit()
         
         flash('Maintenance request created successfully!', 'success')
         return redirect(url_for('requests.view', id=maintenance_request.id))
     
     # GET request
-    equipment_list = Equipment.query.filter_by(is_scrapped=False).order_by(Equipment.name).all()
-    return render_template('requests/create.html', equipment_list=equipment_list)
+    return render_template('requests/create.html', equipment_list=equipment_choices())
 
 
 @requests_bp.route('/<int:id>')
 @login_required
 def view(id):
     """View maintenance request details"""
-    maintenance_request = MaintenanceRequest.query.get_or_404(id)
+    # Photo metadata comes back in the same query as the request row
+    maintenance_request = MaintenanceRequest.query.options(
+        joinedload(MaintenanceRequest.attachments).joinedload(Attachment.uploaded_by)
+    ).get_or_404(id)
     
     # Check access for technicians
     if current_user.role == 'Technician':
@@ -116,14 +199,25 @@ def view(id):
             flash('Access denied.', 'danger')
             return redirect(url_for('requests.list_requests'))
     
-    # Get available technicians for assignment
-    technicians = User.query.join(User.teams).filter(
-        Team.id == maintenance_request.team_id
-    ).all()
+    return render_template('requests/view.html', **view_context(maintenance_request))
+
+
+@requests_bp.route('/<int:id>/history')
+@login_required
+def history(id):
+    """Paginated status-transition history (JSON)"""
+    maintenance_request = MaintenanceRequest.query.get_or_404(id)
+    
+    # Same access rule as the detail page
+    if current_user.role == 'Technician':
+        user_teams = [team.id for team in current_user.teams]
+        if maintenance_request.team_id not in user_teams:
+            return jsonify({'success': False, 'message': 'Access denied'}), 403
+    
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
     
-    return render_template('requests/view.html',
-                          request=maintenance_request,
-                          technicians=technicians)
+    return jsonify(get_history(id, page=page, per_page=per_page))
 
 
 @requests_bp.route('/<int:id>/edit', methods=['GET', 'POST'])
@@ -152,6 +246,9 @@ def edit(id):
         duration = request.form.get('duration')
         notes = request.form.get('notes')
         
+        # Reject edits made on top of an outdated copy
+        check_version(maintenance_request, request.form.get('version', type=int))
+        
         # Update request
         maintenance_request.subject = subject
         maintenance_request.description = description
@@ -161,7 +258,7 @@ def edit(id):
         maintenance_request.duration = float(duration) if duration else None
         maintenance_request.notes = notes
         
-        db.session.commit()
+        commit_or_conflict(maintenance_request)
         
         flash('Maintenance request updated successfully!', 'success')
         return redirect(url_for('requests.view', id=maintenance_request.id))
@@ -190,13 +287,25 @@ def assign(id):
         flash('Technician is not part of the maintenance team.', 'danger')
         return redirect(url_for('requests.view', id=id))
     
+    check_version(maintenance_request, request.form.get('version', type=int))
+    
+    old_status = maintenance_request.status
+    previous_technician_id = maintenance_request.assigned_technician_id
     maintenance_request.assigned_technician_id = technician_id
     
     # If status is New, change to In Progress
     if maintenance_request.status == 'New':
         maintenance_request.status = 'In Progress'
     
-    db.session.commit()
+    record_event(maintenance_request, 'assigned', current_user,
+                 from_status=old_status, to_status=maintenance_request.status,
+                 technician_id=technician.id,
+                 previous_technician_id=previous_technician_id)
+    
+    # Queued in the same transaction; the outbox worker delivers it
+    notify_assigned(maintenance_request, technician)
+    
+    commit_or_conflict(maintenance_request)
     
     flash('Technician assigned successfully!', 'success')
     return redirect(url_for('requests.view', id=id))
@@ -219,6 +328,8 @@ def update_status(id):
         flash('You do not have permission to update this request.', 'danger')
         return redirect(url_for('requests.view', id=id))
     
+    check_version(maintenance_request, request.form.get('version', type=int))
+    
     # Update status
     old_status = maintenance_request.status
     maintenance_request.status = new_status
@@ -227,22 +338,60 @@ def update_status(id):
     if new_status in ['Repaired', 'Scrap'] and old_status not in ['Repaired', 'Scrap']:
         maintenance_request.completed_at = datetime.utcnow()
     
-    # Special handling for Scrap status
+    # Special handling for Scrap status (recorded in the event payload)
+    payload = {}
     if new_status == 'Scrap':
         equipment = maintenance_request.equipment
         equipment.is_scrapped = True
-        
-        # Add system note
-        if not maintenance_request.notes:
-            maintenance_request.notes = ''
-        maintenance_request.notes += f'\n[SYSTEM] Equipment marked as scrapped on {datetime.now().strftime("%Y-%m-%d %H:%M")}'
+        payload['equipment_scrapped'] = equipment.id
     
-    db.session.commit()
+    if new_status != old_status:
+        record_event(maintenance_request, 'status_changed', current_user,
+                     from_status=old_status, to_status=new_status, **payload)
+        notify_status_changed(maintenance_request, old_status, new_status, actor=current_user)
+    
+    commit_or_conflict(maintenance_request)
     
     flash(f'Request status updated to {new_status}!', 'success')
     return redirect(url_for('requests.view', id=id))
 
 
+@requests_bp.route('/<int:id>/parts', methods=['POST'])
+@login_required
+def parts(id):
+    """Reserve, consume or release spare parts for a request"""
+    maintenance_request = MaintenanceRequest.query.get_or_404(id)
+    action = request.form.get('action')
+    
+    if not (current_user.is_manager() or maintenance_request.assigned_technician_id == current_user.id):
+        flash('You do not have permission to book parts on this request.', 'danger')
+        return redirect(url_for('requests.view', id=id))
+    
+    if maintenance_request.status in CLOSED_STATUSES:
+        flash('Parts cannot be booked on a closed request.', 'warning')
+        return redirect(url_for('requests.view', id=id))
+    
+    part = db.session.get(Part, request.form.get('part_id', type=int) or 0)
+    location = db.session.get(StockLocation, request.form.get('location_id', type=int) or 0)
+    quantity = request.form.get('quantity', type=int)
+    operations = {'reserve': reserve, 'consume': consume, 'release': release}
+    
+    if part is None or location is None or action not in operations:
+        flash('Choose a part, a stock location and an action.', 'danger')
+        return redirect(url_for('requests.view', id=id))
+    
+    try:
+        operations[action](maintenance_request, part, location, quantity, actor=current_user)
+    except (InsufficientStock, ValueError) as e:
+        db.session.rollback()
+        flash(str(e), 'danger')
+        return redirect(url_for('requests.view', id=id))
+    db.session.commit()
+    
+    flash(f'{action.capitalize()}d {quantity or "all reserved"} {part.unit} of {part.sku}.', 'success')
+    return redirect(url_for('requests.view', id=id))
+
+
 @requests_bp.route('/<int:id>/delete', methods=['POST'])
 @login_required
 def delete(id):
@@ -254,8 +403,9 @@ def delete(id):
         flash('Access denied.', 'danger')
         return redirect(url_for('requests.view', id=id))
     
+    check_version(maintenance_request, request.form.get('version', type=int))
     db.session.delete(maintenance_request)
-    db.session.commit()
+    commit_or_conflict(maintenance_request)
     
     flash('Maintenance request deleted successfully!', 'success')
     return redirect(url_for('requests.list_requests'))
@@ -279,6 +429,9 @@ def api_update_status(id):
         if not can_update:
             return jsonify({'success': False, 'message': 'Access denied'}), 403
         
+        # The card's version must match, otherwise the board is out of date
+        check_version(maintenance_request, data.get('version'))
+        
         # Update status
         old_status = maintenance_request.status
         maintenance_request.status = new_status
@@ -287,16 +440,23 @@ def api_update_status(id):
         if new_status in ['Repaired', 'Scrap'] and old_status not in ['Repaired', 'Scrap']:
             maintenance_request.completed_at = datetime.utcnow()
         
-        # Special handling for Scrap status
+        # Special handling for Scrap status (recorded in the event payload)
+        payload = {}
         if new_status == 'Scrap':
             equipment = maintenance_request.equipment
             equipment.is_scrapped = True
-            if not maintenance_request.notes:
-                maintenance_request.notes = ''
-            maintenance_request.notes += f'\n[SYSTEM] Equipment marked as scrapped on {datetime.now().strftime("%Y-%m-%d %H:%M")}'
+            payload['equipment_scrapped'] = equipment.id
         
-        db.session.commit()
+        if new_status != old_status:
+            record_event(maintenance_request, 'status_changed', current_user,
+                         from_status=old_status, to_status=new_status, **payload)
+            notify_status_changed(maintenance_request, old_status, new_status, actor=current_user)
+        
+        commit_or_conflict(maintenance_request)
         
-        return jsonify({'success': True, 'message': 'Status updated'})
+        return jsonify({'success': True, 'message': 'Status updated',
+                        'version': maintenance_request.version})
+    except VersionConflict:
+        raise
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -0,0 +1,34 @@
+from flask import Blueprint, request, jsonify, url_for
+from flask_login import login_required, current_user
+from services.search import search
+from sites import current_site_id
+
+search_bp = Blueprint('search', __name__, url_prefix='/search')
+
+
+def result_url(entry):
+    if entry.kind == 'equipment':
+        return url_for('equipment.view', id=entry.id)
+    if entry.kind == 'request':
+        return url_for('requests.view', id=entry.id)
+    if entry.kind == 'team':
+        return url_for('teams.view', id=entry.id)
+    return url_for('requests.list_requests', technician=entry.id)
+
+
+@search_bp.route('/')
+@login_required
+def query():
+    """Typeahead results for the search box"""
+    # Technicians only see requests of their own teams
+    team_ids = None
+    if current_user.role == 'Technician':
+        team_ids = {team.id for team in current_user.teams}
+
+    results = search(request.args.get('q', ''), site_id=current_site_id(), team_ids=team_ids)
+    return jsonify(results=[{
+        'kind': entry.kind,
+        'label': entry.label,
+        'detail': entry.detail,
+        'url': result_url(entry),
+    } for entry in results])
@@ -0,0 +1,78 @@
+from flask import Blueprint, render_template, redirect, url_for, flash, request, session
+from flask_login import login_required, current_user
+from models import db, Site, Team, Equipment, MaintenanceRequest
+from sites import for_each_site, per_site_storage, site_engine, SITE_SESSION_KEY, ALL_SITES
+
+sites_bp = Blueprint('sites', __name__, url_prefix='/sites')
+
+
+@sites_bp.route('/')
+@login_required
+def list_sites():
+    """Sites with per-site totals (admins only)"""
+    if not current_user.is_admin():
+        flash('Access denied. Admins only.', 'danger')
+        return redirect(url_for('dashboard.index'))
+
+    def counts():
+        return {
+            'teams': Team.query.count(),
+            'equipment': Equipment.query.filter_by(is_scrapped=False).count(),
+            'open_requests': MaintenanceRequest.query.filter(
+                MaintenanceRequest.status.in_(['New', 'In Progress'])
+            ).count(),
+        }
+
+    sites = [dict(site=site, **totals) for site, totals in for_each_site(counts)]
+    return render_template('sites/list.html', sites=sites, per_site=per_site_storage())
+
+
+@sites_bp.route('/create', methods=['POST'])
+@login_required
+def create():
+    """Create a new site"""
+    if not current_user.is_admin():
+        flash('Access denied. Admins only.', 'danger')
+        return redirect(url_for('dashboard.index'))
+
+    name = request.form.get('name', '').strip()
+    code = request.form.get('code', '').strip().lower()
+
+    if not name or not code:
+        flash('Site name and code are required.', 'danger')
+        return redirect(url_for('sites.list_sites'))
+
+    if Site.query.filter(db.or_(Site.name == name, Site.code == code)).first():
+        flash('A site with that name or code already exists.', 'danger')
+        return redirect(url_for('sites.list_sites'))
+
+    site = Site(name=name, code=code)
+    db.session.add(site)
+    db.session.commit()
+
+    # Create the site's database file now rather than on its first request
+    if per_site_storage():
+        site_engine(site.id)
+
+    flash('Site created successfully!', 'success')
+    return redirect(url_for('sites.list_sites'))
+
+
+@sites_bp.route('/switch', methods=['POST'])
+@login_required
+def switch():
+    """Choose the working site (users who are not bound to one)"""
+    if current_user.site_id:
+        flash('Your account is bound to a single site.', 'warning')
+        return redirect(request.referrer or url_for('dashboard.index'))
+
+    choice = request.form.get('site_id', '')
+    if choice == ALL_SITES and not per_site_storage():
+        session[SITE_SESSION_KEY] = ALL_SITES
+    elif choice.isdigit() and db.session.get(Site, int(choice)):
+        session[SITE_SESSION_KEY] = int(choice)
+    else:
+        flash('Unknown site.', 'danger')
+
+    # The old page may show a record from the previous site
+    return redirect(url_for('dashboard.index'))
@@ -0,0 +1,171 @@
+import math
+from datetime import datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from flask import Blueprint, render_template, redirect, url_for, flash, request
+from flask_login import login_required, current_user
+from models import db, BusinessCalendar, CalendarHoliday, SlaPolicy, Team
+
+sla_bp = Blueprint('sla', __name__, url_prefix='/sla')
+
+REQUEST_TYPES = ('Corrective', 'Preventive')
+
+
+def managers_only():
+    if not current_user.is_manager():
+        flash('Access denied. Managers and Admins only.', 'danger')
+        return redirect(url_for('dashboard.index'))
+    return None
+
+
+def parse_hours(value):
+    """'4' or '1.5' hours -> whole minutes, None when blank; ValueError unless positive"""
+    if not value:
+        return None
+    hours = float(value)
+    if not math.isfinite(hours) or hours <= 0:
+        raise ValueError(f'Not a positive number of hours: {value}')
+    # Under half a minute would round to no time at all
+    return max(round(hours * 60), 1)
+
+
+@sla_bp.route('/')
+@login_required
+def index():
+    """SLA policies and business calendars"""
+    denied = managers_only()
+    if denied:
+        return denied
+
+    policies = SlaPolicy.query.order_by(SlaPolicy.name).all()
+    calendars = BusinessCalendar.query.order_by(BusinessCalendar.name).all()
+    teams = Team.query.order_by(Team.name).all()
+    return render_template('sla/index.html', policies=policies, calendars=calendars, teams=teams,
+                           request_types=REQUEST_TYPES)
+
+
+@sla_bp.route('/policies/create', methods=['POST'])
+@login_required
+def create_policy():
+    """Add an SLA policy"""
+    denied = managers_only()
+    if denied:
+        return denied
+
+    name = request.form.get('name', '').strip()
+    calendar = db.session.get(BusinessCalendar, request.form.get('calendar_id', type=int) or 0)
+    request_type = request.form.get('request_type') or None
+    team_id = request.form.get('team_id', type=int)
+
+    try:
+        response_minutes = parse_hours(request.form.get('response_hours'))
+        resolve_minutes = parse_hours(request.form.get('resolve_hours'))
+        escalate_after_minutes = parse_hours(request.form.get('escalate_hours'))
+    except ValueError:
+        flash('Targets must be positive numbers of hours.', 'danger')
+        return redirect(url_for('sla.index'))
+
+    if not name or calendar is None or not response_minutes or not resolve_minutes:
+        flash('Name, calendar, response and resolve targets are required.', 'danger')
+        return redirect(url_for('sla.index'))
+
+    if request_type not in (None,) + REQUEST_TYPES:
+        flash('Unknown request type.', 'danger')
+        return redirect(url_for('sla.index'))
+
+    if response_minutes > resolve_minutes:
+        flash('The response target cannot be longer than the resolve target.', 'danger')
+        return redirect(url_for('sla.index'))
+
+    db.session.add(SlaPolicy(
+        name=name,
+        request_type=request_type,
+        team_id=team_id if team_id and db.session.get(Team, team_id) else None,
+        calendar_id=calendar.id,
+        response_minutes=response_minutes,
+        resolve_minutes=resolve_minutes,
+        escalate_after_minutes=escalate_after_minutes
+    ))
+    db.session.commit()
+
+    flash('SLA policy created. It applies to requests created from now on.', 'success')
+    return redirect(url_for('sla.index'))
+
+
+@sla_bp.route('/policies/<int:id>/toggle', methods=['POST'])
+@login_required
+def toggle_policy(id):
+    """Switch a policy on or off (requests keep the deadlines they already have)"""
+    denied = managers_only()
+    if denied:
+        return denied
+
+    policy = SlaPolicy.query.get_or_404(id)
+    policy.is_active = not policy.is_active
+    db.session.commit()
+
+    flash(f"Policy {'enabled' if policy.is_active else 'disabled'}.", 'success')
+    return redirect(url_for('sla.index'))
+
+
+@sla_bp.route('/calendars/create', methods=['POST'])
+@login_required
+def create_calendar():
+    """Add a business calendar"""
+    denied = managers_only()
+    if denied:
+        return denied
+
+    name = request.form.get('name', '').strip()
+    zone = request.form.get('timezone', '').strip() or 'UTC'
+    workdays = ''.join(sorted(set(request.form.getlist('workdays'))))
+
+    try:
+        ZoneInfo(zone)
+        day_start = datetime.strptime(request.form.get('day_start', ''), '%H:%M').time()
+        day_end = datetime.strptime(request.form.get('day_end', ''), '%H:%M').time()
+    except (ZoneInfoNotFoundError, ValueError):
+        flash('Enter a valid time zone (e.g. Europe/Berlin) and working hours.', 'danger')
+        return redirect(url_for('sla.index'))
+
+    if not name or not workdays or not set(workdays) <= set('1234567') or day_start >= day_end:
+        flash('A calendar needs a name, at least one working day and working hours.', 'danger')
+        return redirect(url_for('sla.index'))
+
+    if BusinessCalendar.query.filter_by(name=name).first():
+        flash('A calendar with that name already exists.', 'danger')
+        return redirect(url_for('sla.index'))
+
+    db.session.add(BusinessCalendar(name=name, timezone=zone, workdays=workdays,
+                                    day_start=day_start, day_end=day_end))
+    db.session.commit()
+
+    flash('Business calendar created.', 'success')
+    return redirect(url_for('sla.index'))
+
+
+@sla_bp.route('/calendars/<int:id>/holidays', methods=['POST'])
+@login_required
+def add_holiday(id):
+    """Add a non-working date to a calendar"""
+    denied = managers_only()
+    if denied:
+        return denied
+
+    calendar = BusinessCalendar.query.get_or_404(id)
+    try:
+        date = datetime.strptime(request.form.get('date', ''), '%Y-%m-%d').date()
+    except ValueError:
+        flash('Enter a valid date.', 'danger')
+        return redirect(url_for('sla.index'))
+
+    if CalendarHoliday.query.filter_by(calendar_id=calendar.id, date=date).first():
+        flash('That date is already a holiday.', 'warning')
+        return redirect(url_for('sla.index'))
+
+    db.session.add(CalendarHoliday(calendar_id=calendar.id, date=date,
+                                   name=request.form.get('name', '').strip() or None))
+    db.session.commit()
+
+    flash('Holiday added.', 'success')
+    return redirect(url_for('sla.index'))
@@ -1,6 +1,7 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_required, current_user
 from models import db, Team, User
+from services.reference import technician_choices
 
 teams_bp = Blueprint('teams', __name__, url_prefix='/teams')
 
@@ -29,13 +30,13 @@ def create():
         if not name:
             flash('Team name is required.', 'danger')
             return render_template('teams/create.html',
-                                  users=User.query.filter_by(role='Technician').all())
+                                  users=technician_choices())
         
         # Check if team name exists
         if Team.query.filter_by(name=name).first():
             flash('Team name already exists.', 'danger')
             return render_template('teams/create.html',
-                                  users=User.query.filter_by(role='Technician').all())
+                                  users=technician_choices())
         
         # Create team
         team = Team(name=name, description=description)
@@ -53,8 +54,7 @@ def create():
         return redirect(url_for('teams.view', id=team.id))
     
     # GET request
-    users = User.query.filter_by(role='Technician').all()
-    return render_template('teams/create.html', users=users)
+    return render_template('teams/create.html', users=technician_choices())
 
 
 @teams_bp.route('/<int:id>')
@@ -95,7 +95,7 @@ def edit(id):
             flash('Team name already exists.', 'danger')
             return render_template('teams/edit.html',
                                   team=team,
-                                  users=User.query.filter_by(role='Technician').all())
+                                  users=technician_choices())
         
         # Update team
         team.name = name
@@ -114,8 +114,7 @@ def edit(id):
         return redirect(url_for('teams.view', id=team.id))
     
     # GET request
-    users = User.query.filter_by(role='Technician').all()
-    return render_template('teams/edit.html', team=team, users=users)
+    return render_template('teams/edit.html', team=team, users=technician_choices())
 
 
 @teams_bp.route('/<int:id>/delete', methods=['POST'])
@@ -0,0 +1,166 @@
+"""Schema versioning.
+
+The database stores the version it was last migrated to in a one-row
+``schema_version`` table. ensure_schema() compares that with SCHEMA_VERSION,
+a single cheap query on a normal start, and only creates tables or runs
+MIGRATIONS when the database is new or behind.
+
+To change the schema: bump SCHEMA_VERSION and, if existing tables change,
+add a function to MIGRATIONS under the new number that upgrades a database
+from the previous version. New tables are created without migration code.
+"""
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from models import DEFAULT_SITE_ID, EquipmentClosure, SLA_STATE_VIEW, SLA_STATE_VIEW_SQL
+
+SCHEMA_VERSION = 10
+
+# Databases created before versioning match version 1
+BASELINE_VERSION = 1
+
+
+def _add_column(connection, table, column, ddl):
+    # Only touches tables stored in this database file: a per-site file
+    # skips the shared tables it sees through the attached primary
+    inspector = inspect(connection)
+    if not inspector.has_table(table):
+        return
+    if column not in {c['name'] for c in inspector.get_columns(table)}:
+        connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+
+def _add_row_versions(connection):
+    for table in ('equipment', 'maintenance_requests'):
+        _add_column(connection, table, 'version', 'INTEGER NOT NULL DEFAULT 1')
+
+
+def _add_sites(connection):
+    # Everything that exists today belongs to the default site (id 1)
+    for table in ('teams', 'equipment', 'maintenance_requests'):
+        _add_column(connection, table, 'site_id', 'INTEGER NOT NULL DEFAULT 1 REFERENCES sites (id)')
+        if inspect(connection).has_table(table):
+            connection.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{table}_site_id ON {table} (site_id)'))
+    _add_column(connection, 'users', 'site_id', 'INTEGER REFERENCES sites (id)')
+
+
+def _add_equipment_hierarchy(connection):
+    if not inspect(connection).has_table('equipment'):
+        return
+    _add_column(connection, 'equipment', 'parent_id', 'INTEGER REFERENCES equipment (id)')
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_equipment_parent_id ON equipment (parent_id)'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_maintenance_requests_equipment_status '
+                            'ON maintenance_requests (equipment_id, status)'))
+    # Existing equipment is flat: every asset is its own root
+    EquipmentClosure.__table__.create(connection, checkfirst=True)
+    connection.execute(text('INSERT INTO equipment_closure (ancestor_id, descendant_id, depth) '
+                            'SELECT id, id, 0 FROM equipment'))
+
+
+def _add_warranty_tracking(connection):
+    _add_column(connection, 'maintenance_requests', 'under_warranty', 'BOOLEAN NOT NULL DEFAULT 0')
+    if inspect(connection).has_table('equipment'):
+        connection.execute(text('CREATE INDEX IF NOT EXISTS ix_equipment_warranty_expiry '
+                                'ON equipment (warranty_expiry)'))
+
+
+def _add_technician_queue_index(connection):
+    if inspect(connection).has_table('maintenance_requests'):
+        connection.execute(text('CREATE INDEX IF NOT EXISTS ix_maintenance_requests_technician_status_due '
+                                'ON maintenance_requests (assigned_technician_id, status, due_date)'))
+
+
+# version -> callable(connection) upgrading from version - 1
+# (4: request_changes table; 6: spare-parts tables; 7: attachments table;
+#  8: SLA tables, views are recreated by _create_views)
+MIGRATIONS = {
+    2: _add_row_versions,
+    3: _add_sites,
+    5: _add_equipment_hierarchy,
+    9: _add_warranty_tracking,
+    10: _add_technician_queue_index,
+}
+
+
+def get_schema_version(db):
+    try:
+        return db.session.execute(text('SELECT version FROM schema_version')).scalar()
+    except (OperationalError, ProgrammingError):
+        db.session.rollback()
+        return None
+
+
+def _set_schema_version(connection, version, schema='main'):
+    table = f'{schema}.schema_version' if connection.dialect.name == 'sqlite' else 'schema_version'
+    connection.execute(text(f'CREATE TABLE IF NOT EXISTS {table} (version INTEGER NOT NULL)'))
+    connection.execute(text(f'DELETE FROM {table}'))
+    connection.execute(text(f'INSERT INTO {table} (version) VALUES (:v)'), {'v': version})
+
+
+def _create_views(connection):
+    # Views are derived, so they are simply rebuilt on every upgrade
+    if not inspect(connection).has_table('request_slas'):
+        return
+    connection.execute(text(f'DROP VIEW IF EXISTS {SLA_STATE_VIEW}'))
+    connection.execute(text(SLA_STATE_VIEW_SQL))
+
+
+def _ensure_default_site(connection):
+    connection.execute(text(
+        "INSERT INTO sites (id, name, code, created_at) "
+        "SELECT :id, 'Main Site', 'main', CURRENT_TIMESTAMP "
+        "WHERE NOT EXISTS (SELECT 1 FROM sites)"
+    ), {'id': DEFAULT_SITE_ID})
+
+
+def ensure_schema(db):
+    """Bring the database up to SCHEMA_VERSION; returns True if anything changed"""
+    current = get_schema_version(db)
+    db.session.remove()
+    if current == SCHEMA_VERSION:
+        return False
+    if current is not None and current > SCHEMA_VERSION:
+        raise RuntimeError(f'Database schema v{current} is newer than this code (v{SCHEMA_VERSION})')
+
+    with db.engine.begin() as connection:
+        if current is None and inspect(connection).has_table('users'):
+            current = BASELINE_VERSION
+
+        if current is not None:
+            for version in range(current + 1, SCHEMA_VERSION + 1):
+                if version in MIGRATIONS:
+                    MIGRATIONS[version](connection)
+
+        # Creates everything for a new database, and tables added since the
+        # last version (which need no migration code) for an existing one
+        db.metadata.create_all(connection)
+        _create_views(connection)
+        _ensure_default_site(connection)
+        _set_schema_version(connection, SCHEMA_VERSION)
+    return True
+
+
+def ensure_site_schema(engine, metadata, tables):
+    """Create or upgrade the site-local tables of a per-site SQLite file.
+
+    The file keeps its own schema_version; the shared tables it reads
+    through the attached primary are upgraded by ensure_schema().
+    """
+    with engine.begin() as connection:
+        current = None
+        if inspect(connection).has_table('schema_version'):
+            current = connection.execute(text('SELECT version FROM main.schema_version')).scalar()
+        if current == SCHEMA_VERSION:
+            return False
+        if current is not None and current > SCHEMA_VERSION:
+            raise RuntimeError(f'Site database schema v{current} is newer than this code (v{SCHEMA_VERSION})')
+
+        if current is not None:
+            for version in range(current + 1, SCHEMA_VERSION + 1):
+                if version in MIGRATIONS:
+                    MIGRATIONS[version](connection)
+
+        metadata.create_all(connection, tables=[metadata.tables[name] for name in tables])
+        _create_views(connection)
+        _set_schema_version(connection, SCHEMA_VERSION)
+    return True
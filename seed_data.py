@@ -1,4 +1,4 @@
-from models import db, User, Team, Equipment, MaintenanceRequest
+from models import db, User, Team, Equipment, MaintenanceRequest, BusinessCalendar, SlaPolicy
 from datetime import datetime, timedelta
 import random
 
@@ -155,6 +155,19 @@ def seed_database():
     db.session.commit()
     print(f"✅ Created {len(maintenance_requests)} maintenance requests")
 
+    # SLA policies (after the sample requests, which keep their own due dates)
+    calendar = BusinessCalendar(name='Standard Hours', timezone='UTC', workdays='12345')
+    db.session.add(calendar)
+    db.session.flush()
+    db.session.add_all([
+        SlaPolicy(name='Breakdowns', request_type='Corrective', calendar_id=calendar.id,
+                  response_minutes=4 * 60, resolve_minutes=16 * 60, escalate_after_minutes=8 * 60),
+        SlaPolicy(name='Planned maintenance', request_type='Preventive', calendar_id=calendar.id,
+                  response_minutes=16 * 60, resolve_minutes=40 * 60),
+    ])
+    db.session.commit()
+    print("✅ Created 2 SLA policies")
+
     print("\n🎉 Database seeded successfully!")
     print("\n📋 Test Accounts:")
     print("   Admin:     admin@gearguard.com / admin123")
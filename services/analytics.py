@@ -0,0 +1,163 @@
+"""Reliability analytics: MTTR, MTBF, first-time-fix rate and backlog age.
+
+All metrics are computed set-based in the database. Window functions pair
+each corrective request with the previous and next failure of the same
+equipment, and a single GROUP BY rolls them up per equipment, department
+or team. Date arithmetic uses SQLite's julianday().
+
+Queries are limited to the current site (sites.current_site_id()); a
+cross-site report runs them once per site and merge_reliability() combines
+the rows.
+"""
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+from models import db
+from sites import current_site_id
+
+# A repair counts as a first-time fix if the same equipment does not fail
+# again within this many days of completion
+FIRST_TIME_FIX_DAYS = 30
+
+# Dimension -> (key expression, label expression)
+DIMENSIONS = {
+    'equipment': ('r.equipment_id', 'e.name'),
+    'department': ('e.department', 'e.department'),
+    'team': ('r.team_id', 't.name'),
+}
+
+RELIABILITY_SQL = """
+WITH base AS (
+    SELECT r.id, r.status, r.request_type, r.duration,
+           r.created_at, r.completed_at,
+           {key} AS dim_key, {label} AS dim_label,
+           julianday(r.created_at) - julianday(LAG(r.created_at) OVER failures) AS days_since_prev_failure,
+           julianday(LEAD(r.created_at) OVER failures) - julianday(r.completed_at) AS days_to_next_failure
+    FROM maintenance_requests r
+    JOIN equipment e ON e.id = r.equipment_id
+    JOIN teams t ON t.id = r.team_id
+    WHERE :site_id IS NULL OR r.site_id = :site_id
+    WINDOW failures AS (PARTITION BY r.equipment_id, r.request_type ORDER BY r.created_at)
+)
+SELECT dim_key, dim_label,
+    SUM(CASE WHEN request_type = 'Corrective'
+             AND created_at >= :start AND created_at < :end THEN 1 ELSE 0 END) AS failures,
+    SUM(CASE WHEN request_type = 'Corrective' AND status = 'Repaired'
+             AND completed_at >= :start AND completed_at < :end THEN 1 ELSE 0 END) AS repairs,
+    AVG(CASE WHEN request_type = 'Corrective' AND status = 'Repaired'
+             AND completed_at >= :start AND completed_at < :end
+             THEN (julianday(completed_at) - julianday(created_at)) * 24 END) AS mttr_hours,
+    AVG(CASE WHEN request_type = 'Corrective' AND status = 'Repaired'
+             AND completed_at >= :start AND completed_at < :end THEN duration END) AS avg_repair_hours,
+    AVG(CASE WHEN request_type = 'Corrective'
+             AND created_at >= :start AND created_at < :end THEN days_since_prev_failure END) AS mtbf_days,
+    SUM(CASE WHEN request_type = 'Corrective' AND status = 'Repaired'
+             AND completed_at >= :start AND completed_at < :end
+             AND (days_to_next_failure IS NULL OR days_to_next_failure > :ftf_days)
+             THEN 1 ELSE 0 END) AS first_time_fixes,
+    SUM(CASE WHEN created_at < :end AND (completed_at IS NULL OR completed_at >= :end)
+             AND NOT (status IN ('Repaired', 'Scrap') AND completed_at IS NULL)
+             THEN 1 ELSE 0 END) AS backlog,
+    AVG(CASE WHEN created_at < :end AND (completed_at IS NULL OR completed_at >= :end)
+             AND NOT (status IN ('Repaired', 'Scrap') AND completed_at IS NULL)
+             THEN julianday(:as_of) - julianday(created_at) END) AS backlog_age_days,
+    MAX(CASE WHEN created_at < :end AND (completed_at IS NULL OR completed_at >= :end)
+             AND NOT (status IN ('Repaired', 'Scrap') AND completed_at IS NULL)
+             THEN julianday(:as_of) - julianday(created_at) END) AS oldest_backlog_days
+FROM base
+GROUP BY dim_key, dim_label
+HAVING failures > 0 OR repairs > 0 OR backlog > 0
+ORDER BY failures DESC, dim_label
+"""
+
+# Results are cached per (site, dimension, period); periods that are still open
+# expire quickly, closed periods are kept longer
+OPEN_PERIOD_TTL = 300
+CLOSED_PERIOD_TTL = 3600
+CACHE_MAX_ENTRIES = 256
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _sql_timestamp(value):
+    # Matches how SQLAlchemy stores DateTime in SQLite, so string comparison works
+    return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def _round(value, digits=2):
+    return round(value, digits) if value is not None else None
+
+
+def compute_reliability(dimension, start, end, ftf_days=FIRST_TIME_FIX_DAYS):
+    """Run the reliability query for one dimension over [start, end)"""
+    key, label = DIMENSIONS[dimension]
+    as_of = min(end, datetime.utcnow())
+
+    rows = db.session.execute(text(RELIABILITY_SQL.format(key=key, label=label)), {
+        'start': _sql_timestamp(start),
+        'end': _sql_timestamp(end),
+        'as_of': _sql_timestamp(as_of),
+        'ftf_days': ftf_days,
+        'site_id': current_site_id(),
+    }).mappings().all()
+
+    results = []
+    for row in rows:
+        repairs = row['repairs'] or 0
+        results.append({
+            'key': row['dim_key'],
+            'label': row['dim_label'],
+            'failures': row['failures'] or 0,
+            'repairs': repairs,
+            'mttr_hours': _round(row['mttr_hours']),
+            'avg_repair_hours': _round(row['avg_repair_hours']),
+            'mtbf_days': _round(row['mtbf_days']),
+            'first_time_fix_rate': _round(row['first_time_fixes'] / repairs, 4) if repairs else None,
+            'backlog': row['backlog'] or 0,
+            'backlog_age_days': _round(row['backlog_age_days']),
+            'oldest_backlog_days': _round(row['oldest_backlog_days']),
+        })
+    return results
+
+
+def get_reliability(dimension, start, end, ftf_days=FIRST_TIME_FIX_DAYS):
+    """Cached compute_reliability()"""
+    cache_key = (current_site_id(), dimension, start, end, ftf_days)
+    now = time.monotonic()
+
+    with _cache_lock:
+        hit = _cache.get(cache_key)
+        if hit and hit[0] > now:
+            return hit[1]
+
+    results = compute_reliability(dimension, start, end, ftf_days)
+    ttl = CLOSED_PERIOD_TTL if end <= datetime.utcnow() else OPEN_PERIOD_TTL
+
+    with _cache_lock:
+        if len(_cache) >= CACHE_MAX_ENTRIES:
+            # Drop the entry closest to expiry
+            del _cache[min(_cache, key=lambda k: _cache[k][0])]
+        _cache[cache_key] = (now + ttl, results)
+    return results
+
+
+def merge_reliability(per_site):
+    """Combine [(site, rows)] from for_each_site() into one list.
+
+    Averages cannot be re-weighted without the raw data, so rows stay per
+    site and are labelled with the site name.
+    """
+    merged = []
+    for site, rows in per_site:
+        for row in rows:
+            merged.append(dict(row, site=site.name, label=f"{site.name} · {row['label']}"))
+    merged.sort(key=lambda row: (-row['failures'], row['label']))
+    return merged
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,213 @@
+"""Set-based bulk changes to equipment and maintenance requests.
+
+Each operation is a handful of INSERT ... SELECT and UPDATE statements in
+one transaction, however many rows match, instead of loading and
+committing every row through its edit form. Statements are ordered so the
+history and sync-feed rows are written from the same WHERE clause as the
+UPDATE that follows them.
+
+Bulk statements bypass the ORM flush hooks, so everything those hooks
+would have done is done here explicitly: row versions are bumped (open
+edit forms then report a conflict), the sync change feed gets a row per
+request and team (models._log_request_changes), request history gets an
+event, and the dropdown cache and search index are told about the change.
+
+With dry_run=True only the counts are computed and nothing is written.
+"""
+import json
+from datetime import datetime
+
+from sqlalchemy import String, cast, func, insert, literal, select, update
+from sqlalchemy.sql.operators import ColumnOperators
+
+from models import db, Equipment, MaintenanceRequest, RequestChange, RequestEvent, team_members
+from services.hierarchy import subtree_ids
+from services.reference import bump_version
+from services.search import mark_stale
+from sites import current_site_id
+
+OPEN_STATUSES = ('New', 'In Progress')
+
+
+def _scoped(statement, model):
+    # The site listener scopes ORM queries, but not the SELECT inside an INSERT
+    site_id = current_site_id()
+    if site_id is not None:
+        statement = statement.where(model.site_id == site_id)
+    return statement
+
+
+def equipment_selection(department=None, team_id=None, employee=None, search=None, under=None,
+                        include_scrapped=False):
+    """SELECT of equipment ids matching the equipment-list filters"""
+    query = _scoped(select(Equipment.id), Equipment)
+    if not include_scrapped:
+        query = query.filter_by(is_scrapped=False)
+    if department:
+        query = query.where(Equipment.department == department)
+    if team_id:
+        query = query.where(Equipment.team_id == team_id)
+    if employee:
+        query = query.where(Equipment.assigned_employee.contains(employee))
+    if search:
+        query = query.where(db.or_(Equipment.name.contains(search), Equipment.serial_number.contains(search)))
+    if under:
+        query = query.where(Equipment.id.in_(subtree_ids(under)))
+    return query
+
+
+def _count(query):
+    return db.session.execute(select(func.count()).select_from(query.subquery())).scalar()
+
+
+def _log_request_changes(request_filter, team_id=None, deleted_from_old_team=False, now=None):
+    """Sync-feed rows for the requests matching request_filter, before they are updated"""
+    team = literal(team_id) if team_id is not None else MaintenanceRequest.team_id
+    columns = [RequestChange.request_id, RequestChange.team_id, RequestChange.deleted, RequestChange.changed_at]
+    rows = [select(MaintenanceRequest.id, team, literal(False), literal(now))]
+    if deleted_from_old_team:
+        # Gone from the old team's clients
+        rows.append(select(MaintenanceRequest.id, MaintenanceRequest.team_id, literal(True), literal(now)))
+    for row in rows:
+        db.session.execute(insert(RequestChange).from_select(
+            columns, _scoped(row.where(*request_filter), MaintenanceRequest)
+        ))
+
+
+def _json_payload(payload):
+    """SQL text expression with payload as compact JSON, like services/history.py writes.
+
+    Constant values are serialized here; integer columns are spliced in
+    with plain string concatenation, which every dialect renders.
+    """
+    if not any(isinstance(value, ColumnOperators) for value in payload.values()):
+        return literal(json.dumps(payload, separators=(',', ':')), String)
+
+    expression, text = None, '{'
+    for key, value in payload.items():
+        text += json.dumps(key) + ':'
+        if isinstance(value, ColumnOperators):
+            part = literal(text, String) + func.coalesce(cast(value, String), 'null')
+            expression = part if expression is None else expression + part
+            text = ','
+        else:
+            text += json.dumps(value) + ','
+    return expression + literal(text.rstrip(',') + '}', String)
+
+
+def _log_request_events(request_filter, event_type, actor, payload, now):
+    """One history event per request matching request_filter"""
+    db.session.execute(insert(RequestEvent).from_select(
+        [RequestEvent.request_id, RequestEvent.event_type, RequestEvent.from_status, RequestEvent.to_status,
+         RequestEvent.actor_id, RequestEvent.created_at, RequestEvent.payload],
+        _scoped(select(
+            MaintenanceRequest.id, literal(event_type), MaintenanceRequest.status, MaintenanceRequest.status,
+            literal(actor.id if actor is not None else None), literal(now), _json_payload(payload)
+        ).where(*request_filter), MaintenanceRequest)
+    ))
+
+
+def _update_requests(request_filter, **values):
+    return db.session.execute(
+        update(MaintenanceRequest).where(*request_filter).values(version=MaintenanceRequest.version + 1, **values),
+        execution_options={'synchronize_session': False}
+    ).rowcount
+
+
+def _finish(dry_run, counts):
+    if dry_run:
+        db.session.rollback()
+        return counts
+    db.session.commit()
+    # Not seen by the flush hooks that normally keep these current
+    bump_version()
+    mark_stale()
+    return counts
+
+
+def move_equipment(selection, team_id, cascade=True, actor=None, dry_run=False):
+    """Move the selected equipment to a team; with cascade, its open requests follow.
+
+    Returns {'equipment': n, 'requests': n}.
+    """
+    moving = selection.where(Equipment.team_id != team_id)
+    request_filter = (
+        MaintenanceRequest.equipment_id.in_(moving),
+        MaintenanceRequest.status.in_(OPEN_STATUSES),
+        MaintenanceRequest.team_id != team_id,
+    )
+
+    if dry_run:
+        return _finish(True, {
+            'equipment': _count(moving),
+            'requests': _count(select(MaintenanceRequest.id).where(*request_filter)) if cascade else 0,
+        })
+
+    now = datetime.utcnow()
+    moved_requests = 0
+    if cascade:
+        # Requests first: afterwards the equipment no longer matches `moving`
+        _log_request_changes(request_filter, team_id=team_id, deleted_from_old_team=True, now=now)
+        _log_request_events(request_filter, 'team_changed', actor,
+                            {'from_team_id': MaintenanceRequest.team_id, 'to_team_id': team_id}, now)
+        moved_requests = _update_requests(request_filter, team_id=team_id)
+
+    moved_equipment = db.session.execute(
+        update(Equipment).where(Equipment.id.in_(moving)).values(team_id=team_id, version=Equipment.version + 1),
+        execution_options={'synchronize_session': False}
+    ).rowcount
+    return _finish(False, {'equipment': moved_equipment, 'requests': moved_requests})
+
+
+def scrap_equipment(selection, dry_run=False):
+    """Mark the selected equipment as scrapped.
+
+    Returns {'equipment': n, 'open_requests': n}; open requests on it are
+    left for their teams to close.
+    """
+    open_requests = _count(select(MaintenanceRequest.id).where(
+        MaintenanceRequest.equipment_id.in_(selection), MaintenanceRequest.status.in_(OPEN_STATUSES)
+    ))
+    if dry_run:
+        return _finish(True, {'equipment': _count(selection), 'open_requests': open_requests})
+
+    scrapped = db.session.execute(
+        update(Equipment).where(Equipment.id.in_(selection)).filter_by(is_scrapped=False)
+        .values(is_scrapped=True, version=Equipment.version + 1),
+        execution_options={'synchronize_session': False}
+    ).rowcount
+    return _finish(False, {'equipment': scrapped, 'open_requests': open_requests})
+
+
+def reassign_open_work(from_technician_id, to_technician_id=None, team_id=None, actor=None, dry_run=False):
+    """Hand a technician's open requests to another technician (or unassign them).
+
+    Only requests of teams the new technician belongs to are handed over;
+    the rest stay where they are. Returns {'requests': n, 'not_in_team': n}.
+    """
+    request_filter = [
+        MaintenanceRequest.assigned_technician_id == from_technician_id,
+        MaintenanceRequest.status.in_(OPEN_STATUSES),
+    ]
+    if team_id:
+        request_filter.append(MaintenanceRequest.team_id == team_id)
+    not_in_team = 0
+    if to_technician_id is not None:
+        target_teams = select(team_members.c.team_id).where(team_members.c.user_id == to_technician_id)
+        not_in_team = _count(_scoped(select(MaintenanceRequest.id), MaintenanceRequest)
+                             .where(*request_filter, MaintenanceRequest.team_id.not_in(target_teams)))
+        request_filter.append(MaintenanceRequest.team_id.in_(target_teams))
+
+    if dry_run:
+        return _finish(True, {'requests': _count(_scoped(select(MaintenanceRequest.id), MaintenanceRequest)
+                                                 .where(*request_filter)),
+                              'not_in_team': not_in_team})
+
+    now = datetime.utcnow()
+    payload = {'from_technician_id': from_technician_id}
+    if to_technician_id is not None:
+        payload['to_technician_id'] = to_technician_id
+    _log_request_changes(request_filter, now=now)
+    _log_request_events(request_filter, 'reassigned', actor, payload, now)
+    return _finish(False, {'requests': _update_requests(request_filter, assigned_technician_id=to_technician_id),
+                           'not_in_team': not_in_team})
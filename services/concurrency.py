@@ -0,0 +1,34 @@
+"""Optimistic concurrency control for versioned rows.
+
+Equipment and MaintenanceRequest carry a ``version`` column that SQLAlchemy
+uses as ``version_id_col``: every ORM UPDATE or DELETE is a compare-and-swap
+(``WHERE id=? AND version=?``) and bumps the version. Forms and API clients
+send back the version they were shown, so edits based on stale data are
+rejected instead of silently overwriting someone else's change. No row
+locks are taken.
+"""
+from sqlalchemy.orm.exc import StaleDataError
+from models import db
+
+
+class VersionConflict(Exception):
+    """Raised when a write was based on an outdated version of a row"""
+
+    def __init__(self, obj):
+        super().__init__(f'{obj!r} was modified concurrently')
+        self.obj = obj
+
+
+def check_version(obj, expected):
+    """Reject the write if the client saw a different version (None skips the check)"""
+    if expected is not None and int(expected) != obj.version:
+        raise VersionConflict(obj)
+
+
+def commit_or_conflict(obj):
+    """Commit; a lost compare-and-swap becomes VersionConflict with obj reloaded"""
+    try:
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        raise VersionConflict(obj)
@@ -0,0 +1,74 @@
+"""Queries over the equipment hierarchy (line -> machine -> subassembly).
+
+The equipment_closure table stores every (ancestor, descendant, depth)
+pair and is kept in step with Equipment.parent_id by a flush listener in
+models.py. Subtrees, breadcrumbs and roll-ups are therefore each a single
+indexed query instead of a recursive walk:
+
+* subtree:     closure primary key (ancestor_id, descendant_id)
+* breadcrumbs: ix_equipment_closure_descendant_depth
+* roll-ups:    closure joined to ix_maintenance_requests_equipment_status
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, text
+from models import db, Equipment, EquipmentClosure
+
+# Downtime is summed over corrective requests opened in this window
+DOWNTIME_WINDOW_DAYS = 90
+
+ROLLUP_SQL = """
+SELECT node.id, node.name, node.is_scrapped,
+       COUNT(DISTINCT c.descendant_id) AS assets,
+       COUNT(DISTINCT CASE WHEN r.status IN ('New', 'In Progress') THEN r.id END) AS open_requests,
+       COALESCE(SUM(CASE WHEN r.request_type = 'Corrective' AND r.created_at >= :since
+                         THEN julianday(COALESCE(r.completed_at, :now)) - julianday(r.created_at)
+                    END), 0) * 24 AS downtime_hours
+FROM equipment node
+JOIN equipment_closure c ON c.ancestor_id = node.id
+LEFT JOIN maintenance_requests r ON r.equipment_id = c.descendant_id
+WHERE {where}
+GROUP BY node.id, node.name, node.is_scrapped
+ORDER BY node.name
+"""
+
+
+def subtree_ids(equipment_id):
+    """SELECT of the ids in a subtree (the node included), for use in IN (...)"""
+    return select(EquipmentClosure.descendant_id).where(EquipmentClosure.ancestor_id == equipment_id)
+
+
+def is_in_subtree(equipment_id, ancestor_id):
+    return db.session.query(EquipmentClosure.depth).filter_by(
+        ancestor_id=ancestor_id, descendant_id=equipment_id
+    ).first() is not None
+
+
+def get_breadcrumbs(equipment_id):
+    """Ancestors from the root down to the parent, as [(id, name)]"""
+    return db.session.query(Equipment.id, Equipment.name).join(
+        EquipmentClosure, EquipmentClosure.ancestor_id == Equipment.id
+    ).filter(
+        EquipmentClosure.descendant_id == equipment_id,
+        EquipmentClosure.depth > 0
+    ).order_by(EquipmentClosure.depth.desc()).all()
+
+
+def _rollups(where, params, window_days):
+    now = datetime.utcnow()
+    params = dict(params,
+                  since=(now - timedelta(days=window_days)).strftime('%Y-%m-%d %H:%M:%S.%f'),
+                  now=now.strftime('%Y-%m-%d %H:%M:%S.%f'))
+    rows = db.session.execute(text(ROLLUP_SQL.format(where=where)), params).mappings().all()
+    return [dict(row, downtime_hours=round(row['downtime_hours'], 1)) for row in rows]
+
+
+def get_subtree_rollup(equipment_id, window_days=DOWNTIME_WINDOW_DAYS):
+    """Assets, open requests and downtime hours for a whole subtree"""
+    rows = _rollups('node.id = :id', {'id': equipment_id}, window_days)
+    return rows[0] if rows else None
+
+
+def get_child_rollups(equipment_id, window_days=DOWNTIME_WINDOW_DAYS):
+    """The same roll-up for each direct child's subtree, in one query"""
+    return _rollups('node.parent_id = :id', {'id': equipment_id}, window_days)
@@ -0,0 +1,53 @@
+"""Structured status-transition history for maintenance requests.
+
+Every create, assign and status change appends one RequestEvent row in the
+same transaction as the change itself. Rows are never updated, so history
+grows by a small fixed-size insert instead of rewriting ``notes``.
+"""
+import json
+
+from models import db, RequestEvent, User
+
+
+def record_event(maintenance_request, event_type, actor, from_status=None, to_status=None, **payload):
+    """Append an event for a request to the current session"""
+    payload = {key: value for key, value in payload.items() if value is not None}
+    event = RequestEvent(
+        request_id=maintenance_request.id,
+        event_type=event_type,
+        from_status=from_status,
+        to_status=to_status,
+        actor_id=actor.id if actor is not None else None,
+        payload=json.dumps(payload, separators=(',', ':')) if payload else None
+    )
+    db.session.add(event)
+    return event
+
+
+def get_history(request_id, page=1, per_page=20):
+    """Return one page of a request's history, newest first"""
+    query = db.session.query(RequestEvent, User.name).outerjoin(
+        User, User.id == RequestEvent.actor_id
+    ).filter(
+        RequestEvent.request_id == request_id
+    ).order_by(RequestEvent.created_at.desc(), RequestEvent.id.desc())
+
+    # Fetch one extra row to know whether another page exists without a COUNT
+    rows = query.offset((page - 1) * per_page).limit(per_page + 1).all()
+
+    events = [{
+        'id': event.id,
+        'type': event.event_type,
+        'from_status': event.from_status,
+        'to_status': event.to_status,
+        'actor': actor_name,
+        'created_at': event.created_at.isoformat(),
+        'payload': event.get_payload()
+    } for event, actor_name in rows[:per_page]]
+
+    return {
+        'events': events,
+        'page': page,
+        'per_page': per_page,
+        'has_next': len(rows) > per_page
+    }
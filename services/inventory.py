@@ -0,0 +1,184 @@
+"""Spare-parts stock: an append-only ledger plus running balances.
+
+Every movement appends a StockLedgerEntry and applies its effect to
+StockBalance (and, for reservations, PartReservation) in the same
+transaction, so stock levels are one primary-key read and the ledger is
+the audit trail that reproduces them. Balance changes are single
+conditional UPDATEs: two technicians reserving the last unit cannot both
+succeed, because the second UPDATE matches no row.
+
+Reservations still held by a request are released automatically when the
+request moves to Repaired or Scrap, or is deleted (see _release_on_close).
+"""
+from sqlalchemy import event, func, inspect as inspect_state, text
+
+from db_routing import RoutingSession
+from models import db, MaintenanceRequest, Part, PartReservation, StockBalance, StockLedgerEntry, StockLocation
+
+CLOSED_STATUSES = ('Repaired', 'Scrap')
+
+RECEIVE_SQL = text("""
+INSERT INTO stock_balances (part_id, location_id, on_hand, reserved)
+VALUES (:part_id, :location_id, :quantity, 0)
+ON CONFLICT (part_id, location_id) DO UPDATE SET on_hand = on_hand + excluded.on_hand
+""")
+
+RESERVE_SQL = text("""
+UPDATE stock_balances SET reserved = reserved + :quantity
+WHERE part_id = :part_id AND location_id = :location_id AND on_hand - reserved >= :quantity
+""")
+
+HOLD_SQL = text("""
+INSERT INTO part_reservations (request_id, part_id, location_id, quantity)
+VALUES (:request_id, :part_id, :location_id, :quantity)
+ON CONFLICT (request_id, part_id, location_id) DO UPDATE SET quantity = quantity + excluded.quantity
+""")
+
+UNHOLD_SQL = text("""
+UPDATE part_reservations SET quantity = quantity - :quantity
+WHERE request_id = :request_id AND part_id = :part_id AND location_id = :location_id AND quantity >= :quantity
+""")
+
+UNRESERVE_SQL = text("""
+UPDATE stock_balances SET reserved = reserved - :quantity
+WHERE part_id = :part_id AND location_id = :location_id
+""")
+
+# Releases `released` units of the reservation and takes `quantity` off the shelf
+TAKE_SQL = text("""
+UPDATE stock_balances SET on_hand = on_hand - :quantity, reserved = reserved - :released
+WHERE part_id = :part_id AND location_id = :location_id
+  AND reserved >= :released AND on_hand - reserved + :released >= :quantity
+""")
+
+
+class InsufficientStock(Exception):
+    """Not enough unreserved stock at the location for this movement"""
+
+
+def _check_quantity(quantity):
+    if not isinstance(quantity, int) or quantity <= 0:
+        raise ValueError('Quantity must be a positive whole number')
+
+
+def _append(session, entry_type, part_id, location_id, quantity, request_id=None, actor=None, note=None):
+    session.add(StockLedgerEntry(
+        entry_type=entry_type,
+        part_id=part_id,
+        location_id=location_id,
+        quantity=quantity,
+        request_id=request_id,
+        actor_id=actor.id if actor is not None else None,
+        note=note
+    ))
+
+
+def _params(part_id, location_id, quantity, request_id=None, **extra):
+    return dict(part_id=part_id, location_id=location_id, quantity=quantity, request_id=request_id, **extra)
+
+
+def receive(part, location, quantity, actor=None, note=None):
+    """Add delivered stock to a location"""
+    _check_quantity(quantity)
+    db.session.connection().execute(RECEIVE_SQL, _params(part.id, location.id, quantity))
+    _append(db.session, 'receipt', part.id, location.id, quantity, actor=actor, note=note)
+
+
+def reserve(maintenance_request, part, location, quantity, actor=None):
+    """Set stock aside for a request; raises InsufficientStock"""
+    _check_quantity(quantity)
+    connection = db.session.connection()
+    params = _params(part.id, location.id, quantity, maintenance_request.id)
+    if connection.execute(RESERVE_SQL, params).rowcount != 1:
+        raise InsufficientStock(f'Only {get_available(part.id, location.id)} {part.unit} of {part.sku} available')
+    connection.execute(HOLD_SQL, params)
+    _append(db.session, 'reservation', part.id, location.id, quantity, maintenance_request.id, actor)
+
+
+def _release(session, request_id, part_id, location_id, quantity, actor=None, note=None):
+    connection = session.connection()
+    params = _params(part_id, location_id, quantity, request_id, released=quantity)
+    if connection.execute(UNHOLD_SQL, params).rowcount != 1:
+        raise ValueError('Cannot release more than the request has reserved')
+    connection.execute(UNRESERVE_SQL, params)
+    _append(session, 'release', part_id, location_id, quantity, request_id, actor, note)
+
+
+def release(maintenance_request, part, location, quantity=None, actor=None):
+    """Return reserved stock to the shelf (all of it when quantity is None)"""
+    held = get_reserved_for(maintenance_request.id, part.id, location.id)
+    quantity = held if quantity is None else quantity
+    _check_quantity(quantity)
+    _release(db.session, maintenance_request.id, part.id, location.id, quantity, actor)
+
+
+def consume(maintenance_request, part, location, quantity, actor=None):
+    """Use parts on a request, drawing on its reservation first; raises InsufficientStock"""
+    _check_quantity(quantity)
+    connection = db.session.connection()
+    released = min(quantity, get_reserved_for(maintenance_request.id, part.id, location.id))
+    params = _params(part.id, location.id, quantity, maintenance_request.id, released=released)
+
+    if connection.execute(TAKE_SQL, params).rowcount != 1:
+        raise InsufficientStock(f'Only {get_available(part.id, location.id)} {part.unit} of {part.sku} available')
+    if released:
+        connection.execute(UNHOLD_SQL, dict(params, quantity=released))
+        _append(db.session, 'release', part.id, location.id, released, maintenance_request.id, actor,
+                note='Consumed')
+    _append(db.session, 'consumption', part.id, location.id, quantity, maintenance_request.id, actor)
+
+
+# Column queries rather than session.get(): the balance UPDATEs above bypass
+# the identity map, so a loaded StockBalance/PartReservation may be stale
+
+def get_available(part_id, location_id):
+    return db.session.query(StockBalance.on_hand - StockBalance.reserved).filter_by(
+        part_id=part_id, location_id=location_id
+    ).scalar() or 0
+
+
+def get_reserved_for(request_id, part_id, location_id):
+    return db.session.query(PartReservation.quantity).filter_by(
+        request_id=request_id, part_id=part_id, location_id=location_id
+    ).scalar() or 0
+
+
+def get_request_parts(request_id):
+    """Reservations still held and quantities consumed by one request"""
+    reservations = PartReservation.query.filter(
+        PartReservation.request_id == request_id,
+        PartReservation.quantity > 0
+    ).all()
+    consumed = db.session.query(
+        Part, StockLocation, func.sum(StockLedgerEntry.quantity)
+    ).join(Part, Part.id == StockLedgerEntry.part_id).join(
+        StockLocation, StockLocation.id == StockLedgerEntry.location_id
+    ).filter(
+        StockLedgerEntry.request_id == request_id,
+        StockLedgerEntry.entry_type == 'consumption'
+    ).group_by(Part.id, StockLocation.id).all()
+    return reservations, consumed
+
+
+def _release_all(session, request_id, note):
+    held = session.query(PartReservation.part_id, PartReservation.location_id, PartReservation.quantity).filter(
+        PartReservation.request_id == request_id,
+        PartReservation.quantity > 0
+    ).all()
+    for part_id, location_id, quantity in held:
+        _release(session, request_id, part_id, location_id, quantity, note=note)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _release_on_close(session, flush_context, instances):
+    """Hand back whatever a request still holds once it is closed or deleted"""
+    for obj in list(session.dirty):
+        if not isinstance(obj, MaintenanceRequest) or obj.status not in CLOSED_STATUSES:
+            continue
+        added, _, deleted = inspect_state(obj).attrs.status.history
+        if added and not (set(deleted) & set(CLOSED_STATUSES)):
+            _release_all(session, obj.id, f'Auto-released: request {obj.status}')
+
+    for obj in list(session.deleted):
+        if isinstance(obj, MaintenanceRequest):
+            _release_all(session, obj.id, 'Auto-released: request deleted')
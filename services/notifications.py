@@ -0,0 +1,403 @@
+"""Transactional outbox for outgoing notifications.
+
+Route handlers never talk to a mail server. The ``notify_*`` helpers only add
+an OutboxMessage to the current session, so the message is committed (or
+rolled back) together with the state change that caused it. OutboxWorker
+then delivers pending rows in batches from a background thread.
+"""
+import logging
+import smtplib
+import threading
+import uuid
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, OutboxMessage, MaintenanceRequest, User
+from sites import for_each_database
+
+logger = logging.getLogger(__name__)
+
+
+# ---------------------------------------------------------------------------
+# Enqueueing (called from request handlers, never blocks on delivery)
+# ---------------------------------------------------------------------------
+
+def _insert_once(**values):
+    """INSERT ... ON CONFLICT (dedup_key) DO NOTHING; returns the new id or None.
+
+    A concurrent transaction queueing the same key makes this a no-op
+    instead of failing the caller's commit on the unique index, and the
+    conflict does not abort the transaction, so no savepoint is needed.
+    """
+    dialect = db.session.get_bind(mapper=OutboxMessage.__mapper__).dialect.name
+    insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+    result = db.session.execute(
+        insert(OutboxMessage.__table__).values(**values).on_conflict_do_nothing(index_elements=['dedup_key'])
+    )
+    return result.inserted_primary_key[0] if result.rowcount else None
+
+
+def enqueue(kind, recipient, subject, body, dedup_key=None):
+    """Add a message to the outbox in the caller's transaction"""
+    if not recipient:
+        return None
+
+    if dedup_key:
+        id = _insert_once(kind=kind, recipient=recipient, subject=subject, body=body, dedup_key=dedup_key)
+        return db.session.get(OutboxMessage, id) if id else None
+
+    message = OutboxMessage(kind=kind, recipient=recipient, subject=subject, body=body)
+    db.session.add(message)
+    return message
+
+
+def notify_assigned(maintenance_request, technician):
+    """Tell a technician a request was assigned to them"""
+    today = datetime.utcnow().date().isoformat()
+    return enqueue(
+        'request_assigned',
+        technician.email,
+        f'[GearGuard] Request #{maintenance_request.id} assigned to you',
+        f'Hi {technician.name},\n\n'
+        f'You have been assigned "{maintenance_request.subject}" '
+        f'on {maintenance_request.equipment.name}.\n',
+        dedup_key=f'assigned:{maintenance_request.site_id}:{maintenance_request.id}:{technician.id}:{today}'
+    )
+
+
+def notify_status_changed(maintenance_request, old_status, new_status, actor=None):
+    """Tell the creator and assigned technician about a status change"""
+    recipients = {maintenance_request.created_by, maintenance_request.assigned_technician}
+    today = datetime.utcnow().date().isoformat()
+
+    for user in recipients:
+        # Nobody needs an email about something they just did themselves
+        if user is None or (actor is not None and user.id == actor.id):
+            continue
+        enqueue(
+            'status_changed',
+            user.email,
+            f'[GearGuard] Request #{maintenance_request.id} is now {new_status}',
+            f'Hi {user.name},\n\n'
+            f'"{maintenance_request.subject}" moved from {old_status} to {new_status}.\n',
+            # The same transition is announced to a recipient at most once a day
+            dedup_key=f'status:{maintenance_request.site_id}:{maintenance_request.id}:{old_status}>{new_status}:{user.id}:{today}'
+        )
+
+
+def notify_sla_breached(maintenance_request, target):
+    """Tell whoever is working on a request that it missed its response or resolve target"""
+    recipients = ([maintenance_request.assigned_technician] if maintenance_request.assigned_technician
+                  else maintenance_request.team.members)
+    for user in recipients:
+        enqueue(
+            'sla_breached',
+            user.email,
+            f'[GearGuard] Request #{maintenance_request.id} missed its {target} target',
+            f'Hi {user.name},\n\n'
+            f'"{maintenance_request.subject}" on {maintenance_request.equipment.name} '
+            f'has passed its SLA {target} deadline.\n',
+            dedup_key=f'sla:{maintenance_request.site_id}:{maintenance_request.id}:{target}:{user.id}'
+        )
+
+
+def notify_sla_escalated(maintenance_request):
+    """Escalate a request that is still open well past its resolve target to the managers"""
+    managers = User.query.filter(
+        User.role.in_(['Admin', 'Manager']),
+        db.or_(User.site_id.is_(None), User.site_id == maintenance_request.site_id)
+    ).all()
+    for user in managers:
+        enqueue(
+            'sla_escalated',
+            user.email,
+            f'[GearGuard] Escalation: request #{maintenance_request.id} is overdue',
+            f'Hi {user.name},\n\n'
+            f'"{maintenance_request.subject}" ({maintenance_request.team.name}) is still '
+            f'{maintenance_request.status} well past its SLA resolve deadline.\n',
+            dedup_key=f'sla:{maintenance_request.site_id}:{maintenance_request.id}:escalation:{user.id}'
+        )
+
+
+def notify_warranty_digest(team, items, days, today):
+    """Send a team its equipment whose warranty lapses soon: items are (id, name, serial, expiry)"""
+    lines = ''.join(f'- {name} ({serial}): warranty ends {expiry.isoformat()}\n'
+                    for _, name, serial, expiry in items)
+    for user in team.members:
+        enqueue(
+            'warranty_digest',
+            user.email,
+            f'[GearGuard] {len(items)} warranties of {team.name} end within {days} days',
+            f'Hi {user.name},\n\n'
+            f'Report faults on these assets before their warranty ends, while repairs are free:\n\n'
+            f'{lines}',
+            # Re-running the job on the same day sends nothing new
+            dedup_key=f'warranty:{team.site_id}:{team.id}:{user.id}:{today.isoformat()}'
+        )
+
+
+def notify_password_reset(user, token, reset_link):
+    """Send a password reset link"""
+    return enqueue(
+        'password_reset',
+        user.email,
+        '[GearGuard] Password reset',
+        f'Hi {user.name},\n\n'
+        f'Use the link below to reset your password. It expires in 1 hour.\n\n'
+        f'{reset_link}\n',
+        dedup_key=f'reset:{token}'
+    )
+
+
+def queue_overdue_alerts():
+    """Queue one alert per overdue open request and due date, then commit"""
+    overdue = MaintenanceRequest.query.filter(
+        MaintenanceRequest.due_date < datetime.now().date(),
+        MaintenanceRequest.status.in_(['New', 'In Progress'])
+    ).all()
+    if not overdue:
+        return 0
+
+    alerts = []
+    for maintenance_request in overdue:
+        if maintenance_request.assigned_technician:
+            recipients = [maintenance_request.assigned_technician]
+        else:
+            recipients = maintenance_request.team.members
+        for user in recipients:
+            key = f'overdue:{maintenance_request.site_id}:{maintenance_request.id}:{maintenance_request.due_date.isoformat()}:{user.id}'
+            alerts.append((key, maintenance_request, user))
+
+    # One lookup for every candidate key instead of one per alert
+    existing = {
+        key for (key,) in db.session.query(OutboxMessage.dedup_key).filter(
+            OutboxMessage.dedup_key.in_([key for key, _, _ in alerts])
+        )
+    }
+
+    queued = 0
+    for key, maintenance_request, user in alerts:
+        if key in existing:
+            continue
+        # Another worker may have queued it since the lookup
+        if _insert_once(
+            kind='request_overdue',
+            recipient=user.email,
+            subject=f'[GearGuard] Request #{maintenance_request.id} is overdue',
+            body=f'Hi {user.name},\n\n'
+                 f'"{maintenance_request.subject}" was due on '
+                 f'{maintenance_request.due_date.strftime("%Y-%m-%d")}.\n',
+            dedup_key=key
+        ):
+            queued += 1
+
+    db.session.commit()
+    return queued
+
+
+# ---------------------------------------------------------------------------
+# Transports
+# ---------------------------------------------------------------------------
+
+class ConsoleTransport:
+    """Prints messages instead of sending them (development default)"""
+
+    def open(self):
+        pass
+
+    def send(self, message):
+        print(f'📧 To: {message.recipient}\n   Subject: {message.subject}\n{message.body}', flush=True)
+
+    def close(self):
+        pass
+
+
+class SMTPTransport:
+    """Delivers messages over one SMTP connection per batch.
+
+    For local testing point it at a debugging server, e.g.
+    ``python -m aiosmtpd -n -l localhost:1025``.
+    """
+
+    def __init__(self, host, port, sender, username=None, password=None,
+                 use_tls=False, timeout=10):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self._conn = None
+
+    def open(self):
+        self._conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            self._conn.starttls()
+        if self.username:
+            self._conn.login(self.username, self.password)
+
+    def send(self, message):
+        email = EmailMessage()
+        email['From'] = self.sender
+        email['To'] = message.recipient
+        email['Subject'] = message.subject
+        email.set_content(message.body)
+        self._conn.send_message(email)
+
+    def close(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.quit()
+        except smtplib.SMTPException:
+            pass
+        self._conn = None
+
+
+TRANSPORTS = {
+    'console': lambda config: ConsoleTransport(),
+    'smtp': lambda config: SMTPTransport(
+        host=config.get('MAIL_SERVER', 'localhost'),
+        port=config.get('MAIL_PORT', 1025),
+        sender=config.get('MAIL_DEFAULT_SENDER', 'noreply@gearguard.local'),
+        username=config.get('MAIL_USERNAME'),
+        password=config.get('MAIL_PASSWORD'),
+        use_tls=config.get('MAIL_USE_TLS', False)
+    ),
+}
+
+
+def build_transport(config):
+    """Build the transport named by MAIL_TRANSPORT (or use a transport object as-is)"""
+    transport = config.get('MAIL_TRANSPORT', 'console')
+    if isinstance(transport, str):
+        return TRANSPORTS[transport](config)
+    return transport
+
+
+# ---------------------------------------------------------------------------
+# Delivery
+# ---------------------------------------------------------------------------
+
+def backoff_delay(attempts, base_seconds, max_seconds):
+    """Exponential backoff: base, 2*base, 4*base, ... capped at max_seconds"""
+    return min(base_seconds * 2 ** (attempts - 1), max_seconds)
+
+
+def dispatch_batch(transport):
+    """Claim a batch of due messages, deliver them and record the outcome.
+
+    Returns the number of messages claimed.
+    """
+    config = current_app.config
+    batch_size = config.get('OUTBOX_BATCH_SIZE', 50)
+    max_attempts = config.get('OUTBOX_MAX_ATTEMPTS', 6)
+    base_delay = config.get('OUTBOX_BACKOFF_SECONDS', 30)
+    max_delay = config.get('OUTBOX_BACKOFF_MAX_SECONDS', 3600)
+    claim_timeout = timedelta(seconds=config.get('OUTBOX_CLAIM_TIMEOUT_SECONDS', 300))
+    now = datetime.utcnow()
+
+    # Release claims left behind by a worker that died mid-batch
+    OutboxMessage.query.filter(
+        OutboxMessage.status == 'sending',
+        OutboxMessage.claimed_at < now - claim_timeout
+    ).update({'status': 'pending', 'claimed_by': None}, synchronize_session=False)
+
+    due_ids = [row.id for row in db.session.query(OutboxMessage.id).filter(
+        OutboxMessage.status == 'pending',
+        OutboxMessage.next_attempt_at <= now
+    ).order_by(OutboxMessage.next_attempt_at).limit(batch_size)]
+
+    if not due_ids:
+        db.session.commit()
+        return 0
+
+    # Claim with a conditional UPDATE so concurrent workers never share a row
+    token = uuid.uuid4().hex
+    OutboxMessage.query.filter(
+        OutboxMessage.id.in_(due_ids),
+        OutboxMessage.status == 'pending'
+    ).update({'status': 'sending', 'claimed_by': token, 'claimed_at': now},
+             synchronize_session=False)
+    db.session.commit()
+
+    batch = OutboxMessage.query.filter_by(claimed_by=token).all()
+    if not batch:
+        return 0
+
+    try:
+        transport.open()
+        opened = None
+    except Exception as e:
+        opened = e
+
+    for message in batch:
+        error = opened
+        if error is None:
+            try:
+                transport.send(message)
+            except Exception as e:
+                error = e
+
+        message.attempts += 1
+        message.claimed_by = None
+        if error is None:
+            message.status = 'sent'
+            message.sent_at = datetime.utcnow()
+            message.last_error = None
+        elif message.attempts >= max_attempts:
+            message.status = 'failed'
+            message.last_error = str(error)
+            logger.error('Outbox message %s failed permanently: %s', message.id, error)
+        else:
+            message.status = 'pending'
+            message.last_error = str(error)
+            message.next_attempt_at = datetime.utcnow() + timedelta(
+                seconds=backoff_delay(message.attempts, base_delay, max_delay))
+
+    if opened is None:
+        transport.close()
+
+    db.session.commit()
+    return len(batch)
+
+
+class OutboxWorker(threading.Thread):
+    """Background thread that drains the outbox and queues overdue alerts"""
+
+    def __init__(self, app, transport=None):
+        super().__init__(name='outbox-worker', daemon=True)
+        self.app = app
+        self.transport = transport or build_transport(app.config)
+        self._stop_event = threading.Event()
+        self._next_overdue_scan = datetime.utcnow()
+
+    def run(self):
+        poll_seconds = self.app.config.get('OUTBOX_POLL_SECONDS', 5)
+        overdue_interval = timedelta(seconds=self.app.config.get('OUTBOX_OVERDUE_SCAN_SECONDS', 3600))
+
+        while not self._stop_event.is_set():
+            claimed = 0
+            with self.app.app_context():
+                try:
+                    if datetime.utcnow() >= self._next_overdue_scan:
+                        for_each_database(queue_overdue_alerts)
+                        self._next_overdue_scan = datetime.utcnow() + overdue_interval
+                    claimed = dispatch_batch(self.transport)
+                except Exception:
+                    db.session.rollback()
+                    logger.exception('Outbox worker iteration failed')
+                finally:
+                    db.session.remove()
+
+            # Keep draining while there is a backlog, otherwise sleep
+            if not claimed:
+                self._stop_event.wait(poll_seconds)
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,118 @@
+"""Cached (id, label) lists for form dropdowns: teams, technicians, equipment, departments.
+
+Forms used to load full ORM rows for every dropdown on every GET and every
+failed validation. The lists change rarely, so each is kept in a small
+process-wide LRU as a tuple of (id, label) tuples, keyed by list and site.
+
+Entries are stamped with a global version counter. Committing a session
+that wrote a Team, User or Equipment bumps the counter, and any entry with
+an older stamp is reloaded on next use. The counter lives in shared memory
+created at import, i.e. in the pre-fork master (gunicorn --preload), so a
+write handled by one worker invalidates every worker's cache. Writes from
+outside the server (CLI commands, other hosts) are picked up within
+CACHE_TTL seconds.
+"""
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from itertools import chain
+
+from sqlalchemy import event
+
+from db_routing import RoutingSession
+from models import db, Equipment, Team, User
+from sites import current_site_id
+from telemetry import count_cache, register_cache
+
+CACHE_MAX_ENTRIES = 64
+CACHE_TTL = 300
+
+WATCHED_MODELS = (Team, User, Equipment)
+
+_version = multiprocessing.Value('q', 0)
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+register_cache('reference')
+
+
+def current_version():
+    return _version.value
+
+
+def bump_version():
+    with _version.get_lock():
+        _version.value += 1
+
+
+def _cached(name, load):
+    key = (name, current_site_id())
+    version = _version.value
+    now = time.monotonic()
+
+    with _cache_lock:
+        hit = _cache.get(key)
+        if hit and hit[0] == version and hit[1] > now:
+            _cache.move_to_end(key)
+            count_cache('reference', True)
+            return hit[2]
+
+    count_cache('reference', False)
+
+    # Stamped with the version read before loading: a write that commits
+    # meanwhile leaves this entry stale rather than hiding the write
+    choices = tuple((value, label) for value, label in load())
+
+    with _cache_lock:
+        _cache[key] = (version, now + CACHE_TTL, choices)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+    return choices
+
+
+def team_choices():
+    return _cached('teams', lambda: db.session.query(Team.id, Team.name).order_by(Team.name).all())
+
+
+def technician_choices():
+    return _cached('technicians', lambda: db.session.query(User.id, User.name).filter(
+        User.role == 'Technician'
+    ).order_by(User.name).all())
+
+
+def equipment_choices():
+    """Equipment that can still get requests, labelled 'name (serial)'"""
+    return _cached('equipment', lambda: db.session.query(
+        Equipment.id, Equipment.name + ' (' + Equipment.serial_number + ')'
+    ).filter_by(is_scrapped=False).order_by(Equipment.name).all())
+
+
+def department_choices():
+    return _cached('departments', lambda: db.session.query(
+        Equipment.department, Equipment.department
+    ).distinct().order_by(Equipment.department).all())
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _note_reference_writes(session, flush_context):
+    # new/dirty/deleted still describe what this flush wrote
+    if any(isinstance(obj, WATCHED_MODELS) for obj in chain(session.new, session.dirty, session.deleted)):
+        session.info['reference_data_changed'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _bump_on_commit(session):
+    if session.info.pop('reference_data_changed', False):
+        bump_version()
+
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def _forget_on_rollback(session, previous_transaction):
+    session.info.pop('reference_data_changed', None)
@@ -0,0 +1,90 @@
+"""Batch failure-risk scoring for the equipment fleet.
+
+score_fleet() rebuilds the equipment_risk table with one INSERT ... SELECT,
+so the whole fleet is scored set-based inside the database instead of row
+by row in Python. Run it nightly with ``flask --app app score-risk``; pages
+only read the stored scores.
+"""
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from models import db
+
+# Contribution of each signal to the raw risk value
+WEIGHTS = {
+    'failures_90d': 1.0,       # per corrective request in the last 90 days
+    'failures_365d': 0.35,     # per corrective request in the last year
+    'age_years': 0.15,         # per year since purchase
+    'out_of_warranty': 0.5,    # flat, once the warranty has lapsed
+    'repair_hours': 0.1,       # per hour of average recent repair time
+}
+
+# Raw value at which the score reaches 50; scores saturate towards 100
+HALF_RISK = 2.0
+
+SCORE_SQL = """
+INSERT INTO equipment_risk
+    (equipment_id, score, failures_90d, failures_365d, age_years,
+     in_warranty, avg_repair_hours, computed_at)
+SELECT id,
+       ROUND(100.0 * raw / (raw + :half_risk), 1),
+       failures_90d, failures_365d, age_years, in_warranty, avg_repair_hours,
+       :computed_at
+FROM (
+    SELECT id, failures_90d, failures_365d, age_years, in_warranty, avg_repair_hours,
+           :w_failures_90d * failures_90d
+           + :w_failures_365d * failures_365d
+           + :w_age_years * COALESCE(age_years, 0)
+           + :w_out_of_warranty * (1 - in_warranty)
+           + :w_repair_hours * COALESCE(avg_repair_hours, 0) AS raw
+    FROM (
+        SELECT e.id,
+               COALESCE(f.failures_90d, 0) AS failures_90d,
+               COALESCE(f.failures_365d, 0) AS failures_365d,
+               (julianday(:today) - julianday(e.purchase_date)) / 365.25 AS age_years,
+               CASE WHEN e.warranty_expiry >= :today THEN 1 ELSE 0 END AS in_warranty,
+               f.avg_repair_hours
+        FROM equipment e
+        LEFT JOIN (
+            SELECT equipment_id,
+                   SUM(CASE WHEN created_at >= :since_90 THEN 1 ELSE 0 END) AS failures_90d,
+                   COUNT(*) AS failures_365d,
+                   AVG(CASE WHEN status = 'Repaired' AND created_at >= :since_180
+                            THEN duration END) AS avg_repair_hours
+            FROM maintenance_requests
+            WHERE request_type = 'Corrective' AND created_at >= :since_365
+            GROUP BY equipment_id
+        ) f ON f.equipment_id = e.id
+        WHERE COALESCE(e.is_scrapped, 0) = 0
+    )
+)
+"""
+
+
+def score_fleet(now=None):
+    """Recompute every non-scrapped equipment's score; returns (count, seconds)"""
+    started = time.perf_counter()
+    now = now or datetime.utcnow()
+
+    def since(days):
+        return (now - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+    params = {
+        'today': now.date().isoformat(),
+        'since_90': since(90),
+        'since_180': since(180),
+        'since_365': since(365),
+        'half_risk': HALF_RISK,
+        'computed_at': now.strftime('%Y-%m-%d %H:%M:%S.%f'),
+    }
+    params.update({f'w_{name}': weight for name, weight in WEIGHTS.items()})
+
+    # Swap the whole table in one transaction; readers keep seeing the
+    # previous scores until the commit
+    db.session.execute(text('DELETE FROM equipment_risk'))
+    db.session.execute(text(SCORE_SQL), params)
+    count = db.session.execute(text('SELECT COUNT(*) FROM equipment_risk')).scalar()
+    db.session.commit()
+
+    return count, time.perf_counter() - started
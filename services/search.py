@@ -0,0 +1,433 @@
+"""In-memory prefix index behind the global search box.
+
+Equipment (name, serial), request subjects, team names and user names are
+split into lowercase word tokens and kept in sorted lists of (token, key)
+pairs, one list per site (plus one for rows without a site). A query's
+longest word is located with bisect in the lists the user may see, their
+prefix ranges scanned in token order, and the remaining words matched
+against each candidate's tokens, so a keystroke costs a binary search and
+a short scan instead of a LIKE over four tables.
+
+The index is built when the app starts and updated from the ORM: writes
+are captured at flush and applied on commit, so rolled-back work never
+shows up. Each process holds its own copy. Commits also append the keys
+they changed to a ring of recent changes in shared memory (created
+pre-fork, like services/reference.py); another process that sees new
+entries reloads just those rows in the background, and only rebuilds
+everything when it fell more than CHANGE_LOG_SIZE changes behind or a bulk
+write (mark_stale) could not say which rows it touched. Writes made
+outside the server (CLI commands, other hosts) show up within INDEX_TTL
+seconds.
+"""
+import bisect
+import heapq
+import multiprocessing
+import re
+import threading
+import time
+from collections import defaultdict, namedtuple
+from itertools import chain, islice
+
+from flask import current_app, g
+from sqlalchemy import event
+
+from db_routing import RoutingSession
+from models import db, Equipment, MaintenanceRequest, Team, User
+from sites import activate_site, for_each_database
+
+INDEX_TTL = 600
+MIN_QUERY_LENGTH = 2
+MAX_RESULTS = 10
+# Upper bound on matching candidates looked at for very short prefixes on
+# big trees (counted after the permission filters); each further keystroke
+# narrows the range again
+MAX_CANDIDATES = 5000
+# Recent changes other processes can catch up from without a full rebuild
+CHANGE_LOG_SIZE = 4096
+# Change-log kind that means "unknown rows changed": rebuild
+REBUILD = -1
+
+# Listed in this order when scores tie
+KINDS = ('equipment', 'request', 'team', 'user')
+
+OPEN_STATUSES = ('New', 'In Progress')
+
+WORD = re.compile(r'[^\W_]+')
+
+Entry = namedtuple('Entry', 'kind id site_id team_id label detail active tokens')
+
+_generation = multiprocessing.Value('q', 0)
+# Slot generation % CHANGE_LOG_SIZE holds (kind index or REBUILD, site id or 0, row id)
+_change_log = multiprocessing.Array('q', CHANGE_LOG_SIZE * 3, lock=False)
+_index = None
+_index_lock = threading.Lock()
+_rebuild_lock = threading.Lock()
+
+
+def tokenize(*texts):
+    return tuple(sorted({word for text in texts if text for word in WORD.findall(text.lower())}))
+
+
+def entry_key(entry):
+    # Per-site files number their rows independently, so the site is part of the key
+    return (entry.kind, entry.site_id or 0, entry.id)
+
+
+def equipment_entry(id, name, serial_number, department, site_id, team_id, is_scrapped):
+    return Entry('equipment', id, site_id, team_id, name, f'{serial_number} · {department}',
+                 not is_scrapped, tokenize(name, serial_number))
+
+
+def request_entry(id, subject, status, site_id, team_id):
+    return Entry('request', id, site_id, team_id, subject, f'#{id} · {status}',
+                 status in OPEN_STATUSES, tokenize(subject))
+
+
+def team_entry(id, name, site_id):
+    return Entry('team', id, site_id, id, name, 'Team', True, tokenize(name))
+
+
+def user_entry(id, name, role, site_id):
+    return Entry('user', id, site_id, None, name, role, True, tokenize(name))
+
+
+def entry_for(obj):
+    """Index entry for an ORM object, or None for types that are not searched"""
+    if isinstance(obj, Equipment):
+        return equipment_entry(obj.id, obj.name, obj.serial_number, obj.department, obj.site_id,
+                               obj.team_id, obj.is_scrapped)
+    if isinstance(obj, MaintenanceRequest):
+        return request_entry(obj.id, obj.subject, obj.status, obj.site_id, obj.team_id)
+    if isinstance(obj, Team):
+        return team_entry(obj.id, obj.name, obj.site_id)
+    if isinstance(obj, User):
+        return user_entry(obj.id, obj.name, obj.role, obj.site_id)
+    return None
+
+
+class PrefixIndex:
+    """Sorted (token, key) pairs per site plus the entry behind each key"""
+
+    def __init__(self, entries=(), generation=0):
+        self.entries = {entry_key(entry): entry for entry in entries}
+        self.tokens = defaultdict(list)
+        for key, entry in self.entries.items():
+            self.tokens[entry.site_id].extend((token, key) for token in entry.tokens)
+        for pairs in self.tokens.values():
+            pairs.sort()
+        # Changes up to here are in this copy; own_generations maps later
+        # ones this process applied itself as it committed them to their key
+        self.generation = generation
+        self.own_generations = {}
+        self.expires = time.monotonic() + INDEX_TTL
+
+    def put(self, entry):
+        key = entry_key(entry)
+        self.remove(key)
+        self.entries[key] = entry
+        for token in entry.tokens:
+            bisect.insort(self.tokens[entry.site_id], (token, key))
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        pairs = self.tokens[entry.site_id]
+        for token in entry.tokens:
+            i = bisect.bisect_left(pairs, (token, key))
+            if i < len(pairs) and pairs[i] == (token, key):
+                del pairs[i]
+
+    def _prefix_range(self, pairs, prefix):
+        for token, key in islice(pairs, bisect.bisect_left(pairs, (prefix,)), None):
+            if not token.startswith(prefix):
+                return
+            yield token, key
+
+    def candidates(self, prefix, site_id=None, accept=None):
+        """Entries with a token starting with prefix, in token order.
+
+        site_id limits the scan to that site's rows and rows without a site;
+        accept() filters further. At most MAX_CANDIDATES accepted entries.
+        """
+        if site_id is None:
+            lists = list(self.tokens.values())
+        else:
+            lists = [self.tokens.get(site_id, ()), self.tokens.get(None, ())]
+        seen = set()
+        accepted = 0
+        for token, key in heapq.merge(*[self._prefix_range(pairs, prefix) for pairs in lists]):
+            if key in seen:
+                continue
+            seen.add(key)
+            entry = self.entries[key]
+            if accept is None or accept(entry):
+                yield entry
+                accepted += 1
+                if accepted == MAX_CANDIDATES:
+                    return
+
+    def is_expired(self):
+        return time.monotonic() > self.expires
+
+    def pending_changes(self):
+        """Foreign changes committed since this copy was made/caught up"""
+        return _generation.value - self.generation - len(self.own_generations)
+
+
+# ---------------------------------------------------------------------------
+# Building
+# ---------------------------------------------------------------------------
+
+def load_entries():
+    """Every searchable row, read as plain columns"""
+    entries = [team_entry(*row) for row in db.session.query(Team.id, Team.name, Team.site_id)]
+    entries += [user_entry(*row) for row in db.session.query(User.id, User.name, User.role, User.site_id)]
+
+    def load_site_rows():
+        rows = [equipment_entry(*row) for row in db.session.query(
+            Equipment.id, Equipment.name, Equipment.serial_number, Equipment.department,
+            Equipment.site_id, Equipment.team_id, Equipment.is_scrapped
+        )]
+        rows += [request_entry(*row) for row in db.session.query(
+            MaintenanceRequest.id, MaintenanceRequest.subject, MaintenanceRequest.status,
+            MaintenanceRequest.site_id, MaintenanceRequest.team_id
+        )]
+        return rows
+
+    for rows in for_each_database(load_site_rows):
+        entries += rows
+    return entries
+
+
+def build_index():
+    """(Re)build this process's index; needs an app context"""
+    global _index
+    # Read first: a commit that lands while loading makes the new copy stale
+    # rather than silently missing from it
+    generation = _generation.value
+    index = PrefixIndex(load_entries(), generation)
+    with _index_lock:
+        _index = index
+    return index
+
+
+def _log_change(kind, site_id, id):
+    """Append to the shared change log; returns the change's generation"""
+    with _generation.get_lock():
+        _generation.value += 1
+        slot = _generation.value % CHANGE_LOG_SIZE * 3
+        _change_log[slot:slot + 3] = [kind, site_id, id]
+        return _generation.value
+
+
+def _read_changes(since, until):
+    """Keys changed in generations (since, until], or None if they are not all in the log"""
+    changes = {}
+    with _generation.get_lock():
+        if _generation.value - since > CHANGE_LOG_SIZE:
+            return None  # partly overwritten already
+        for generation in range(since + 1, until + 1):
+            slot = generation % CHANGE_LOG_SIZE * 3
+            kind, site_id, id = _change_log[slot:slot + 3]
+            if kind == REBUILD:
+                return None
+            changes[generation] = (KINDS[kind], site_id, id)
+    return changes
+
+
+def load_changed(keys):
+    """Current entry (or None when deleted) for each key; needs an app context"""
+    by_site_kind = defaultdict(set)
+    for kind, site_id, id in keys:
+        by_site_kind[(site_id, kind)].add(id)
+
+    loaded = dict.fromkeys(keys)
+    previous = g.get('site_id'), g.get('db_site_engine')
+    try:
+        for (site_id, kind), ids in by_site_kind.items():
+            # Read with the row's own site active: scoping and per-site files
+            activate_site(site_id or None)
+            if kind == 'equipment':
+                rows = [equipment_entry(*row) for row in db.session.query(
+                    Equipment.id, Equipment.name, Equipment.serial_number, Equipment.department,
+                    Equipment.site_id, Equipment.team_id, Equipment.is_scrapped
+                ).filter(Equipment.id.in_(ids))]
+            elif kind == 'request':
+                rows = [request_entry(*row) for row in db.session.query(
+                    MaintenanceRequest.id, MaintenanceRequest.subject, MaintenanceRequest.status,
+                    MaintenanceRequest.site_id, MaintenanceRequest.team_id
+                ).filter(MaintenanceRequest.id.in_(ids))]
+            elif kind == 'team':
+                rows = [team_entry(*row) for row in db.session.query(Team.id, Team.name, Team.site_id)
+                        .filter(Team.id.in_(ids))]
+            else:
+                rows = [user_entry(*row) for row in db.session.query(User.id, User.name, User.role, User.site_id)
+                        .filter(User.id.in_(ids))]
+            for entry in rows:
+                key = entry_key(entry)
+                if key in loaded:
+                    loaded[key] = entry
+    finally:
+        g.site_id, g.db_site_engine = previous
+    return loaded
+
+
+def catch_up():
+    """Apply other processes' changes to this process's index; needs an app context"""
+    with _index_lock:
+        index = _index
+        since = index.generation
+        until = _generation.value
+        own = dict(index.own_generations)
+
+    changes = _read_changes(since, until)
+    if changes is None:
+        build_index()
+        return
+    foreign = {key for generation, key in changes.items() if generation not in own}
+    loaded = load_changed(foreign) if foreign else {}
+
+    with _index_lock:
+        if _index is not index:
+            return  # rebuilt meanwhile
+        # This process's own later commits are newer than what was just read
+        newer = {key for generation, key in index.own_generations.items() if generation > until}
+        for key, entry in loaded.items():
+            if key in newer:
+                continue
+            if entry is None:
+                index.remove(key)
+            else:
+                index.put(entry)
+        index.generation = until
+        index.own_generations = {generation: key for generation, key in index.own_generations.items()
+                                 if generation > until}
+
+
+def _refresh_in_background(app, rebuild):
+    if not _rebuild_lock.acquire(blocking=False):
+        return  # already running
+
+    def refresh():
+        try:
+            with app.app_context():
+                try:
+                    build_index() if rebuild else catch_up()
+                finally:
+                    db.session.remove()
+        except Exception:
+            app.logger.exception('Refreshing the search index failed')
+            with _index_lock:
+                if _index is not None:
+                    _index.expires = time.monotonic() + INDEX_TTL
+        finally:
+            _rebuild_lock.release()
+
+    threading.Thread(target=refresh, name='search-index', daemon=True).start()
+
+
+def mark_stale():
+    """Rebuild every process's index soon, after writes that bypassed the ORM"""
+    _log_change(REBUILD, 0, 0)
+
+
+# ---------------------------------------------------------------------------
+# Querying
+# ---------------------------------------------------------------------------
+
+def _score(entry, query, words):
+    label = entry.label.lower()
+    if label == query:
+        match = 0
+    elif label.startswith(query):
+        match = 1
+    elif all(word in entry.tokens for word in words):
+        match = 2
+    else:
+        match = 3
+    return (match, not entry.active, KINDS.index(entry.kind), len(entry.label), label, entry.id)
+
+
+def search(query, site_id=None, team_ids=None, limit=MAX_RESULTS):
+    """Best matches for a typed prefix.
+
+    site_id limits equipment, requests and teams to one site (users bound to
+    another site are left out too); team_ids, when given, limits requests to
+    those teams.
+    """
+    query = ' '.join(query.lower().split())
+    words = WORD.findall(query)
+    if len(query) < MIN_QUERY_LENGTH or not words:
+        return []
+
+    if _index is None:
+        build_index()
+    elif _index.is_expired():
+        _refresh_in_background(current_app._get_current_object(), rebuild=True)
+    else:
+        with _index_lock:
+            pending = _index.pending_changes()
+            if not pending and _index.own_generations:
+                # Nothing but this process's own commits: already applied
+                _index.generation = max(_index.own_generations)
+                _index.own_generations = {}
+        if pending:
+            _refresh_in_background(current_app._get_current_object(), rebuild=False)
+
+    anchor = max(words, key=len)
+    others = [word for word in words if word != anchor]
+
+    def accept(entry):
+        if team_ids is not None and entry.kind == 'request' and entry.team_id not in team_ids:
+            return False
+        return all(any(token.startswith(word) for token in entry.tokens) for word in others)
+
+    with _index_lock:
+        matches = list(_index.candidates(anchor, site_id, accept))
+
+    return heapq.nsmallest(limit, matches, key=lambda entry: _score(entry, query, words))
+
+
+# ---------------------------------------------------------------------------
+# Keeping the index current
+# ---------------------------------------------------------------------------
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _capture_search_changes(session, flush_context):
+    # Values are read here: after the commit they are expired
+    changes = session.info.setdefault('search_changes', [])
+    for obj in chain(session.new, session.dirty):
+        entry = entry_for(obj)
+        if entry is not None:
+            changes.append((entry_key(entry), entry))
+    for obj in session.deleted:
+        entry = entry_for(obj)
+        if entry is not None:
+            changes.append((entry_key(entry), None))
+    if not changes:
+        session.info.pop('search_changes')
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _apply_search_changes(session):
+    changes = session.info.pop('search_changes', None)
+    if not changes:
+        return
+    latest = dict(changes)  # the last state of each row in this transaction
+    with _index_lock:
+        for key, entry in latest.items():
+            kind, site_id, id = key
+            generation = _log_change(KINDS.index(kind), site_id, id)
+            if _index is None:
+                continue
+            _index.own_generations[generation] = key
+            if entry is None:
+                _index.remove(key)
+            else:
+                _index.put(entry)
+
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def _forget_search_changes(session, previous_transaction):
+    session.info.pop('search_changes', None)
@@ -0,0 +1,256 @@
+"""Service-level targets for maintenance requests.
+
+An SlaPolicy gives response and resolve targets in business minutes,
+counted on a BusinessCalendar (working days, hours and holidays in a local
+time zone). The most specific active policy for a request's type and team
+applies. Deadlines are computed when a request is created, and the response
+clock stops when it is first assigned or picked up; both happen in a
+before_flush hook, so every path that creates or assigns requests
+(forms, Kanban, JSON API, offline sync) is covered.
+
+SlaTimer keeps every pending deadline in a heap and sleeps until the
+earliest one, so breaches and escalations fire when they happen rather
+than when some job next scans all open requests. Each firing is a
+conditional UPDATE, so a request that was answered or closed in the
+meantime, or a second timer process, does nothing.
+
+The live state of every request is available in SQL through the
+request_sla_state view (models.SLA_STATE_VIEW_SQL).
+"""
+import heapq
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import event, inspect as inspect_state, or_, text
+
+from db_routing import RoutingSession
+from models import db, MaintenanceRequest, RequestSla, SlaPolicy
+from services.history import record_event
+from services.notifications import notify_sla_breached, notify_sla_escalated
+from sites import activate_site, current_site_id, for_each_database
+
+logger = logging.getLogger(__name__)
+
+OPEN_STATUSES = ('New', 'In Progress')
+
+# A calendar without a single working minute in this many days is invalid
+MAX_CALENDAR_DAYS = 3 * 366
+
+# kind -> (deadline column, column stamped when it fires, extra condition)
+TIMERS = {
+    'response': ('response_due_at', 'response_breached_at', 'AND responded_at IS NULL'),
+    'resolve': ('resolve_due_at', 'resolve_breached_at', ''),
+    'escalation': ('escalate_at', 'escalated_at', ''),
+}
+
+FIRE_SQL = """
+UPDATE request_slas SET {stamp} = :now
+WHERE id = :id AND {stamp} IS NULL AND {deadline} <= :now {condition}
+  AND request_id IN (SELECT id FROM maintenance_requests WHERE status IN ('New', 'In Progress'))
+"""
+
+
+# ---------------------------------------------------------------------------
+# Business-time arithmetic
+# ---------------------------------------------------------------------------
+
+def add_business_minutes(calendar, start, minutes):
+    """UTC datetime `minutes` working minutes after the UTC datetime `start`"""
+    zone = ZoneInfo(calendar.timezone)
+    workdays = {int(day) for day in calendar.workdays}
+    holidays = {holiday.date for holiday in calendar.holidays}
+    local = start.replace(tzinfo=timezone.utc).astimezone(zone).replace(tzinfo=None)
+    remaining = timedelta(minutes=minutes)
+
+    day = local.date()
+    for _ in range(MAX_CALENDAR_DAYS):
+        if day.isoweekday() in workdays and day not in holidays:
+            opens = datetime.combine(day, calendar.day_start)
+            closes = datetime.combine(day, calendar.day_end)
+            begin = max(opens, local)
+            if begin < closes:
+                if begin + remaining <= closes:
+                    due = (begin + remaining).replace(tzinfo=zone)
+                    return due.astimezone(timezone.utc).replace(tzinfo=None)
+                remaining -= closes - begin
+        day += timedelta(days=1)
+    raise ValueError(f'Calendar {calendar.name!r} has no working hours')
+
+
+def find_policy(request_type, team_id):
+    """Most specific active policy: type and team, then team, then type, then catch-all"""
+    candidates = SlaPolicy.query.filter(
+        SlaPolicy.is_active.is_(True),
+        or_(SlaPolicy.request_type == request_type, SlaPolicy.request_type.is_(None)),
+        or_(SlaPolicy.team_id == team_id, SlaPolicy.team_id.is_(None))
+    ).all()
+    if not candidates:
+        return None
+    return max(candidates, key=lambda policy: (policy.team_id is not None,
+                                               policy.request_type is not None,
+                                               -policy.id))
+
+
+def start_sla(maintenance_request, started_at):
+    """Attach deadlines from the matching policy (no-op when none applies)"""
+    policy = find_policy(maintenance_request.request_type, maintenance_request.team_id)
+    if policy is None:
+        return None
+
+    calendar = policy.calendar
+    resolve_due = add_business_minutes(calendar, started_at, policy.resolve_minutes)
+    maintenance_request.sla = RequestSla(
+        policy_id=policy.id,
+        response_due_at=add_business_minutes(calendar, started_at, policy.response_minutes),
+        resolve_due_at=resolve_due,
+        escalate_at=add_business_minutes(calendar, resolve_due, policy.escalate_after_minutes)
+        if policy.escalate_after_minutes is not None else None
+    )
+    # A hand-typed due date still wins
+    if maintenance_request.due_date is None:
+        zone = ZoneInfo(calendar.timezone)
+        maintenance_request.due_date = resolve_due.replace(tzinfo=timezone.utc).astimezone(zone).date()
+    return maintenance_request.sla
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _apply_slas(session, flush_context, instances):
+    """Start the clocks of new requests and stop the response clock on pickup"""
+    now = datetime.utcnow()
+    for obj in list(session.new):
+        if isinstance(obj, MaintenanceRequest) and obj.sla is None:
+            start_sla(obj, obj.created_at or now)
+
+    for obj in list(session.dirty):
+        if not isinstance(obj, MaintenanceRequest):
+            continue
+        attrs = inspect_state(obj).attrs
+        changed = attrs.assigned_technician_id.history.has_changes() or attrs.status.history.has_changes()
+        if not changed or (obj.assigned_technician_id is None and obj.status == 'New'):
+            continue
+        sla = obj.sla
+        if sla is None:
+            # Requests from before SLAs existed get one on their first assignment
+            sla = start_sla(obj, obj.created_at or now)
+        if sla is not None and sla.responded_at is None:
+            sla.responded_at = now
+
+
+def get_sla_state(request_id):
+    """One request's row of the request_sla_state view, or None without an SLA"""
+    return db.session.execute(
+        text('SELECT * FROM request_sla_state WHERE request_id = :id'), {'id': request_id}
+    ).mappings().first()
+
+
+# ---------------------------------------------------------------------------
+# Breach timer
+# ---------------------------------------------------------------------------
+
+def fire(sla_id, kind):
+    """Mark one deadline as missed; returns True if this call did it"""
+    deadline, stamp, condition = TIMERS[kind]
+    # Same text format SQLAlchemy stores DateTime in, so the comparison is exact
+    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+    result = db.session.execute(text(FIRE_SQL.format(stamp=stamp, deadline=deadline, condition=condition)),
+                                {'id': sla_id, 'now': now})
+    if result.rowcount != 1:
+        db.session.rollback()
+        return False
+
+    sla = db.session.get(RequestSla, sla_id)
+    maintenance_request = db.session.get(MaintenanceRequest, sla.request_id)
+    if kind == 'escalation':
+        record_event(maintenance_request, 'sla_escalated', None)
+        notify_sla_escalated(maintenance_request)
+    else:
+        record_event(maintenance_request, 'sla_breached', None, target=kind)
+        notify_sla_breached(maintenance_request, kind)
+    db.session.commit()
+    return True
+
+
+def pending_deadlines(after_id=0):
+    """(deadline, sla id, kind) still to fire for rows with id > after_id, and the highest id seen"""
+    # Upper bound first, so a row committed while this runs is left for the next call
+    newest = db.session.query(db.func.max(RequestSla.id)).scalar() or 0
+    rows = db.session.query(RequestSla).join(
+        MaintenanceRequest, MaintenanceRequest.id == RequestSla.request_id
+    ).filter(
+        RequestSla.id > after_id,
+        RequestSla.id <= newest,
+        MaintenanceRequest.status.in_(OPEN_STATUSES)
+    ).all()
+
+    deadlines = []
+    for sla in rows:
+        for kind, (deadline, stamp, _) in TIMERS.items():
+            if getattr(sla, deadline) is None or getattr(sla, stamp) is not None:
+                continue
+            if kind == 'response' and sla.responded_at is not None:
+                continue
+            deadlines.append((getattr(sla, deadline), sla.id, kind))
+    return deadlines, max(newest, after_id)
+
+
+class SlaTimer(threading.Thread):
+    """Fires SLA breach and escalation events at their deadlines.
+
+    The heap is filled once at start; afterwards only SLA rows newer than
+    the last one seen are read, every SLA_TIMER_POLL_SECONDS. Entries whose
+    request was answered or closed meanwhile are dropped when they fire.
+    """
+
+    def __init__(self, app):
+        super().__init__(name='sla-timer', daemon=True)
+        self.app = app
+        self._stop_event = threading.Event()
+        self._heap = []
+        self._watermarks = {}
+
+    def _load(self):
+        def load():
+            site_key = current_site_id()
+            deadlines, newest = pending_deadlines(self._watermarks.get(site_key, 0))
+            self._watermarks[site_key] = newest
+            return site_key, deadlines
+
+        for site_key, deadlines in for_each_database(load):
+            for due_at, sla_id, kind in deadlines:
+                heapq.heappush(self._heap, (due_at, site_key, sla_id, kind))
+        db.session.remove()
+
+    def _fire_due(self):
+        while self._heap and self._heap[0][0] <= datetime.utcnow():
+            _, site_key, sla_id, kind = heapq.heappop(self._heap)
+            activate_site(site_key)
+            try:
+                fire(sla_id, kind)
+            finally:
+                db.session.remove()
+
+    def run(self):
+        poll_seconds = self.app.config.get('SLA_TIMER_POLL_SECONDS', 30)
+        next_load = datetime.utcnow()
+
+        while not self._stop_event.is_set():
+            with self.app.app_context():
+                try:
+                    if datetime.utcnow() >= next_load:
+                        self._load()
+                        next_load = datetime.utcnow() + timedelta(seconds=poll_seconds)
+                    self._fire_due()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception('SLA timer iteration failed')
+                finally:
+                    db.session.remove()
+
+            # Sleep until the earliest deadline or the next look for new rows
+            wake_at = min(self._heap[0][0], next_load) if self._heap else next_load
+            self._stop_event.wait(max((wake_at - datetime.utcnow()).total_seconds(), 0))
+
+    def stop(self):
+        self._stop_event.set()
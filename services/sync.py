@@ -0,0 +1,246 @@
+"""Offline sync for technician clients.
+
+A client downloads its teams' open requests once together with a cursor,
+then asks for changes since that cursor. Every ORM write to a request adds a
+RequestChange row in the same transaction (models._log_request_changes), so
+a delta is one range scan on (team_id, id) plus one fetch of the changed
+rows: sync traffic follows what changed, not the size of the backlog.
+Requests that were deleted, closed or moved to another team come back as
+tombstones.
+
+Mutations queued while offline are uploaded as one batch and applied in a
+single transaction. Each carries the version the client last saw; a stale
+one is reported per item as a conflict and the rest of the batch still
+applies. Replaying a batch after a lost response is safe: items that were
+already applied come back as conflicts instead of being applied twice.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from models import db, MaintenanceRequest, RequestChange, User
+from services.concurrency import VersionConflict, check_version
+from services.history import record_event
+from services.notifications import notify_assigned, notify_status_changed
+
+OPEN_STATUSES = ('New', 'In Progress')
+STATUSES = ('New', 'In Progress', 'Repaired', 'Scrap')
+MAX_BATCH = 500
+
+EDITABLE_FIELDS = ('subject', 'description', 'scheduled_date', 'due_date', 'duration', 'notes')
+# Text columns that are NOT NULL, and those that may be cleared
+REQUIRED_TEXT_FIELDS = ('subject', 'description')
+OPTIONAL_TEXT_FIELDS = ('notes',)
+
+
+class CursorExpired(Exception):
+    """The client's cursor predates the retained change log; it must bootstrap again"""
+
+
+class BatchRetry(Exception):
+    """A concurrent write interleaved with the batch; nothing was applied"""
+
+
+class MutationRejected(Exception):
+    """A mutation that is invalid or not allowed for this user"""
+
+
+class FlushRejected(Exception):
+    """The database refused a mutation's changes; carries its result"""
+
+    def __init__(self, result):
+        super().__init__(result['error'])
+        self.result = result
+
+
+def latest_cursor():
+    return db.session.query(func.max(RequestChange.id)).scalar() or 0
+
+
+def changes_since(cursor, team_ids, limit):
+    """Ids of requests changed after cursor in these teams -> (ids, next_cursor, has_more)"""
+    oldest = db.session.query(func.min(RequestChange.id)).scalar()
+    if cursor and oldest is not None and cursor + 1 < oldest:
+        raise CursorExpired()
+
+    # Read the high-water mark first so a quiet team's cursor still advances
+    latest = latest_cursor()
+    changes = db.session.query(RequestChange.id, RequestChange.request_id).filter(
+        RequestChange.team_id.in_(team_ids),
+        RequestChange.id > cursor,
+        RequestChange.id <= latest
+    ).order_by(RequestChange.id).limit(limit).all()
+
+    has_more = len(changes) == limit
+    next_cursor = changes[-1][0] if has_more else max(latest, cursor)
+    request_ids = list(dict.fromkeys(request_id for _, request_id in changes))
+    return request_ids, next_cursor, has_more
+
+
+def prune_changes(days):
+    """Delete change rows older than days, always keeping the newest one"""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    newest = latest_cursor()
+    deleted = RequestChange.query.filter(
+        RequestChange.changed_at < cutoff,
+        RequestChange.id < newest
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+    except (TypeError, ValueError):
+        raise MutationRejected(f'Invalid date: {value!r}')
+
+
+def _update_status(maintenance_request, data, user):
+    new_status = data.get('status')
+    if new_status not in STATUSES:
+        raise MutationRejected(f'Invalid status: {new_status!r}')
+    if not (user.is_manager() or maintenance_request.assigned_technician_id == user.id):
+        raise MutationRejected('You do not have permission to update this request')
+
+    old_status = maintenance_request.status
+    if new_status == old_status:
+        return
+    maintenance_request.status = new_status
+    if new_status in ['Repaired', 'Scrap'] and old_status not in ['Repaired', 'Scrap']:
+        maintenance_request.completed_at = datetime.utcnow()
+
+    payload = {}
+    if new_status == 'Scrap':
+        maintenance_request.equipment.is_scrapped = True
+        payload['equipment_scrapped'] = maintenance_request.equipment_id
+
+    record_event(maintenance_request, 'status_changed', user,
+                 from_status=old_status, to_status=new_status, **payload)
+    notify_status_changed(maintenance_request, old_status, new_status, actor=user)
+
+
+def _assign(maintenance_request, data, user):
+    technician_id = data.get('technician_id')
+    if not isinstance(technician_id, int):
+        raise MutationRejected('technician_id is required')
+    if not user.is_manager() and technician_id != user.id:
+        raise MutationRejected('You can only assign yourself')
+
+    technician = db.session.get(User, technician_id)
+    if technician is None or maintenance_request.team_id not in [team.id for team in technician.teams]:
+        raise MutationRejected('Technician is not part of the maintenance team')
+
+    old_status = maintenance_request.status
+    previous_technician_id = maintenance_request.assigned_technician_id
+    maintenance_request.assigned_technician_id = technician.id
+    if maintenance_request.status == 'New':
+        maintenance_request.status = 'In Progress'
+
+    record_event(maintenance_request, 'assigned', user,
+                 from_status=old_status, to_status=maintenance_request.status,
+                 technician_id=technician.id,
+                 previous_technician_id=previous_technician_id)
+    notify_assigned(maintenance_request, technician)
+
+
+def _edit(maintenance_request, data, user):
+    if not (user.is_manager() or
+            maintenance_request.created_by_id == user.id or
+            maintenance_request.assigned_technician_id == user.id):
+        raise MutationRejected('You do not have permission to edit this request')
+
+    unknown = set(data) - set(EDITABLE_FIELDS)
+    if unknown:
+        raise MutationRejected(f"Fields cannot be edited: {', '.join(sorted(unknown))}")
+    for name in REQUIRED_TEXT_FIELDS:
+        if name in data and not (isinstance(data[name], str) and data[name].strip()):
+            raise MutationRejected(f'{name.capitalize()} is required and must be text')
+    for name in OPTIONAL_TEXT_FIELDS:
+        if data.get(name) is not None and not isinstance(data[name], str):
+            raise MutationRejected(f'{name.capitalize()} must be text')
+
+    # Validate everything before touching the row
+    values = dict(data)
+    for name in ('scheduled_date', 'due_date'):
+        if name in values:
+            values[name] = _parse_date(values[name])
+    if values.get('duration') is not None:
+        try:
+            if isinstance(values['duration'], bool):
+                raise TypeError()
+            values['duration'] = float(values['duration'])
+        except (TypeError, ValueError):
+            raise MutationRejected(f"Invalid duration: {values['duration']!r}")
+
+    for name, value in values.items():
+        setattr(maintenance_request, name, value)
+
+
+OPERATIONS = {
+    'update_status': _update_status,
+    'assign': _assign,
+    'edit': _edit,
+}
+
+
+def _apply(mutation, user):
+    result = {'client_id': mutation.get('client_id'), 'id': mutation.get('id')}
+
+    operation = OPERATIONS.get(mutation.get('op'))
+    if operation is None:
+        return dict(result, status='rejected', error=f"Unknown op: {mutation.get('op')!r}")
+
+    maintenance_request = db.session.get(MaintenanceRequest, mutation.get('id')) \
+        if isinstance(mutation.get('id'), int) else None
+    if maintenance_request is None:
+        return dict(result, status='rejected', error='Request not found')
+
+    data = mutation.get('data') or {}
+    try:
+        # Without it a replayed mutation would be applied a second time
+        if mutation.get('version') is None:
+            raise MutationRejected('Mutations must carry the version they were based on')
+        if not isinstance(data, dict):
+            raise MutationRejected('data must be an object')
+        check_version(maintenance_request, mutation.get('version'))
+        operation(maintenance_request, data, user)
+    except VersionConflict:
+        return dict(result, status='conflict', version=maintenance_request.version)
+    except (MutationRejected, ValueError, TypeError) as e:
+        return dict(result, status='rejected', error=str(e))
+
+    # Bumps the version, so a later mutation of the same request in this
+    # batch is checked against the result of this one
+    try:
+        db.session.flush()
+    except IntegrityError as e:
+        raise FlushRejected(dict(result, status='rejected', error=f'Invalid values: {e.orig}'))
+    return dict(result, status='applied', version=maintenance_request.version)
+
+
+def apply_mutations(mutations, user):
+    """Apply a batch in one transaction; returns one result per mutation, in order.
+
+    No savepoints: pysqlite releases the outermost savepoint as a commit.
+    Every check runs before a mutation changes anything, so a rejected or
+    conflicting item leaves nothing behind to undo. An item the database
+    itself refuses rolls the transaction back; the batch is then replayed
+    with that item rejected (at most once per item).
+    """
+    mutations = [mutation if isinstance(mutation, dict) else {} for mutation in mutations]
+    refused = {}
+    while True:
+        try:
+            results = []
+            for i, mutation in enumerate(mutations):
+                results.append(refused[i] if i in refused else _apply(mutation, user))
+            db.session.commit()
+            return results
+        except FlushRejected as e:
+            db.session.rollback()
+            refused[len(results)] = e.result
+        except StaleDataError:
+            db.session.rollback()
+            raise BatchRetry()
@@ -0,0 +1,145 @@
+"""Multi-month request trends by team and request type.
+
+Everything comes from one aggregate: teams LEFT JOIN requests, grouped by
+team, strftime('%Y-%m', created_at) and request_type. The cost is one query
+no matter how many months or teams are requested; Python only pivots the
+grouped rows into chart-ready series. Cross-site reports run get_trends()
+once per site and combine the results with merge_trends().
+"""
+from datetime import datetime
+
+from sqlalchemy import func, case, and_
+from models import db, Team, MaintenanceRequest
+
+SERIES = ('total', 'completed', 'hours', 'corrective', 'preventive')
+
+
+def parse_month(value):
+    """'YYYY-MM' -> (year, month)"""
+    parsed = datetime.strptime(value, '%Y-%m')
+    return parsed.year, parsed.month
+
+
+def add_months(year, month, count):
+    index = year * 12 + (month - 1) + count
+    return index // 12, index % 12 + 1
+
+
+def month_range(start, end):
+    """Inclusive list of 'YYYY-MM' labels from start to end ((year, month) tuples)"""
+    months = []
+    year, month = start
+    while (year, month) <= end:
+        months.append(f'{year:04d}-{month:02d}')
+        year, month = add_months(year, month, 1)
+    return months
+
+
+def _empty_series(size):
+    return {name: [0] * size for name in SERIES}
+
+
+def get_trends(start, end, year_over_year=False):
+    """Monthly series per team and overall for months start..end (inclusive).
+
+    With year_over_year the same months one year earlier are fetched in the
+    same query and returned under 'previous_year'.
+    """
+    months = month_range(start, end)
+    first = add_months(*start, -12) if year_over_year else start
+    range_start = datetime(*first, 1)
+    range_end = datetime(*add_months(*end, 1), 1)
+
+    month = func.strftime('%Y-%m', MaintenanceRequest.created_at)
+    repaired = MaintenanceRequest.status == 'Repaired'
+
+    rows = db.session.query(
+        Team.id,
+        Team.name,
+        month.label('month'),
+        MaintenanceRequest.request_type,
+        func.count(MaintenanceRequest.id),
+        func.sum(case((repaired, 1), else_=0)),
+        func.sum(case((repaired, func.coalesce(MaintenanceRequest.duration, 0)), else_=0))
+    ).outerjoin(MaintenanceRequest, and_(
+        MaintenanceRequest.team_id == Team.id,
+        MaintenanceRequest.created_at >= range_start,
+        MaintenanceRequest.created_at < range_end
+    )).group_by(
+        Team.id, Team.name, month, MaintenanceRequest.request_type
+    ).order_by(Team.name).all()
+
+    previous_months = [f'{int(m[:4]) - 1:04d}{m[4:]}' for m in months]
+    position = {m: i for i, m in enumerate(months)}
+    previous_position = {m: i for i, m in enumerate(previous_months)}
+
+    teams = {}
+    totals = _empty_series(len(months))
+    previous_totals = _empty_series(len(months))
+
+    for team_id, team_name, row_month, request_type, total, completed, hours in rows:
+        team = teams.setdefault(team_id, {
+            'id': team_id,
+            'name': team_name,
+            'series': _empty_series(len(months)),
+            'previous_year': _empty_series(len(months)) if year_over_year else None,
+        })
+        if row_month is None:
+            # Team without requests in the range (outer join)
+            continue
+
+        if row_month in position:
+            targets, index = (team['series'], totals), position[row_month]
+        elif year_over_year and row_month in previous_position:
+            targets, index = (team['previous_year'], previous_totals), previous_position[row_month]
+        else:
+            continue
+
+        for series in targets:
+            series['total'][index] += total
+            series['completed'][index] += completed or 0
+            series['hours'][index] += round(hours or 0, 2)
+            if request_type == 'Corrective':
+                series['corrective'][index] += total
+            elif request_type == 'Preventive':
+                series['preventive'][index] += total
+
+    result = {
+        'months': months,
+        'teams': list(teams.values()),
+        'totals': totals,
+    }
+    if year_over_year:
+        result['previous_year'] = {'months': previous_months, 'totals': previous_totals}
+    else:
+        for team in result['teams']:
+            del team['previous_year']
+    return result
+
+
+def merge_trends(per_site):
+    """Combine [(site, get_trends() result)] from for_each_site() into one result"""
+    merged = None
+    for site, result in per_site:
+        if merged is None:
+            merged = {
+                'months': result['months'],
+                'teams': [],
+                'totals': _empty_series(len(result['months'])),
+            }
+            if 'previous_year' in result:
+                merged['previous_year'] = {
+                    'months': result['previous_year']['months'],
+                    'totals': _empty_series(len(result['months'])),
+                }
+
+        for team in result['teams']:
+            merged['teams'].append(dict(team, site=site.name))
+
+        sums = [(merged['totals'], result['totals'])]
+        if 'previous_year' in result:
+            sums.append((merged['previous_year']['totals'], result['previous_year']['totals']))
+        for target, source in sums:
+            for name in SERIES:
+                target[name] = [round(a + b, 2) for a, b in zip(target[name], source[name])]
+    return merged
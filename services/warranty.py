@@ -0,0 +1,75 @@
+"""Warranty tracking: assets about to lapse, and repairs that should be free.
+
+Equipment.warranty_expiry is indexed, so "expiring within N days" is a
+range scan over that index however large the fleet is. The daily digest
+makes one such scan per database, groups the rows by team in memory and
+mails each team its list; it never reads equipment outside the window.
+
+Corrective requests raised on equipment that is still under warranty are
+flagged (MaintenanceRequest.under_warranty) in a before_flush hook, so
+every path that creates requests (forms, JSON API, offline sync) is
+covered, and the flag records the warranty state when the fault was
+reported rather than when someone looks at it.
+"""
+from collections import defaultdict
+from datetime import date, timedelta
+
+from sqlalchemy import event
+
+from db_routing import RoutingSession
+from models import db, Equipment, MaintenanceRequest, Team
+from services.notifications import notify_warranty_digest
+
+
+def expiring_within(days, today=None):
+    """Criteria for equipment in service whose warranty ends in the next `days` days"""
+    today = today or date.today()
+    return (Equipment.warranty_expiry >= today,
+            Equipment.warranty_expiry <= today + timedelta(days=days),
+            Equipment.is_scrapped.is_(False))
+
+
+def warranty_filter(query, state, days, today=None):
+    """Apply the equipment-list warranty filter: expiring, active, expired or none"""
+    today = today or date.today()
+    if state == 'expiring':
+        return query.filter(*expiring_within(days, today))
+    if state == 'active':
+        return query.filter(Equipment.warranty_expiry >= today)
+    if state == 'expired':
+        return query.filter(Equipment.warranty_expiry < today)
+    if state == 'none':
+        return query.filter(Equipment.warranty_expiry.is_(None))
+    return query
+
+
+def send_digests(days, today=None):
+    """Queue one digest per team with equipment lapsing within `days` days.
+
+    Works on the active database (use sites.for_each_database for all of
+    them); returns (teams notified, equipment listed).
+    """
+    today = today or date.today()
+    rows = db.session.query(
+        Equipment.team_id, Equipment.id, Equipment.name, Equipment.serial_number, Equipment.warranty_expiry
+    ).filter(*expiring_within(days, today)).order_by(Equipment.warranty_expiry).all()
+
+    by_team = defaultdict(list)
+    for team_id, *item in rows:
+        by_team[team_id].append(item)
+
+    for team in Team.query.filter(Team.id.in_(by_team)).all():
+        notify_warranty_digest(team, by_team[team.id], days, today)
+    db.session.commit()
+    return len(by_team), len(rows)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _flag_warranty_repairs(session, flush_context, instances):
+    """Mark new corrective requests on equipment that is under warranty"""
+    for obj in list(session.new):
+        if not isinstance(obj, MaintenanceRequest) or obj.request_type != 'Corrective':
+            continue
+        equipment = obj.equipment or (session.get(Equipment, obj.equipment_id) if obj.equipment_id else None)
+        if equipment is not None and equipment.in_warranty():
+            obj.under_warranty = True
@@ -0,0 +1,61 @@
+"""A technician's own queue of open requests ("My Work").
+
+Everything here is answered from ix_maintenance_requests_technician_status_due
+on (assigned_technician_id, status, due_date): the queue is an index range
+per open status, the status counters are a count over the technician's
+index entries, and the overdue count is a due_date range inside that. None
+of it reads other technicians' rows, so the cost follows the size of one
+person's queue, not of the global backlog.
+
+Order: overdue first, then corrective before preventive work (the same
+ranking as MaintenanceRequest.get_priority_class), then by scheduled date
+and due date, undated work last.
+"""
+from datetime import date
+
+from sqlalchemy import case, func
+
+from models import db, MaintenanceRequest
+
+OPEN_STATUSES = ('New', 'In Progress')
+STATUSES = ('New', 'In Progress', 'Repaired', 'Scrap')
+
+# Nobody works through more than this at once; keeps a runaway queue cheap
+MAX_ITEMS = 200
+
+
+def queue_order(today=None):
+    """ORDER BY for open requests: priority, overdue, scheduled date"""
+    today = today or date.today()
+    priority = case(
+        (MaintenanceRequest.due_date < today, 0),
+        (MaintenanceRequest.request_type == 'Corrective', 1),
+        else_=2
+    )
+    return (priority,
+            MaintenanceRequest.scheduled_date.is_(None), MaintenanceRequest.scheduled_date,
+            MaintenanceRequest.due_date.is_(None), MaintenanceRequest.due_date,
+            MaintenanceRequest.id)
+
+
+def work_queue(query, technician_id, today=None):
+    """Restrict and order a MaintenanceRequest query to a technician's open work"""
+    return query.filter(
+        MaintenanceRequest.assigned_technician_id == technician_id,
+        MaintenanceRequest.status.in_(OPEN_STATUSES)
+    ).order_by(*queue_order(today)).limit(MAX_ITEMS)
+
+
+def status_counts(technician_id, today=None):
+    """{'New': n, 'In Progress': n, 'Repaired': n, 'Scrap': n, 'Overdue': n} of one technician"""
+    today = today or date.today()
+    counts = dict.fromkeys(STATUSES, 0)
+    counts.update(db.session.query(MaintenanceRequest.status, func.count()).filter(
+        MaintenanceRequest.assigned_technician_id == technician_id
+    ).group_by(MaintenanceRequest.status).all())
+    counts['Overdue'] = db.session.query(func.count()).select_from(MaintenanceRequest).filter(
+        MaintenanceRequest.assigned_technician_id == technician_id,
+        MaintenanceRequest.status.in_(OPEN_STATUSES),
+        MaintenanceRequest.due_date < today
+    ).scalar()
+    return counts
@@ -0,0 +1,193 @@
+"""Multi-site scoping and optional per-site storage.
+
+Teams, equipment and maintenance requests carry a site_id (models.SiteScoped).
+Each request works in one site: a user's own site, or for users without one
+the site picked in the sidebar (or all sites, with shared storage). Every ORM
+SELECT/UPDATE/DELETE in that request gets ``site_id = :site`` added through
+with_loader_criteria, so blueprint queries, get_or_404() and the JSON API are
+scoped without each of them repeating the filter.
+
+SITE_STORAGE selects where the site-local tables live:
+
+* ``shared`` (default): one database, rows partitioned by the indexed site_id.
+* ``per_site``: each site's SITE_TABLES live in their own SQLite file
+  (site-<id>.db in SITE_DATABASE_DIR). The primary file is attached to every
+  site connection, so users, teams and the outbox still resolve and joins
+  work unchanged, while each plant writes to its own file and lock.
+
+Cross-site reports call for_each_site() and merge the per-site results.
+To switch an existing database to per_site storage, set SITE_STORAGE and
+run ``flask --app app split-sites`` once; it moves each site's rows out of
+the primary into that site's file.
+"""
+import os
+import threading
+
+from flask import current_app, g, has_app_context, session as http_session
+from flask_login import current_user
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import with_loader_criteria
+
+from db_routing import RoutingSession
+from models import db, Site, SiteScoped, DEFAULT_SITE_ID
+from schema import ensure_site_schema
+
+SITE_SESSION_KEY = 'site_id'
+ALL_SITES = 'all'
+
+# Tables stored in the per-site files; everything else stays in the primary
+SITE_TABLES = ('equipment', 'maintenance_requests', 'request_events', 'equipment_risk', 'request_changes',
+               'equipment_closure', 'stock_ledger', 'stock_balances', 'part_reservations', 'attachments',
+               'request_slas')
+
+# How to find one site's rows of each site table in the primary database
+SITE_ROW_FILTERS = {
+    'equipment': 'site_id = :site_id',
+    'maintenance_requests': 'site_id = :site_id',
+    'request_events': 'request_id IN (SELECT id FROM shared.maintenance_requests WHERE site_id = :site_id)',
+    'equipment_risk': 'equipment_id IN (SELECT id FROM shared.equipment WHERE site_id = :site_id)',
+    'request_changes': 'team_id IN (SELECT id FROM shared.teams WHERE site_id = :site_id)',
+    'equipment_closure': 'descendant_id IN (SELECT id FROM shared.equipment WHERE site_id = :site_id)',
+    'stock_ledger': 'location_id IN (SELECT id FROM shared.stock_locations WHERE site_id = :site_id)',
+    'stock_balances': 'location_id IN (SELECT id FROM shared.stock_locations WHERE site_id = :site_id)',
+    'part_reservations': 'location_id IN (SELECT id FROM shared.stock_locations WHERE site_id = :site_id)',
+    'attachments': 'request_id IN (SELECT id FROM shared.maintenance_requests WHERE site_id = :site_id) '
+                   'OR equipment_id IN (SELECT id FROM shared.equipment WHERE site_id = :site_id)',
+    'request_slas': 'request_id IN (SELECT id FROM shared.maintenance_requests WHERE site_id = :site_id)',
+}
+
+_engines_lock = threading.Lock()
+
+
+def per_site_storage():
+    return current_app.config.get('SITE_STORAGE', 'shared') == 'per_site'
+
+
+def current_site_id():
+    """Site the current request is scoped to, or None for all sites"""
+    return g.get('site_id') if has_app_context() else None
+
+
+def site_engine(site_id):
+    """Engine for one site's database file (per_site storage only)"""
+    engines = current_app.extensions.setdefault('site_engines', {})
+    engine = engines.get(site_id)
+    if engine is not None:
+        return engine
+
+    with _engines_lock:
+        if site_id not in engines:
+            engines[site_id] = _create_site_engine(site_id)
+        return engines[site_id]
+
+
+def _create_site_engine(site_id):
+    primary = db.engines[None]
+    if primary.dialect.name != 'sqlite':
+        raise RuntimeError('Per-site storage requires a SQLite primary database')
+
+    directory = current_app.config.get('SITE_DATABASE_DIR') or current_app.instance_path
+    os.makedirs(directory, exist_ok=True)
+    engine = create_engine(f"sqlite:///{os.path.join(directory, f'site-{site_id}.db')}")
+
+    @event.listens_for(engine, 'connect')
+    def attach_primary(dbapi_connection, connection_record):
+        # Unqualified names resolve to the site file first, then to the primary
+        dbapi_connection.execute('ATTACH DATABASE ? AS shared', (primary.url.database,))
+
+    ensure_site_schema(engine, db.metadata, SITE_TABLES)
+    return engine
+
+
+def activate_site(site_id):
+    """Scope (and with per_site storage, route) the rest of this context to a site"""
+    g.site_id = site_id
+    g.db_site_engine = site_engine(site_id) if site_id and per_site_storage() else None
+
+
+def for_each_site(fn):
+    """Run fn() once per site with that site active; returns [(site, result)]"""
+    previous = g.get('site_id'), g.get('db_site_engine')
+    results = []
+    try:
+        for site in Site.query.order_by(Site.name).all():
+            activate_site(site.id)
+            results.append((site, fn()))
+    finally:
+        g.site_id, g.db_site_engine = previous
+    return results
+
+
+def for_each_database(fn):
+    """Run a whole-table job once per database that holds site data"""
+    if per_site_storage():
+        return [result for _, result in for_each_site(fn)]
+    return [fn()]
+
+
+def split_into_site_files():
+    """Move site rows from the primary into the per-site files; returns rows moved per table.
+
+    Copies use INSERT OR IGNORE and the primary is only cleared after every
+    site has been copied, so an interrupted run can simply be repeated.
+    """
+    moved = dict.fromkeys(SITE_TABLES, 0)
+    for site in Site.query.order_by(Site.id).all():
+        with site_engine(site.id).begin() as connection:
+            for table in SITE_TABLES:
+                columns = ', '.join(column.name for column in db.metadata.tables[table].columns)
+                result = connection.execute(text(
+                    f'INSERT OR IGNORE INTO main.{table} ({columns}) '
+                    f'SELECT {columns} FROM shared.{table} WHERE {SITE_ROW_FILTERS[table]}'
+                ), {'site_id': site.id})
+                moved[table] += result.rowcount
+
+    # Children before parents
+    with db.engines[None].begin() as connection:
+        for table in reversed(SITE_TABLES):
+            connection.execute(text(f'DELETE FROM {table}'))
+    return moved
+
+
+def _requested_site_id():
+    if current_user.site_id:
+        return current_user.site_id
+
+    chosen = http_session.get(SITE_SESSION_KEY)
+    if chosen == ALL_SITES and not per_site_storage():
+        return None
+    if isinstance(chosen, int):
+        return chosen
+    # Per-site storage has no merged view of the site tables outside reports
+    return DEFAULT_SITE_ID if per_site_storage() else None
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _scope_to_site(orm_execute_state):
+    site_id = current_site_id()
+    if site_id is None or orm_execute_state.is_column_load or orm_execute_state.is_relationship_load:
+        return
+    if orm_execute_state.is_select or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.statement = orm_execute_state.statement.options(
+            with_loader_criteria(SiteScoped, lambda cls: cls.site_id == site_id, include_aliases=True)
+        )
+
+
+def init_sites(app):
+
+    @app.before_request
+    def select_site():
+        g.site_id = None
+        g.db_site_engine = None
+        if current_user.is_authenticated:
+            activate_site(_requested_site_id())
+
+    @app.context_processor
+    def inject_sites():
+        if not current_user.is_authenticated or current_user.site_id:
+            return {'current_site_id': current_site_id()}
+        return {
+            'current_site_id': current_site_id(),
+            'switchable_sites': Site.query.order_by(Site.name).all(),
+            'can_view_all_sites': not per_site_storage(),
+        }
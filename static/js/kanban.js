@@ -73,9 +73,10 @@ function handleDrop(e) {
   const cardId = draggedCard.dataset.id
 
   // Update card status via AJAX
-  updateCardStatus(cardId, newStatus).then((success) => {
-    if (success) {
+  updateCardStatus(cardId, newStatus, draggedCard.dataset.version).then((result) => {
+    if (result.success) {
       // Move card to new column
+      draggedCard.dataset.version = result.version
       this.appendChild(draggedCard)
 
       // Update count badges
@@ -83,29 +84,44 @@ function handleDrop(e) {
 
       // Show success message
       showToast("Status updated successfully!", "success")
+    } else if (result.current) {
+      // Someone else changed the card first: show where it really is now
+      const card = draggedCard
+      card.dataset.version = result.current.version
+      const actual = document.querySelector(`.kanban-column[data-status="${result.current.status}"] .kanban-cards`)
+      if (actual) {
+        actual.appendChild(card)
+      }
+      updateColumnCounts()
+      showToast(`Request was changed by someone else (now ${result.current.status})`, "warning")
     } else {
-      showToast("Failed to update status", "danger")
+      showToast(result.message || "Failed to update status", "danger")
     }
   })
 
   return false
 }
 
-async function updateCardStatus(cardId, newStatus) {
+async function updateCardStatus(cardId, newStatus, version) {
   try {
     const response = await fetch(`/requests/api/update-status/${cardId}`, {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
       },
-      body: JSON.stringify({ status: newStatus }),
+      body: JSON.stringify({ status: newStatus, version: Number(version) }),
     })
 
-    const data = await response.json()
-    return data.success
+    // Throttled or shed: tell the user when to retry instead of retrying at once
+    if (response.status === 429 || response.status === 503) {
+      const wait = response.headers.get("Retry-After") || 1
+      return { success: false, message: `Too many updates. Try again in ${wait} s.` }
+    }
+
+    return await response.json()
   } catch (error) {
     console.error("Error updating status:", error)
-    return false
+    return { success: false }
   }
 }
 
@@ -71,3 +71,78 @@ document.querySelectorAll("input[required], textarea[required], select[required]
     }
   })
 })
+
+// Global search box (typeahead)
+const omnibox = document.querySelector(".omnibox")
+if (omnibox) {
+  const input = omnibox.querySelector(".omnibox-input")
+  const list = omnibox.querySelector(".omnibox-results")
+  const icons = { equipment: "🏭", request: "🔧", team: "👥", user: "👤" }
+  let controller = null
+  let timer = null
+  let active = -1
+
+  const highlight = (index) => {
+    const items = list.querySelectorAll("a")
+    items.forEach((item, i) => item.classList.toggle("active", i === index))
+    active = index
+  }
+
+  const render = (results) => {
+    list.innerHTML = ""
+    results.forEach((result) => {
+      const item = document.createElement("li")
+      const link = document.createElement("a")
+      link.href = result.url
+      link.innerHTML = `<span class="omnibox-icon"></span><span class="omnibox-label"></span><small></small>`
+      link.querySelector(".omnibox-icon").textContent = icons[result.kind]
+      link.querySelector(".omnibox-label").textContent = result.label
+      link.querySelector("small").textContent = result.detail
+      item.appendChild(link)
+      list.appendChild(item)
+    })
+    list.hidden = results.length === 0
+    highlight(results.length ? 0 : -1)
+  }
+
+  const lookup = async () => {
+    const q = input.value.trim()
+    if (controller) controller.abort()
+    if (q.length < 2) return render([])
+    controller = new AbortController()
+    try {
+      const response = await fetch(`${omnibox.dataset.url}?q=${encodeURIComponent(q)}`, { signal: controller.signal })
+      if (response.ok) render((await response.json()).results)
+    } catch (error) {
+      if (error.name !== "AbortError") throw error
+    }
+  }
+
+  input.addEventListener("input", () => {
+    clearTimeout(timer)
+    timer = setTimeout(lookup, 80)
+  })
+
+  input.addEventListener("keydown", (e) => {
+    const items = list.querySelectorAll("a")
+    if (e.key === "ArrowDown" && items.length) {
+      e.preventDefault()
+      highlight((active + 1) % items.length)
+    } else if (e.key === "ArrowUp" && items.length) {
+      e.preventDefault()
+      highlight((active - 1 + items.length) % items.length)
+    } else if (e.key === "Enter" && active >= 0) {
+      e.preventDefault()
+      window.location = items[active].href
+    } else if (e.key === "Escape") {
+      render([])
+    }
+  })
+
+  document.addEventListener("click", (e) => {
+    if (!omnibox.contains(e.target)) list.hidden = true
+  })
+  input.addEventListener("focus", () => {
+    list.hidden = list.children.length === 0
+  })
+}
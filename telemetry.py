@@ -0,0 +1,442 @@
+"""Request tracing and Prometheus metrics.
+
+Tracing: each request gets a root span with child spans for the user
+load, the view function, every SQL statement and every template render,
+so a slow page shows where its time went. Traces are exported as
+OTLP/JSON (the OpenTelemetry wire format) by a background thread, either
+appended one request per line to a file or POSTed to a collector's
+/v1/traces URL; set TRACE_EXPORT to a path or an http(s) URL. An incoming
+W3C ``traceparent`` header is continued, and TRACE_SAMPLE_RATE limits how
+many new traces are kept.
+
+Metrics: /metrics serves the Prometheus text format: per-endpoint latency
+histograms, the SQL, template and user-load time inside them, requests
+in flight, response classes, cache hit ratios and connection-pool usage.
+Scrapers send METRICS_TOKEN as a bearer token; without one set the route
+is 404, since it shows the traffic of an authenticated app.
+Counters live in shared memory created by init_telemetry(), i.e. in the
+pre-fork master (gunicorn --preload), so every worker adds to the same
+numbers and any worker can answer a scrape. Pool figures are those of
+the worker that answers.
+"""
+import bisect
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from flask import (Response, abort, before_render_template, current_app, g, has_request_context,
+                   request, request_finished, request_started, request_tearing_down, template_rendered)
+from sqlalchemy import event, inspect as sqlalchemy_inspect
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = 'gearguard'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Per endpoint: request seconds, SQL seconds, SQL statements, render seconds, user-load seconds
+BREAKDOWN = ('sql_seconds', 'sql_queries', 'render_seconds', 'user_load_seconds')
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+MAX_CACHES = 16
+MAX_STATEMENT_LENGTH = 1000
+EXPORT_QUEUE_SIZE = 1000
+EXPORT_BATCH_SIZE = 50
+
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+_cache_names = []
+
+
+def register_cache(name):
+    """Declare a cache whose hits and misses are reported; call at import time"""
+    if name not in _cache_names:
+        if len(_cache_names) == MAX_CACHES:
+            raise ValueError('Too many caches registered for metrics')
+        _cache_names.append(name)
+
+
+class Metrics:
+    """Fixed-layout counters in shared memory, one row per endpoint"""
+
+    def __init__(self, endpoints):
+        self.endpoints = sorted(endpoints) + ['other']
+        self.index = {endpoint: i for i, endpoint in enumerate(self.endpoints)}
+        # Per endpoint: one count per bucket, +Inf, sum, then the breakdown sums
+        self.row = len(LATENCY_BUCKETS) + 2 + len(BREAKDOWN)
+        self.requests = multiprocessing.Array('d', len(self.endpoints) * self.row)
+        self.statuses = multiprocessing.Array('d', len(STATUS_CLASSES))
+        self.caches = multiprocessing.Array('d', MAX_CACHES * 2)
+        self.in_flight = multiprocessing.Value('q', 0)
+
+    def observe(self, endpoint, seconds, status, breakdown):
+        base = self.index.get(endpoint, len(self.endpoints) - 1) * self.row
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.requests.get_lock():
+            self.requests[base + bucket] += 1
+            self.requests[base + len(LATENCY_BUCKETS) + 1] += seconds
+            for offset, name in enumerate(BREAKDOWN, len(LATENCY_BUCKETS) + 2):
+                self.requests[base + offset] += breakdown[name]
+        with self.statuses.get_lock():
+            self.statuses[min(max(status // 100, 1), 5) - 1] += 1
+
+    def count_cache(self, name, hit):
+        slot = _cache_names.index(name) * 2 + (0 if hit else 1)
+        with self.caches.get_lock():
+            self.caches[slot] += 1
+
+    def add_in_flight(self, delta):
+        with self.in_flight.get_lock():
+            self.in_flight.value += delta
+
+    def render(self, pools):
+        lines = [
+            '# HELP gearguard_request_duration_seconds Time to build the response, by endpoint',
+            '# TYPE gearguard_request_duration_seconds histogram',
+        ]
+        requests = self.requests[:]
+        breakdown_lines = {name: [] for name in BREAKDOWN}
+        for endpoint, i in self.index.items():
+            row = requests[i * self.row:(i + 1) * self.row]
+            total = sum(row[:len(LATENCY_BUCKETS) + 1])
+            if not total:
+                continue
+            metric = 'gearguard_request_duration_seconds'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, row):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative:g}')
+            lines.append(f'{metric}_bucket{{endpoint="{endpoint}",le="+Inf"}} {total:g}')
+            lines.append(f'{metric}_sum{{endpoint="{endpoint}"}} {row[len(LATENCY_BUCKETS) + 1]:g}')
+            lines.append(f'{metric}_count{{endpoint="{endpoint}"}} {total:g}')
+            for offset, name in enumerate(BREAKDOWN, len(LATENCY_BUCKETS) + 2):
+                breakdown_lines[name].append(f'gearguard_request_{name}_total{{endpoint="{endpoint}"}} {row[offset]:g}')
+
+        for name, samples in breakdown_lines.items():
+            lines.append(f'# TYPE gearguard_request_{name}_total counter')
+            lines.extend(samples)
+
+        lines.append('# TYPE gearguard_requests_in_flight gauge')
+        lines.append(f'gearguard_requests_in_flight {self.in_flight.value}')
+        lines.append('# TYPE gearguard_responses_total counter')
+        for status_class, count in zip(STATUS_CLASSES, self.statuses[:]):
+            lines.append(f'gearguard_responses_total{{code="{status_class}"}} {count:g}')
+
+        caches = self.caches[:]
+        lines.append('# TYPE gearguard_cache_requests_total counter')
+        for i, name in enumerate(_cache_names):
+            lines.append(f'gearguard_cache_requests_total{{cache="{name}",result="hit"}} {caches[i * 2]:g}')
+            lines.append(f'gearguard_cache_requests_total{{cache="{name}",result="miss"}} {caches[i * 2 + 1]:g}')
+        lines.append('# HELP gearguard_cache_hit_ratio Hits / lookups since start')
+        lines.append('# TYPE gearguard_cache_hit_ratio gauge')
+        for i, name in enumerate(_cache_names):
+            lookups = caches[i * 2] + caches[i * 2 + 1]
+            lines.append(f'gearguard_cache_hit_ratio{{cache="{name}"}} {caches[i * 2] / lookups if lookups else 0:g}')
+
+        lines.append('# HELP gearguard_db_pool_connections Connections of this worker\'s pools')
+        lines.append('# TYPE gearguard_db_pool_connections gauge')
+        pid = os.getpid()
+        for bind, pool in pools:
+            for state in ('size', 'checkedout', 'overflow', 'checkedin'):
+                value = getattr(pool, state, None)
+                if callable(value):  # not every pool class has every figure
+                    labels = f'bind="{bind}",pid="{pid}",state="{state}"'
+                    lines.append(f'gearguard_db_pool_connections{{{labels}}} {value()}')
+        return '\n'.join(lines) + '\n'
+
+
+# ---------------------------------------------------------------------------
+# Tracing
+# ---------------------------------------------------------------------------
+
+class Trace:
+    """Per-request state: timing totals always, spans only when sampled"""
+
+    def __init__(self, trace_id, parent_id, sampled):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans = []
+        self.stack = [parent_id]
+        self.started = time.perf_counter()
+        self.breakdown = dict.fromkeys(BREAKDOWN, 0.0)
+        self.status = 500
+        self.root = None
+        # (span, perf_counter at start) of renders and statements in progress
+        self.rendering = []
+        self.querying = []
+
+    def open(self, name, kind=1, **attributes):
+        span = {'name': name, 'kind': kind, 'span_id': os.urandom(8).hex(), 'parent_id': self.stack[-1],
+                'start': time.time_ns(), 'attributes': attributes}
+        self.stack.append(span['span_id'])
+        return span
+
+    def close(self, span, **attributes):
+        span['end'] = time.time_ns()
+        span['attributes'].update(attributes)
+        if self.stack[-1] == span['span_id']:
+            self.stack.pop()
+        if self.sampled:
+            self.spans.append(span)
+
+
+def _current_trace():
+    return g.get('_trace') if has_request_context() else None
+
+
+@contextmanager
+def span(name, **attributes):
+    """Record a child span of the current request (no-op outside requests)"""
+    trace = _current_trace()
+    if trace is None:
+        yield
+        return
+    opened = trace.open(name, **attributes)
+    try:
+        yield
+    finally:
+        trace.close(opened)
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+def to_otlp(trace):
+    """One ExportTraceServiceRequest (OTLP/JSON) for a finished trace"""
+    return {'resourceSpans': [{
+        'resource': {'attributes': [_attribute('service.name', SERVICE_NAME),
+                                    _attribute('process.pid', os.getpid())]},
+        'scopeSpans': [{
+            'scope': {'name': __name__},
+            'spans': [{
+                'traceId': trace.trace_id,
+                'spanId': s['span_id'],
+                'parentSpanId': s['parent_id'] or '',
+                'name': s['name'],
+                'kind': s['kind'],
+                'startTimeUnixNano': str(s['start']),
+                'endTimeUnixNano': str(s['end']),
+                'attributes': [_attribute(key, value) for key, value in s['attributes'].items() if value is not None],
+            } for s in trace.spans],
+        }],
+    }]}
+
+
+class TraceExporter:
+    """Writes finished traces to a JSON-lines file or POSTs them to an OTLP/HTTP collector"""
+
+    def __init__(self, target):
+        self.target = target
+        self.queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, trace):
+        # Started on first use in each process: threads do not survive a fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+                    threading.Thread(target=self.run, name='trace-exporter', daemon=True).start()
+                    self._pid = os.getpid()
+        try:
+            self.queue.put_nowait(to_otlp(trace))
+        except queue.Full:
+            pass  # tracing must never slow requests down
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < EXPORT_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.export(batch)
+            except Exception:
+                logger.exception('Exporting %d traces to %s failed', len(batch), self.target)
+
+    def export(self, batch):
+        if self.target.startswith(('http://', 'https://')):
+            merged = {'resourceSpans': [spans for item in batch for spans in item['resourceSpans']]}
+            post = urllib.request.Request(self.target, data=json.dumps(merged).encode(),
+                                          headers={'Content-Type': 'application/json'})
+            urllib.request.urlopen(post, timeout=5).close()
+        else:
+            with open(self.target, 'a', encoding='utf-8') as f:
+                for item in batch:
+                    f.write(json.dumps(item, separators=(',', ':')) + '\n')
+
+
+# ---------------------------------------------------------------------------
+# Hooks
+# ---------------------------------------------------------------------------
+
+def _start_request(app, **extra):
+    parent = TRACEPARENT.match(request.headers.get('traceparent', ''))
+    if parent:
+        trace = Trace(parent.group(1), parent.group(2), parent.group(3) == '01')
+    else:
+        sample_rate = app.config['TRACE_SAMPLE_RATE']
+        trace = Trace(os.urandom(16).hex(), None, random.random() < sample_rate)
+    trace.sampled = trace.sampled and app.extensions['telemetry']['exporter'] is not None
+    rule = request.url_rule.rule if request.url_rule else request.path
+    trace.root = trace.open(f'{request.method} {rule}', kind=2, **{
+        'http.method': request.method, 'http.route': rule, 'http.target': request.full_path.rstrip('?'),
+    })
+    g._trace = trace
+    app.extensions['telemetry']['metrics'].add_in_flight(1)
+
+
+def _note_response(app, response, **extra):
+    trace = _current_trace()
+    if trace is not None:
+        trace.status = response.status_code
+
+
+def _user_id():
+    # Read from the identity map, never from the instance: after a failed
+    # flush, attribute access would try to refresh through the broken session
+    state = sqlalchemy_inspect(g.get('_login_user'), raiseerr=False)
+    identity = getattr(state, 'identity', None)
+    return identity[0] if identity else None
+
+
+def _finish_request(app, exc=None, **extra):
+    trace = g.pop('_trace', None)
+    if trace is None:
+        return
+    # Telemetry must never turn into the request's error
+    try:
+        telemetry = app.extensions['telemetry']
+        telemetry['metrics'].add_in_flight(-1)
+        elapsed = time.perf_counter() - trace.started
+        telemetry['metrics'].observe(request.endpoint, elapsed, trace.status, trace.breakdown)
+
+        trace.close(trace.root, **{'http.status_code': trace.status, 'enduser.id': _user_id()})
+        if trace.sampled:
+            telemetry['exporter'].submit(trace)
+    except Exception:
+        logger.exception('Recording telemetry for %s failed', request.path)
+
+
+def _start_render(app, template, context, **extra):
+    trace = _current_trace()
+    if trace is not None:
+        trace.rendering.append((trace.open(f'render {template.name}', template=template.name), time.perf_counter()))
+
+
+def _finish_render(app, template, context, **extra):
+    trace = _current_trace()
+    if trace is not None and trace.rendering:
+        opened, started = trace.rendering.pop()
+        trace.close(opened)
+        if not trace.rendering:
+            trace.breakdown['render_seconds'] += time.perf_counter() - started
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_sql(conn, cursor, statement, parameters, context, executemany):
+    trace = _current_trace()
+    if trace is not None:
+        trace.querying.append((trace.open(
+            'sql', kind=3, **{'db.system': conn.dialect.name, 'db.statement': statement[:MAX_STATEMENT_LENGTH]}
+        ), time.perf_counter()))
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _finish_sql(conn, cursor, statement, parameters, context, executemany):
+    trace = _current_trace()
+    if trace is not None and trace.querying:
+        opened, started = trace.querying.pop()
+        trace.close(opened)
+        trace.breakdown['sql_seconds'] += time.perf_counter() - started
+        trace.breakdown['sql_queries'] += 1
+
+
+@event.listens_for(Engine, 'handle_error')
+def _fail_sql(exception_context):
+    trace = _current_trace()
+    if trace is not None and trace.querying:
+        opened, started = trace.querying.pop()
+        trace.close(opened, error=type(exception_context.original_exception).__name__)
+        trace.breakdown['sql_seconds'] += time.perf_counter() - started
+        trace.breakdown['sql_queries'] += 1
+
+
+@contextmanager
+def user_load_span():
+    """Wraps the Flask-Login user loader"""
+    trace = _current_trace()
+    started = time.perf_counter()
+    with span('auth.load_user'):
+        yield
+    if trace is not None:
+        trace.breakdown['user_load_seconds'] += time.perf_counter() - started
+
+
+def count_cache(name, hit):
+    try:
+        metrics = current_app.extensions['telemetry']['metrics']
+    except (RuntimeError, KeyError):
+        return  # outside the app, or telemetry not initialised
+    metrics.count_cache(name, hit)
+
+
+def _traced_view(endpoint, view):
+    def traced(*args, **kwargs):
+        with span(f'view {endpoint}', endpoint=endpoint):
+            return view(*args, **kwargs)
+    traced.__name__ = view.__name__
+    traced.__doc__ = view.__doc__
+    traced.__wrapped__ = view
+    return traced
+
+
+def init_telemetry(app):
+    """Call after every blueprint and route is registered"""
+
+    @app.route('/metrics')
+    def metrics():
+        token = app.config.get('METRICS_TOKEN')
+        if not token:
+            abort(404)  # off unless a scraper has been given a token
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(403)
+        from models import db
+        pools = [(bind or 'default', engine.pool) for bind, engine in db.engines.items()]
+        pools += [(f'site-{site_id}', engine.pool)
+                  for site_id, engine in app.extensions.get('site_engines', {}).items()]
+        return Response(app.extensions['telemetry']['metrics'].render(pools),
+                        mimetype='text/plain; version=0.0.4')
+
+    target = app.config.get('TRACE_EXPORT')
+    app.extensions['telemetry'] = {
+        'metrics': Metrics(app.view_functions),
+        'exporter': TraceExporter(target) if target else None,
+    }
+
+    for endpoint, view in list(app.view_functions.items()):
+        app.view_functions[endpoint] = _traced_view(endpoint, view)
+
+    request_started.connect(_start_request, app)
+    request_finished.connect(_note_response, app)
+    request_tearing_down.connect(_finish_request, app)
+    before_render_template.connect(_start_render, app)
+    template_rendered.connect(_finish_render, app)
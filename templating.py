@@ -0,0 +1,94 @@
+"""Compiled-template cache on disk and a fragment cache for repeated markup.
+
+Jinja compiles each template to Python bytecode the first time it is used.
+With a bytecode cache the result is written to TEMPLATE_CACHE_DIR (default:
+instance/jinja-cache) and reused by every later process, so a fresh worker,
+CLI command or restarted server loads templates instead of compiling them.
+Entries carry a checksum of the template source; editing a template simply
+writes a new one.
+
+``{% cache 'name', key, ... %}...{% endcache %}`` renders its body once per
+distinct key and reuses the markup afterwards, e.g. a kanban card keyed by
+request id and row version. Fragments also embed team, user and equipment
+names, so every key additionally includes the dropdown-cache version
+(services/reference.py), which changes whenever one of those is written.
+Old keys are never looked up again and fall out of the per-process LRU of
+FRAGMENT_CACHE_MAX_ENTRIES; set it to 0 to render everything live.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+from services.reference import current_version
+from telemetry import count_cache, register_cache
+
+logger = logging.getLogger(__name__)
+
+_fragments = OrderedDict()
+_fragments_lock = threading.Lock()
+
+register_cache('fragments')
+
+
+def cached_fragment(key, render):
+    """Markup for key, rendering it with render() on a miss"""
+    max_entries = current_app.config['FRAGMENT_CACHE_MAX_ENTRIES']
+    if not max_entries:
+        return render()
+
+    key = key + (current_version(),)
+    with _fragments_lock:
+        markup = _fragments.get(key)
+        if markup is not None:
+            _fragments.move_to_end(key)
+    count_cache('fragments', markup is not None)
+    if markup is not None:
+        return markup
+
+    markup = render()
+    with _fragments_lock:
+        _fragments[key] = markup
+        while len(_fragments) > max_entries:
+            _fragments.popitem(last=False)
+    return markup
+
+
+def clear_fragments():
+    with _fragments_lock:
+        _fragments.clear()
+
+
+class FragmentCacheExtension(Extension):
+    """The {% cache %} tag"""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        call = self.call_method('_render', [nodes.Tuple(key, 'load')])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        return cached_fragment(key, caller)
+
+
+def init_templating(app):
+    """Call before any template is loaded"""
+    app.jinja_env.add_extension(FragmentCacheExtension)
+
+    directory = app.config.get('TEMPLATE_CACHE_DIR') or os.path.join(app.instance_path, 'jinja-cache')
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        logger.warning('Template cache directory %s is not writable; compiling templates in memory', directory)
+        return
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
@@ -0,0 +1,12 @@
+"""WSGI entry point.
+
+Pre-fork servers should load this once in the master so workers inherit the
+imported code and compiled templates, e.g.::
+
+    gunicorn --preload --workers 4 wsgi:app
+
+Seed sample data explicitly with ``flask --app app seed``.
+"""
+from app import create_app
+
+app = create_app()